@@ -1,6 +1,6 @@
 from model import AbstractModel
 from model_utils import GenericMLP, MoLeROutput, PropertyRegressionMLP, DiscriminatorMLP
-from encoder import GraphEncoder, PartialGraphEncoder
+from encoder import GraphEncoder, PartialGraphEncoder, encode_original_graphs
 from decoder import MLPDecoder
 import torch
 from rdkit import Chem
@@ -172,11 +172,11 @@ class AAE(AbstractModel):
         if self.uses_motifs:
             # Record the set of atom types, which will be a subset of all node types.
             self._atom_types = set(
-                dataset._atom_type_featuriser.index_to_atom_type_map.values()
+                dataset.atom_type_featuriser.index_to_atom_type_map.values()
             )
 
         self._index_to_node_type_map = dataset.node_type_index_to_string
-        self._atom_featurisers = dataset._metadata["feature_extractors"]
+        self._atom_featurisers = dataset.metadata["feature_extractors"]
         self._num_node_types = dataset.num_node_types
 
     # def sample_from_latent_repr(self, latent_repr):
@@ -230,12 +230,8 @@ class AAE(AbstractModel):
 
     def _run_step(self, batch):
         # Obtain graph level representation of original molecular graph
-        input_molecule_representations = self.full_graph_encoder(
-            original_graph_node_categorical_features=batch.original_graph_node_categorical_features,
-            node_features=batch.original_graph_x.float(),
-            edge_index=batch.original_graph_edge_index,
-            edge_features=batch.original_graph_edge_features,  # can be edge_type or edge_attr
-            batch_index=batch.original_graph_x_batch,
+        input_molecule_representations = encode_original_graphs(
+            self.full_graph_encoder, batch, deduplicate=self.deduplicate_original_graphs
         )
 
         # Obtain graph level representation of the partial graph
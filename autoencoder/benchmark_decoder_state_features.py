@@ -0,0 +1,182 @@
+"""
+Equivalence check and benchmark of the incremental featurization of decoder states
+(`DecoderStateFeaturizer`) against rebuilding the node features and edges of the whole partial
+molecule in every decoding step, as `batch_decoder_states` did before.
+
+The decoder states come from random decoding walks (atoms, bonds with ring closures, motifs and
+beam siblings that branch off the same molecule), and every state is featurized by both. The node
+features, categorical features, edge index and edge types have to be identical, and only the ring
+closures among the states that add bonds may be featurized from scratch.
+
+    python benchmark_decoder_state_features.py --num_molecules 200 --num_atoms 40
+"""
+from decoding_utils import DecoderStateFeaturizer
+from molecule_generation.chem.atom_feature_utils import get_default_atom_featurisers
+from molecule_generation.chem.motif_utils import MotifExtractionSettings, MotifVocabulary
+from molecule_generation.chem.rdkit_helpers import initialise_atom_from_symbol
+from molecule_generation.utils.moler_decoding_utils import MoLeRDecoderState
+from rdkit import Chem
+import argparse
+import time
+import numpy as np
+
+ATOM_TYPES = ["C", "N", "O", "S", "F", "Cl", "N+", "O-"]
+MOTIFS = ["C1=CC=CC=C1", "C1CCNCC1", "C1=CC=NC=C1", "C1CC1"]
+
+
+def reference_features(decoder_state, atom_featurisers, motif_vocabulary):
+    """The node features and edges of the previous `batch_decoder_states`."""
+    node_features, node_categorical_features = decoder_state.get_node_features(
+        atom_featurisers, motif_vocabulary
+    )
+    edge_indexes = []
+    edge_types = []
+    for edge_type_idx, adj_list in enumerate(decoder_state.adjacency_lists):
+        if len(adj_list) > 0:
+            edge_indexes += [np.array(adj_list, dtype=np.int32).T]
+            edge_types += [edge_type_idx] * len(adj_list)
+    edge_index = (
+        np.concatenate(edge_indexes, 1)
+        if len(edge_indexes) > 0
+        else np.array([[], []], dtype=np.int32)
+    )
+    return node_features, node_categorical_features, edge_index, np.array(edge_types)
+
+
+def make_atom_featurisers():
+    atom_featurisers = get_default_atom_featurisers()
+    for featuriser in atom_featurisers:
+        if not featuriser.metadata_initialised:
+            for symbol in ATOM_TYPES:
+                for num_bonds in range(5):
+                    # prepare_metadata only looks at the atom type, degree, charge and radicals
+                    atom = initialise_atom_from_symbol(symbol)
+                    atom.SetNoImplicit(True)
+                    featuriser.prepare_metadata(atom)
+            featuriser.mark_metadata_initialised()
+    return atom_featurisers
+
+
+def random_walk(molecule_id, num_atoms, motif_vocabulary, rng):
+    """Yields the decoder states of a random decoding run, including some beam siblings."""
+    # like the empty states of `construct_decoder_states`
+    state = MoLeRDecoderState(
+        molecule_representation=None, molecule_id=molecule_id, molecule=Chem.Mol(), atom_types=[]
+    )
+    while state.molecule.GetNumAtoms() < num_atoms:
+        if motif_vocabulary is not None and rng.random() < 0.1:
+            state = MoLeRDecoderState.new_with_added_motif(
+                state, rng.choice(MOTIFS), motif_logprob=0.0
+            )
+            yield state
+            state = MoLeRDecoderState.new_with_focus_on_attachment_point(
+                state,
+                int(rng.choice(state.candidate_attachment_points)),
+                focus_atom_logprob=0.0,
+                attachment_point_choice_info=None,
+            )
+        else:
+            if rng.random() < 0.2:
+                # another beam: a sibling of the next state
+                yield MoLeRDecoderState.new_with_added_atom(
+                    state, rng.choice(ATOM_TYPES), atom_logprob=0.0
+                )
+            state = MoLeRDecoderState.new_with_added_atom(
+                state, rng.choice(ATOM_TYPES), atom_logprob=0.0
+            )
+        yield state
+
+        # the first bond extends the molecule, the second one closes a ring
+        num_bonds = rng.choice([0, 1, 1, 1, 2]) if len(state._visited_atoms) > 0 else 0
+        for _ in range(num_bonds):
+            bonded = {v for adj_list in state.adjacency_lists for u, v in adj_list if u == state.focus_atom}
+            targets = [idx for idx in state._visited_atoms if idx not in bonded and idx != state.focus_atom]
+            if len(targets) == 0:
+                break
+            state = MoLeRDecoderState.new_with_added_bond(
+                state, int(rng.choice(targets)), int(rng.choice([0, 0, 1])), bond_logprob=0.0
+            )
+            yield state
+        state = MoLeRDecoderState.new_with_focus_marked_as_visited(
+            state, focus_node_finished_logprob=0.0
+        )
+        yield state
+
+
+def num_bonds(decoder_state):
+    return sum(len(adj_list) for adj_list in decoder_state.adjacency_lists)
+
+
+def assert_same_features(expected, actual):
+    for name, e, a in zip(["node features", "categorical", "edge index", "edge types"], expected, actual):
+        if e is None:
+            assert a is None, name
+            continue
+        e, a = np.asarray(e), np.asarray(a)
+        assert e.dtype == a.dtype and np.array_equal(e, a), name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_molecules", type=int, default=200)
+    parser.add_argument("--num_atoms", type=int, default=40)
+    parser.add_argument("--no_motifs", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    atom_featurisers = make_atom_featurisers()
+    motif_vocabulary = (
+        None
+        if args.no_motifs
+        else MotifVocabulary(
+            vocabulary={motif: i for i, motif in enumerate(MOTIFS)},
+            settings=MotifExtractionSettings(
+                min_frequency=None, min_num_atoms=3, cut_leaf_edges=False, max_vocab_size=None
+            ),
+        )
+    )
+    states = [
+        state
+        for molecule_id in range(args.num_molecules)
+        for state in random_walk(molecule_id, args.num_atoms, motif_vocabulary, rng)
+    ]
+    print(f"{len(states)} decoder states of {args.num_molecules} molecules")
+
+    featurizer = DecoderStateFeaturizer(atom_featurisers, motif_vocabulary)
+    num_bonds_per_molecule = {}
+    num_bond_states = 0
+    num_rebuilt_bond_states = 0
+    for state in states:
+        num_rebuilds = featurizer.num_rebuilds
+        assert_same_features(
+            reference_features(state, atom_featurisers, motif_vocabulary),
+            featurizer.featurize(state),
+        )
+        # states that add bonds (or motifs) to the last state of their molecule
+        if num_bonds(state) > num_bonds_per_molecule.get(state.molecule_id, 0):
+            num_bond_states += 1
+            num_rebuilt_bond_states += featurizer.num_rebuilds - num_rebuilds
+        num_bonds_per_molecule[state.molecule_id] = num_bonds(state)
+    print("incremental features identical to the full rebuild")
+    print(
+        f"{num_rebuilt_bond_states} of {num_bond_states} states that add bonds featurized from "
+        f"scratch, {featurizer.num_rebuilds} of {len(states)} states in total"
+    )
+    # only the ring closures, the second bond of about a fifth of the atoms
+    assert num_rebuilt_bond_states < 0.3 * num_bond_states
+
+    start = time.perf_counter()
+    for state in states:
+        reference_features(state, atom_featurisers, motif_vocabulary)
+    reference_time = time.perf_counter() - start
+    featurizer = DecoderStateFeaturizer(atom_featurisers, motif_vocabulary)
+    start = time.perf_counter()
+    for state in states:
+        featurizer.featurize(state)
+    incremental_time = time.perf_counter() - start
+    print(
+        f"full rebuild {reference_time * 1e3 / len(states):.3f} ms per state, incremental "
+        f"{incremental_time * 1e3 / len(states):.3f} ms per state "
+        f"({reference_time / incremental_time:.2f}x)"
+    )
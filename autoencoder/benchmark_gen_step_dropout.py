@@ -0,0 +1,94 @@
+"""
+Microbenchmark for the generation step dropout in `MolerDataset.get`: unbatching and rebatching
+the shard versus slicing the batched tensors with `select_gen_steps`. Both are run on the same
+random draws and checked to give exactly the same batches.
+
+    python benchmark_gen_step_dropout.py \
+        --processed_split_folder=data/guacamol/already_batched/train_0 \
+        --num_shards=10
+"""
+from columnar_shards import load_pickled_shard
+from dataset import select_gen_steps
+from torch_geometric.data import Batch
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+
+def rebatch_gen_steps(batch, selected_idx, follow_batch):
+    """The previous implementation."""
+    unrolled = batch.to_data_list()
+    return Batch.from_data_list(
+        [unrolled[i] for i in selected_idx], follow_batch=follow_batch
+    )
+
+
+def assert_identical(expected, actual):
+    assert list(expected.keys()) == list(actual.keys())
+    for key in expected.keys():
+        assert expected[key].dtype == actual[key].dtype, key
+        assert torch.equal(expected[key], actual[key]), key
+    for attr in ["_slice_dict", "_inc_dict"]:
+        assert getattr(expected, attr).keys() == getattr(actual, attr).keys()
+        for key, value in getattr(expected, attr).items():
+            assert value.dtype == getattr(actual, attr)[key].dtype, (attr, key)
+            assert torch.equal(value, getattr(actual, attr)[key]), (attr, key)
+    assert expected.num_graphs == actual.num_graphs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processed_split_folder", required=True, type=str)
+    parser.add_argument("--num_shards", type=int, default=10)
+    parser.add_argument("--gen_step_drop_probability", type=float, default=0.5)
+    parser.add_argument("--num_repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    file_paths = pd.read_csv(
+        os.path.join(args.processed_split_folder, "processed_file_paths.csv")
+    )["file_names"].tolist()[: args.num_shards]
+    shards = [load_pickled_shard(file_path) for file_path in file_paths]
+
+    rng = np.random.RandomState(0)
+    draws = [
+        [
+            np.arange(shard.num_graphs)[
+                rng.rand(shard.num_graphs) > args.gen_step_drop_probability
+            ]
+            for shard in shards
+        ]
+        for _ in range(args.num_repeats)
+    ]
+
+    for shard, selected_idx in zip(shards, draws[0]):
+        follow_batch = [key for key in shard._slice_dict if f"{key}_batch" in shard]
+        assert_identical(
+            rebatch_gen_steps(shard, selected_idx, follow_batch),
+            select_gen_steps(shard, selected_idx),
+        )
+    print("select_gen_steps matches to_data_list + from_data_list exactly")
+
+    timings = {}
+    for name, select_fn in [
+        (
+            "to_data_list + from_data_list",
+            lambda shard, selected_idx: rebatch_gen_steps(
+                shard,
+                selected_idx,
+                [key for key in shard._slice_dict if f"{key}_batch" in shard],
+            ),
+        ),
+        ("select_gen_steps", select_gen_steps),
+    ]:
+        start = time.perf_counter()
+        for repeat_draws in draws:
+            for shard, selected_idx in zip(shards, repeat_draws):
+                select_fn(shard, selected_idx)
+        timings[name] = (time.perf_counter() - start) / (len(shards) * len(draws))
+        print(f"{name:>30}: {timings[name] * 1e3:8.2f} ms per shard")
+    print(
+        f"speedup: {timings['to_data_list + from_data_list'] / timings['select_gen_steps']:.1f}x"
+    )
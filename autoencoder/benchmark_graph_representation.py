@@ -0,0 +1,111 @@
+"""
+Microbenchmark for the softmax weighting in `WeightedSumGraphRepresentation.forward`: one
+`unsorted_segment_softmax` per head versus one over the [V, H] score matrix of all heads. Both
+are checked to give the same weights and the same graph representations.
+
+    python benchmark_graph_representation.py --num_graphs=1000 --mean_num_nodes=15 --device=cuda
+"""
+from model_utils import WeightedSumGraphRepresentation
+from utils import unsorted_segment_softmax
+from torch_geometric.utils import scatter
+import argparse
+import time
+import torch
+
+
+def per_head_softmax(scores, batch):
+    """The previous implementation."""
+    weights_per_head = []
+    for head_idx in range(scores.shape[1]):
+        weights_per_head.append(
+            unsorted_segment_softmax(logits=scores[:, head_idx], segment_ids=batch)
+        )
+    return torch.stack(weights_per_head, dim=-1)
+
+
+def per_head_forward(module, x, batch):
+    """`WeightedSumGraphRepresentation.forward` with the previous softmax weighting."""
+    weights = per_head_softmax(module._scoring_mlp(x), batch)
+    node_reprs = module._transformation_mlp_activation_fun(module._transformation_mlp(x))
+    node_reprs = node_reprs.view(
+        -1, module._num_heads, module._graph_representation_size // module._num_heads
+    )
+    weighted_node_reprs = (weights.unsqueeze(-1) * node_reprs).view(
+        -1, module._graph_representation_size
+    )
+    return scatter(weighted_node_reprs, batch, reduce="sum")
+
+
+def time_fn(fn, num_repeats, device):
+    for _ in range(3):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_graphs", type=int, default=1000)
+    parser.add_argument("--mean_num_nodes", type=int, default=15)
+    parser.add_argument("--input_feature_dim", type=int, default=832)
+    parser.add_argument("--graph_representation_size", type=int, default=416)
+    parser.add_argument("--num_heads", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--num_repeats", type=int, default=50)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    num_nodes_per_graph = torch.randint(
+        1, 2 * args.mean_num_nodes, (args.num_graphs,), device=device
+    )
+    batch = torch.repeat_interleave(
+        torch.arange(args.num_graphs, device=device), num_nodes_per_graph
+    )
+    x = torch.randn(batch.shape[0], args.input_feature_dim, device=device)
+
+    for num_heads in args.num_heads:
+        module = (
+            WeightedSumGraphRepresentation(
+                num_heads=num_heads,
+                input_feature_dim=args.input_feature_dim,
+                graph_representation_size=args.graph_representation_size,
+                weighting_fun="softmax",
+            )
+            .to(device)
+            .eval()
+        )
+        with torch.no_grad():
+            scores = module._scoring_mlp(x)
+            expected_weights = per_head_softmax(scores, batch)
+            actual_weights = unsorted_segment_softmax(logits=scores, segment_ids=batch)
+            print(
+                f"heads={num_heads}: weights identical: "
+                f"{torch.equal(expected_weights, actual_weights)}, max abs difference "
+                f"{(expected_weights - actual_weights).abs().max().item():.3g}"
+            )
+            expected = per_head_forward(module, x, batch)
+            actual = module(x, batch)
+            print(
+                f"heads={num_heads}: graph representations identical: "
+                f"{torch.equal(expected, actual)}, max abs difference "
+                f"{(expected - actual).abs().max().item():.3g}"
+            )
+
+            for name, fn in [
+                ("softmax per head", lambda: per_head_softmax(scores, batch)),
+                (
+                    "softmax all heads",
+                    lambda: unsorted_segment_softmax(logits=scores, segment_ids=batch),
+                ),
+                ("forward per head", lambda: per_head_forward(module, x, batch)),
+                ("forward all heads", lambda: module(x, batch)),
+            ]:
+                elapsed = time_fn(fn, args.num_repeats, device)
+                print(f"heads={num_heads}: {name:>18}: {elapsed * 1e3:8.3f} ms")
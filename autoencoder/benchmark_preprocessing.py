@@ -0,0 +1,68 @@
+"""
+Benchmark for `MolerDataset.process`: converts the raw MoLeR generation traces of one split with
+different numbers of worker processes and reports the throughput.
+
+    python benchmark_preprocessing.py \
+        --raw_moler_trace_dataset_parent_folder=data/guacamol/trace_dir \
+        --split=valid_0 \
+        --num_workers 1 4 16
+"""
+from dataset import MolerDataset
+import argparse
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+
+def count_traces(raw_file_names):
+    num_traces = 0
+    for pkl_file_path in raw_file_names:
+        with gzip.open(pkl_file_path, "rb") as f:
+            num_traces += len(pickle.load(f))
+    return num_traces
+
+
+def run_preprocessing(raw_moler_trace_dataset_parent_folder, split, num_workers):
+    output_folder = tempfile.mkdtemp(prefix="benchmark_preprocessing_")
+    try:
+        start = time.perf_counter()
+        dataset = MolerDataset(
+            root=output_folder,
+            raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
+            output_pyg_trace_dataset_parent_folder=output_folder,
+            split=split,
+            num_workers=num_workers,
+        )
+        elapsed = time.perf_counter() - start
+        return elapsed, dataset.raw_file_names
+    finally:
+        shutil.rmtree(output_folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--raw_moler_trace_dataset_parent_folder",
+        type=str,
+        default="data/guacamol/trace_dir",
+    )
+    parser.add_argument("--split", type=str, default="valid_0")
+    parser.add_argument(
+        "--num_workers", type=int, nargs="+", default=[1, 4, os.cpu_count()]
+    )
+    args = parser.parse_args()
+
+    num_traces = None
+    for num_workers in args.num_workers:
+        elapsed, raw_file_names = run_preprocessing(
+            args.raw_moler_trace_dataset_parent_folder, args.split, num_workers
+        )
+        if num_traces is None:
+            num_traces = count_traces(raw_file_names)
+        print(
+            f"num_workers={num_workers:3d}: {num_traces} traces in {elapsed:.1f}s "
+            f"=> {num_traces / elapsed:.1f} traces/s"
+        )
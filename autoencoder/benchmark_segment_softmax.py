@@ -0,0 +1,155 @@
+"""
+Benchmark and equivalence check of the fused segment (log) softmax in `utils.py` against the
+previous implementation of separate scatter/gather passes, for the segment size distributions of
+the decoder losses and the graph pooling. Forward results and gradients of every backend are
+compared to the reference before anything is timed.
+
+    python benchmark_segment_softmax.py --device=cuda --backends eager torchscript compile
+"""
+from utils import (
+    SMALL_NUMBER,
+    set_segment_softmax_backend,
+    traced_unsorted_segment_log_softmax,
+    unsorted_segment_softmax,
+)
+from torch_geometric.utils import scatter
+import argparse
+import time
+import torch
+
+
+def reference_segment_log_softmax(logits, segment_ids):
+    """The previous implementation of `traced_unsorted_segment_log_softmax`."""
+    max_per_segment = scatter(logits, segment_ids, reduce="max")
+    recentered_scores = logits - max_per_segment[segment_ids]
+    per_segment_sums = scatter(torch.exp(recentered_scores), segment_ids, reduce="sum")
+    return recentered_scores - torch.log(per_segment_sums + SMALL_NUMBER)[segment_ids]
+
+
+def reference_segment_softmax(logits, segment_ids):
+    """The previous implementation of `unsorted_segment_softmax`."""
+    max_per_segment = scatter(logits, segment_ids, reduce="max")
+    exped_recentered_scores = torch.exp(logits - max_per_segment[segment_ids])
+    per_segment_sums = scatter(exped_recentered_scores, segment_ids, reduce="sum")
+    return exped_recentered_scores / (per_segment_sums[segment_ids] + SMALL_NUMBER)
+
+
+def make_segment_ids(segment_sizes, device, shuffle):
+    segment_ids = torch.repeat_interleave(
+        torch.arange(len(segment_sizes), device=device), segment_sizes.to(device)
+    )
+    if shuffle:
+        # the edge candidates of a graph are not necessarily contiguous
+        segment_ids = segment_ids[torch.randperm(len(segment_ids), device=device)]
+    return segment_ids
+
+
+# (name, segment sizes of 1000 graphs, number of columns, unsorted segment ids)
+WORKLOADS = [
+    (
+        "edge candidates + stop",
+        lambda: torch.randint(1, 30, (1000,)) + 1,
+        None,
+        True,
+    ),
+    ("attachment points", lambda: torch.randint(2, 7, (1000,)), None, False),
+    (
+        "graph pooling, 16 heads",
+        lambda: torch.randint(1, 40, (1000,)),
+        16,
+        False,
+    ),
+    (
+        "skewed (lognormal)",
+        lambda: torch.distributions.LogNormal(2.0, 1.0)
+        .sample((1000,))
+        .long()
+        .clamp(min=1),
+        None,
+        True,
+    ),
+]
+
+
+def time_fn(fn, num_repeats, device):
+    for _ in range(3):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_repeats
+
+
+def forward_backward(fn, logits, segment_ids):
+    logits.grad = None
+    fn(logits, segment_ids).square().sum().backward()
+    return logits.grad
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["eager", "torchscript"],
+        choices=["eager", "torchscript", "compile"],
+    )
+    parser.add_argument("--num_repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    for name, segment_sizes_fn, num_columns, shuffle in WORKLOADS:
+        segment_ids = make_segment_ids(segment_sizes_fn(), device, shuffle)
+        shape = (len(segment_ids),) if num_columns is None else (len(segment_ids), num_columns)
+        logits = (3 * torch.randn(shape, device=device)).requires_grad_()
+        print(f"{name}: {len(segment_ids)} logits")
+
+        for kind, reference_fn, fused_fn in [
+            ("log_softmax", reference_segment_log_softmax, traced_unsorted_segment_log_softmax),
+            ("softmax", reference_segment_softmax, unsorted_segment_softmax),
+        ]:
+            expected = reference_fn(logits, segment_ids)
+            expected_grad = forward_backward(reference_fn, logits, segment_ids)
+            timings = {
+                "reference": time_fn(
+                    lambda: forward_backward(reference_fn, logits, segment_ids),
+                    args.num_repeats,
+                    device,
+                )
+            }
+            for backend in args.backends:
+                set_segment_softmax_backend(backend)
+                actual = fused_fn(logits, segment_ids)
+                actual_grad = forward_backward(fused_fn, logits, segment_ids)
+                # the reference also backpropagates through the segment maxima, whose gradients
+                # cancel out analytically but not exactly in floating point
+                relative_grad_difference = (
+                    (expected_grad - actual_grad).abs().max()
+                    / expected_grad.abs().max()
+                ).item()
+                assert torch.allclose(expected, actual, atol=1e-6), (kind, backend)
+                assert relative_grad_difference < 1e-5, (kind, backend)
+                print(
+                    f"  {kind:>11} {backend:>11}: forward identical "
+                    f"{torch.equal(expected, actual)}, max gradient difference "
+                    f"{relative_grad_difference:.3g} of the largest gradient"
+                )
+                timings[backend] = time_fn(
+                    lambda: forward_backward(fused_fn, logits, segment_ids),
+                    args.num_repeats,
+                    device,
+                )
+            set_segment_softmax_backend("eager")
+            print(
+                f"  {kind:>11} forward + backward: "
+                + ", ".join(
+                    f"{backend} {elapsed * 1e3:.3f} ms"
+                    for backend, elapsed in timings.items()
+                )
+            )
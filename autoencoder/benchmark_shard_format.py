@@ -0,0 +1,90 @@
+"""
+Benchmark comparing how fast the gzipped pickle shards and the columnar shards of a processed
+split can be read. The pickled shards are converted into a temporary folder first.
+
+    python benchmark_shard_format.py \
+        --processed_split_folder=data/guacamol/already_batched/valid_0 \
+        --num_shards=20
+"""
+from columnar_shards import (
+    columnar_shard_file_path,
+    load_columnar_shard,
+    load_pickled_shard,
+    save_columnar_shard,
+)
+from dataset import MolerData
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import pandas as pd
+import torch
+
+
+def touch_all_tensors(batch):
+    """Reads every tensor once so that lazily mapped pages are included in the timing."""
+    for _, value in batch:
+        if isinstance(value, torch.Tensor):
+            value.sum()
+
+
+def time_reads(file_paths, load_fn, num_passes, touch):
+    start = time.perf_counter()
+    for _ in range(num_passes):
+        for file_path in file_paths:
+            batch = load_fn(file_path)
+            if touch:
+                touch_all_tensors(batch)
+    return (time.perf_counter() - start) / num_passes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processed_split_folder", required=True, type=str)
+    parser.add_argument("--num_shards", type=int, default=20)
+    parser.add_argument("--num_passes", type=int, default=3)
+    args = parser.parse_args()
+
+    pickled_file_paths = pd.read_csv(
+        os.path.join(args.processed_split_folder, "processed_file_paths.csv")
+    )["file_names"].tolist()[: args.num_shards]
+
+    tmp_folder = tempfile.mkdtemp(prefix="benchmark_shard_format_")
+    try:
+        columnar_file_paths = []
+        num_gen_steps = 0
+        for file_path in pickled_file_paths:
+            batch = load_pickled_shard(file_path)
+            num_gen_steps += batch.num_graphs
+            columnar_file_path = os.path.join(
+                tmp_folder, os.path.basename(columnar_shard_file_path(file_path))
+            )
+            save_columnar_shard(batch, columnar_file_path)
+            columnar_file_paths.append(columnar_file_path)
+
+            # sanity check that the round trip is lossless
+            reloaded = load_columnar_shard(columnar_file_path, MolerData)
+            for key, value in batch:
+                assert torch.equal(value, reloaded[key]), key
+
+        for name, file_paths, load_fn in [
+            ("pkl.gz", pickled_file_paths, load_pickled_shard),
+            (
+                "columnar",
+                columnar_file_paths,
+                lambda file_path: load_columnar_shard(file_path, MolerData),
+            ),
+        ]:
+            num_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+            for touch in [False, True]:
+                elapsed = time_reads(file_paths, load_fn, args.num_passes, touch)
+                print(
+                    f"{name:>8} {'load+read' if touch else 'load':>9}: "
+                    f"{len(file_paths) / elapsed:8.1f} shards/s, "
+                    f"{num_gen_steps / elapsed:10.1f} gen steps/s, "
+                    f"{num_bytes / elapsed / 2**20:8.1f} MB/s on disk "
+                    f"({num_bytes / 2**20:.1f} MB)"
+                )
+    finally:
+        shutil.rmtree(tmp_folder)
@@ -0,0 +1,199 @@
+"""
+Uncompressed, memory-mappable on-disk format for the batched generation step shards.
+
+A shard is a single file made up of
+    - an 8 byte magic string and the length of the header as little endian uint64
+    - a json header describing every array: its name, dtype, shape and offset
+    - the raw array data, every array aligned to `ALIGNMENT` bytes
+
+The arrays are the tensors of the `Batch` (`store/<key>`, including the `*_batch` and `*_ptr`
+vectors), and its `_slice_dict` (`slice/<key>`) and `_inc_dict` (`inc/<key>`), so that the
+`Batch` can be reconstructed without calling `Batch.from_data_list`. Loading maps the file with
+`np.memmap` and wraps the arrays as tensors without copying them.
+"""
+from torch_geometric.data import Batch
+import argparse
+import gzip
+import json
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+COLUMNAR_SHARD_SUFFIX = ".colshard"
+PICKLED_SHARD_SUFFIX = ".pkl.gz"
+MAGIC = b"MOLSHRD1"
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_columnar_shard(batch, file_path):
+    arrays = {}
+    for key, value in batch._store.items():
+        arrays[f"store/{key}"] = value
+    for key, value in batch._slice_dict.items():
+        arrays[f"slice/{key}"] = value
+    for key, value in batch._inc_dict.items():
+        arrays[f"inc/{key}"] = value
+
+    header = {"num_graphs": batch.num_graphs, "arrays": []}
+    offset = 0
+    numpy_arrays = []
+    for name, value in arrays.items():
+        if not isinstance(value, torch.Tensor):
+            raise ValueError(
+                f"{name} is a {type(value)}, only tensors can be stored in a columnar shard."
+            )
+        array = np.ascontiguousarray(value.detach().cpu().numpy())
+        header["arrays"].append(
+            {
+                "name": name,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+        )
+        numpy_arrays.append((offset, array))
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    # write to a temporary file first so that an interrupted write never leaves a truncated shard
+    tmp_file_path = file_path + ".tmp"
+    with open(tmp_file_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for array_offset, array in numpy_arrays:
+            f.seek(data_start + array_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_file_path, file_path)
+
+
+def read_columnar_shard_header(file_path):
+    with open(file_path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a columnar shard.")
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    header["data_start"] = _align(len(MAGIC) + 8 + header_length)
+    return header
+
+
+def load_columnar_shard(file_path, base_cls):
+    """
+    Memory maps a columnar shard and reconstructs the `Batch` of `base_cls` objects. The tensors
+    share memory with the copy-on-write mapping of the file, so nothing is read from disk until the
+    tensors are used and modifying them never modifies the file.
+    """
+    header = read_columnar_shard_header(file_path)
+    buffer = np.memmap(file_path, dtype=np.uint8, mode="c")
+
+    batch = Batch(_base_cls=base_cls)
+    slice_dict, inc_dict = {}, {}
+    for array_info in header["arrays"]:
+        dtype = np.dtype(array_info["dtype"])
+        shape = tuple(array_info["shape"])
+        count = int(np.prod(shape))
+        if count == 0:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            array = np.ndarray(
+                shape,
+                dtype=dtype,
+                buffer=buffer,
+                offset=header["data_start"] + array_info["offset"],
+            )
+        tensor = torch.from_numpy(array)
+        kind, key = array_info["name"].split("/", 1)
+        if kind == "store":
+            batch[key] = tensor
+        elif kind == "slice":
+            slice_dict[key] = tensor
+        else:
+            inc_dict[key] = tensor
+    batch._slice_dict = slice_dict
+    batch._inc_dict = inc_dict
+    batch._num_graphs = header["num_graphs"]
+    return batch
+
+
+def load_pickled_shard(file_path):
+    with gzip.open(file_path, "rb") as f:
+        return pickle.load(f)
+
+
+def load_shard(file_path, base_cls):
+    """Loads a shard in either format, depending on its file suffix."""
+    if file_path.endswith(COLUMNAR_SHARD_SUFFIX):
+        return load_columnar_shard(file_path, base_cls)
+    return load_pickled_shard(file_path)
+
+
+def columnar_shard_file_path(pickled_shard_file_path):
+    return (
+        pickled_shard_file_path[: -len(PICKLED_SHARD_SUFFIX)] + COLUMNAR_SHARD_SUFFIX
+    )
+
+
+def convert_pickled_shards(processed_split_folder, remove_pickled_shards=False):
+    """
+    Converts the gzipped pickle shards of a processed split into columnar shards and points
+    processed_file_paths.csv and the preprocessing manifest at the new files.
+    """
+    processed_file_paths_csv = os.path.join(
+        processed_split_folder, "processed_file_paths.csv"
+    )
+    df = pd.read_csv(processed_file_paths_csv)
+    converted_file_paths = {}
+    for file_path in tqdm(df["file_names"]):
+        if not file_path.endswith(PICKLED_SHARD_SUFFIX):
+            continue
+        new_file_path = columnar_shard_file_path(file_path)
+        save_columnar_shard(load_pickled_shard(file_path), new_file_path)
+        converted_file_paths[file_path] = new_file_path
+
+    manifest_file_path = os.path.join(
+        processed_split_folder, "preprocessing_manifest.json"
+    )
+    if os.path.exists(manifest_file_path):
+        with open(manifest_file_path, "r") as f:
+            manifest = json.load(f)
+        for raw_trace_file in manifest["raw_trace_files"].values():
+            for shard in raw_trace_file["shards"]:
+                shard["file_path"] = converted_file_paths.get(
+                    shard["file_path"], shard["file_path"]
+                )
+        with open(manifest_file_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_file_path + ".tmp", manifest_file_path)
+
+    df["file_names"] = [
+        converted_file_paths.get(file_path, file_path) for file_path in df["file_names"]
+    ]
+    df.to_csv(processed_file_paths_csv, index=False)
+
+    if remove_pickled_shards:
+        for file_path in converted_file_paths:
+            os.remove(file_path)
+
+
+if __name__ == "__main__":
+    """
+    python columnar_shards.py \
+        --processed_split_folders data/guacamol/already_batched/train_0 data/guacamol/already_batched/valid_0
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processed_split_folders", required=True, nargs="+")
+    parser.add_argument("--remove_pickled_shards", action="store_true")
+    args = parser.parse_args()
+    for processed_split_folder in args.processed_split_folders:
+        convert_pickled_shards(processed_split_folder, args.remove_pickled_shards)
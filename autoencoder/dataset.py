@@ -3,14 +3,29 @@ import os
 import pandas as pd
 import numpy as np
 import torch
+import fnmatch
+import glob
 import gzip
+import hashlib
+import json
 import pickle
+import collections
 import concurrent.futures
+import copy
 import random
+import re
 import sys
 from tqdm import tqdm
 from enum import Enum, auto
-from numpy import load
+from columnar_shards import (
+    COLUMNAR_SHARD_SUFFIX,
+    PICKLED_SHARD_SUFFIX,
+    load_shard,
+    save_columnar_shard,
+)
+from gene_exp_conditioning import GeneExpConditioning
+from gene_expression_store import load_gene_expressions
+from lincs_index_lists import load_lincs_experiments
 
 
 class EdgeRepresentation(Enum):
@@ -34,11 +49,6 @@ to_increment_by_num_nodes_in_graph = [
 ]
 
 
-def chunk_list(elems, chunk_size):
-    for i in range(0, len(elems), chunk_size):
-        yield elems[i : i + chunk_size]
-
-
 class MolerData(Data):
     """To ensure that both the original graph and the partial graph edge indices are incremented."""
 
@@ -86,6 +96,326 @@ def get_motif_type_to_node_type_index_map(motif_vocabulary, num_atom_types):
     }
 
 
+def _concatenated_ranges(starts, sizes):
+    """Concatenation of torch.arange(start, start + size) for every start and size."""
+    offsets = torch.cumsum(sizes, dim=0) - sizes
+    return torch.repeat_interleave(starts - offsets, sizes) + torch.arange(
+        int(sizes.sum())
+    )
+
+
+def _exclusive_cumsum(x):
+    return torch.cat([x.new_zeros(1), torch.cumsum(x, dim=0)])
+
+
+def drop_gen_steps(num_graphs, drop_probability):
+    """
+    Indices of the generation steps kept when dropping each one with probability
+    `drop_probability`, keeping one random step if all of them were dropped.
+
+    The last shard of every raw trace file can hold as little as a single step, which would
+    otherwise often end up as an empty batch.
+    """
+    keep = np.random.rand(num_graphs) > drop_probability
+    if not keep.any():
+        keep[np.random.randint(num_graphs)] = True
+    return np.arange(num_graphs)[keep]
+
+
+def select_gen_steps(batch, selected_idx):
+    """
+    Selects the generation steps `selected_idx` (sorted, without duplicates) of a batch of steps.
+
+    This gives exactly the same batch as unbatching with `batch.to_data_list()` and rebatching the
+    selected steps with `Batch.from_data_list`, following the same keys as `batch`, but slices the
+    batched tensors directly using the slices and increments stored in the batch.
+    """
+    selected_idx = torch.as_tensor(selected_idx, dtype=torch.long)
+    num_selected = selected_idx.size(0)
+    data = copy.copy(batch)
+    slice_dict, inc_dict = {}, {}
+    for key, slices in batch._slice_dict.items():
+        value = batch[key]
+        cat_dim = batch.__cat_dim__(key, value)
+        dim = 0 if cat_dim is None else cat_dim % value.dim()
+        sizes = slices[1:] - slices[:-1]
+        selected_sizes = sizes[selected_idx]
+        selected_value = value.index_select(
+            dim, _concatenated_ranges(slices[:-1][selected_idx], selected_sizes)
+        )
+
+        incs = batch._inc_dict[key]
+        # the increment of every graph but the last one can be recovered from the cumulative ones
+        selected_incs = _exclusive_cumsum(
+            (incs[1:] - incs[:-1])[selected_idx[:-1]]
+        )
+        if int(incs[-1]) != 0:
+            broadcast_shape = [1] * selected_value.dim()
+            broadcast_shape[dim] = -1
+            # same order of operations as decrementing in `to_data_list` and incrementing again
+            # in `from_data_list`, so that even float valued indices match exactly
+            selected_value = (
+                selected_value
+                - torch.repeat_interleave(incs[selected_idx], selected_sizes).view(
+                    broadcast_shape
+                )
+            ) + torch.repeat_interleave(selected_incs, selected_sizes).view(
+                broadcast_shape
+            )
+
+        data[key] = selected_value
+        slice_dict[key] = _exclusive_cumsum(selected_sizes)
+        inc_dict[key] = selected_incs
+        if f"{key}_batch" in batch:
+            data[f"{key}_batch"] = torch.repeat_interleave(
+                torch.arange(num_selected), selected_sizes
+            )
+            data[f"{key}_ptr"] = _exclusive_cumsum(selected_sizes)
+
+    if "ptr" in batch:
+        num_nodes = (batch.ptr[1:] - batch.ptr[:-1])[selected_idx]
+        data.batch = torch.repeat_interleave(torch.arange(num_selected), num_nodes)
+        data.ptr = _exclusive_cumsum(num_nodes)
+
+    data._slice_dict = slice_dict
+    data._inc_dict = inc_dict
+    data._num_graphs = num_selected
+    return data
+
+
+def original_graph_to_unique_graph_map(batch):
+    """
+    Maps every generation step of a batch to the distinct original graphs in it. The steps of one
+    molecule are consecutive and share the same original graph, so a step is mapped to the same
+    original graph as the step before it if their node and edge counts, node features and
+    edges all match.
+    """
+    node_ptr = batch.original_graph_x_ptr
+    num_graphs = node_ptr.shape[0] - 1
+    num_nodes = node_ptr[1:] - node_ptr[:-1]
+    node_to_graph = batch.original_graph_x_batch
+    edge_index = batch.original_graph_edge_index.long()
+    edge_to_graph = node_to_graph[edge_index[0]]
+    num_edges = torch.bincount(edge_to_graph, minlength=num_graphs)
+
+    same_as_previous = torch.zeros(num_graphs, dtype=torch.bool, device=node_ptr.device)
+    same_as_previous[1:] = (num_nodes[1:] == num_nodes[:-1]) & (
+        num_edges[1:] == num_edges[:-1]
+    )
+
+    # compare every node and edge to the one in the same position of the previous graph
+    node_idx = torch.arange(node_to_graph.shape[0], device=node_ptr.device)
+    previous_node_idx = torch.where(
+        same_as_previous[node_to_graph], node_idx - num_nodes[node_to_graph], node_idx
+    )
+    node_differs = (
+        batch.original_graph_x != batch.original_graph_x[previous_node_idx]
+    ).any(-1) | (
+        batch.original_graph_node_categorical_features
+        != batch.original_graph_node_categorical_features[previous_node_idx]
+    )
+    edge_idx = torch.arange(edge_to_graph.shape[0], device=node_ptr.device)
+    previous_edge_idx = torch.where(
+        same_as_previous[edge_to_graph], edge_idx - num_edges[edge_to_graph], edge_idx
+    )
+    previous_edge_to_graph = edge_to_graph[previous_edge_idx]
+    edge_features = batch.original_graph_edge_features.view(edge_idx.shape[0], -1)
+    edge_differs = (
+        (edge_index - node_ptr[edge_to_graph])
+        != (edge_index[:, previous_edge_idx] - node_ptr[previous_edge_to_graph])
+    ).any(0) | (edge_features != edge_features[previous_edge_idx]).any(-1)
+
+    num_differences = torch.zeros(num_graphs, dtype=torch.long, device=node_ptr.device)
+    num_differences.index_add_(0, node_to_graph, node_differs.long())
+    num_differences.index_add_(0, edge_to_graph, edge_differs.long())
+    same_as_previous &= num_differences == 0
+    return torch.cumsum(~same_as_previous, dim=0) - 1
+
+
+def first_step_mask(batch, graph_to_unique_graph=None, extra_keys=()):
+    """
+    Marks the first generation step of every run of consecutive steps with the same original graph
+    and the same values of `extra_keys`, e.g. "l1000_idx", as a `LincsDataset` has the steps of a
+    compound once for every experiment with it.
+    """
+    if graph_to_unique_graph is None:
+        graph_to_unique_graph = original_graph_to_unique_graph_map(batch)
+    is_first_step = torch.ones_like(graph_to_unique_graph, dtype=torch.bool)
+    is_first_step[1:] = graph_to_unique_graph[1:] != graph_to_unique_graph[:-1]
+    for key in extra_keys:
+        if key in batch:
+            values = batch[key].view(-1)
+            is_first_step[1:] |= values[1:] != values[:-1]
+    return is_first_step
+
+
+def file_sha1(file_path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def resolve_splits(
+    split, raw_moler_trace_dataset_parent_folder, output_pyg_trace_dataset_parent_folder
+):
+    """
+    Turns a split name, a list of split names or a glob pattern matching the split folders of the
+    raw or the processed traces (e.g. "train_*") into a sorted list of split names.
+    """
+    if not isinstance(split, str):
+        return list(split)
+    if not glob.has_magic(split):
+        return [split]
+    split_folders = set()
+    for parent_folder in [
+        raw_moler_trace_dataset_parent_folder,
+        output_pyg_trace_dataset_parent_folder,
+    ]:
+        if os.path.isdir(parent_folder):
+            split_folders.update(
+                folder
+                for folder in os.listdir(parent_folder)
+                if os.path.isdir(os.path.join(parent_folder, folder))
+            )
+    splits = sorted(fnmatch.filter(split_folders, split))
+    assert len(splits) > 0, f"no split matches {split}."
+    return splits
+
+
+# metadata file path -> ((size, mtime_ns), metadata), shared by all datasets in the process
+_loaded_metadata = {}
+
+
+def load_metadata_file(raw_moler_trace_dataset_parent_folder, sidecar_folder=None):
+    """
+    Loads metadata.pkl.gz of a raw trace folder, at most once per process. An uncompressed copy is
+    kept in `sidecar_folder` (if given) and used as long as the size and mtime of the original match.
+    """
+    metadata_file_path = os.path.abspath(
+        os.path.join(raw_moler_trace_dataset_parent_folder, "metadata.pkl.gz")
+    )
+    stat = os.stat(metadata_file_path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    if metadata_file_path in _loaded_metadata:
+        loaded_version, metadata = _loaded_metadata[metadata_file_path]
+        if loaded_version == version:
+            return metadata
+
+    metadata = None
+    sidecar_file_path = (
+        os.path.join(sidecar_folder, "metadata_cache.pkl")
+        if sidecar_folder is not None
+        else None
+    )
+    if sidecar_file_path is not None and os.path.exists(sidecar_file_path):
+        with open(sidecar_file_path, "rb") as f:
+            # the first object identifies the metadata file, so that stale copies are ignored
+            # without unpickling the metadata itself
+            if pickle.load(f) == (metadata_file_path, version):
+                metadata = pickle.load(f)
+
+    if metadata is None:
+        with gzip.open(metadata_file_path, "rb") as f:
+            metadata = pickle.load(f)
+        if sidecar_file_path is not None:
+            try:
+                tmp_sidecar_file_path = f"{sidecar_file_path}.{os.getpid()}.tmp"
+                with open(tmp_sidecar_file_path, "wb") as f:
+                    pickle.dump(
+                        (metadata_file_path, version),
+                        f,
+                        protocol=pickle.HIGHEST_PROTOCOL,
+                    )
+                    pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_sidecar_file_path, sidecar_file_path)
+            except OSError:
+                pass  # the sidecar is only an optimisation
+
+    _loaded_metadata[metadata_file_path] = (version, metadata)
+    return metadata
+
+
+# dataset instance used by the preprocessing worker processes; it is sent once per worker
+# through the pool initializer rather than once per submitted raw trace file
+_worker_dataset = None
+
+
+def _init_preprocessing_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _convert_raw_trace_file(pkl_file_path, previous_sha1, split):
+    """
+    Runs in a worker process. Converts one raw trace file into output shards, unless its content
+    hash shows that it has not changed since it was last converted.
+    """
+    sha1 = file_sha1(pkl_file_path)
+    if sha1 == previous_sha1:
+        return {"sha1": sha1, "shards": None}
+    return {
+        "sha1": sha1,
+        "shards": _worker_dataset._convert_raw_trace_file_to_shards(
+            pkl_file_path, split
+        ),
+    }
+
+
+class ShardCache:
+    """
+    LRU cache of decoded shards keyed by file path, bounded by the total size of their tensors.
+    Every DataLoader worker holds its own copy of the dataset and therefore its own cache, which
+    only survives across epochs with `persistent_workers=True`.
+    """
+
+    def __init__(self, max_size_bytes):
+        self._max_size_bytes = max_size_bytes
+        self._shards = collections.OrderedDict()
+        self._size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def shard_size_bytes(batch):
+        return sum(
+            value.element_size() * value.numel()
+            for _, value in batch
+            if isinstance(value, torch.Tensor)
+        )
+
+    def get(self, file_path, load_fn):
+        if file_path in self._shards:
+            self.hits += 1
+            self._shards.move_to_end(file_path)
+            return self._shards[file_path][0]
+
+        self.misses += 1
+        batch = load_fn()
+        size_bytes = self.shard_size_bytes(batch)
+        if size_bytes <= self._max_size_bytes:
+            while self._size_bytes + size_bytes > self._max_size_bytes:
+                _, (_, evicted_size_bytes) = self._shards.popitem(last=False)
+                self._size_bytes -= evicted_size_bytes
+            self._shards[file_path] = (batch, size_bytes)
+            self._size_bytes += size_bytes
+        return batch
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "num_shards": len(self._shards),
+            "size_bytes": self._size_bytes,
+            "max_size_bytes": self._max_size_bytes,
+        }
+
+    def clear(self):
+        self._shards.clear()
+        self._size_bytes = 0
+
+
 class MolerDataset(Dataset):
     def __init__(
         self,
@@ -99,8 +429,14 @@ class MolerDataset(Dataset):
         gen_step_drop_probability=0.5,
         edge_repr=EdgeRepresentation.edge_attr,
         num_samples_debug_mode=None,  # only for debugging, will pick first n number of samples deterministically
+        num_workers=None,  # number of processes used by `process()`, defaults to os.cpu_count()
+        shard_format="pickle",  # format of newly processed shards, "pickle" or "columnar"
+        shard_cache_size_bytes=0,  # per worker LRU cache of decoded shards, disabled if 0
     ):
+        assert shard_format in ("pickle", "columnar"), f"unknown shard format {shard_format}"
         self._processed_file_paths = None
+        self._num_workers = num_workers
+        self._shard_format = shard_format
         self._transform = transform
         self._pre_transform = pre_transform
         self._edge_repr = edge_repr
@@ -111,59 +447,118 @@ class MolerDataset(Dataset):
             output_pyg_trace_dataset_parent_folder
         )
         self._split = split
+        # `split` can also be a list of splits or a glob pattern such as "train_*", in which case
+        # the shards of all the splits are indexed as one dataset
+        self._splits = resolve_splits(
+            split,
+            raw_moler_trace_dataset_parent_folder,
+            output_pyg_trace_dataset_parent_folder,
+        )
         self._using_self_loops = using_self_loops
 
-        # attribute for current molecule ie current data shard
-        self._current_in_memory_data_shard = None
-        self._current_in_memory_data_shard_counter = None
+        # decoded shards kept in memory, separately in each DataLoader worker
+        self._shard_cache = (
+            ShardCache(shard_cache_size_bytes) if shard_cache_size_bytes > 0 else None
+        )
 
         self._gen_step_drop_probability = gen_step_drop_probability
-        self.load_metadata()
+        # loaded lazily, see `load_metadata`
+        self._metadata = None
 
         ##### NOTE: only for debugging purposes ########
         self._num_samples_debug_mode = num_samples_debug_mode
         ##### NOTE: only for debugging purposes ########
 
-        # create the directory for the processed data if it doesn't exist
-        processed_file_paths_folder = os.path.join(
-            self._output_pyg_trace_dataset_parent_folder, self._split
-        )
-        if not os.path.exists(processed_file_paths_folder):
-            os.mkdir(processed_file_paths_folder)
-        # try to read in the csv with the processed file paths
-        processed_file_paths_csv = os.path.join(
-            processed_file_paths_folder, "processed_file_paths.csv"
-        )
-        if os.path.exists(processed_file_paths_csv):
-            self._processed_file_paths = pd.read_csv(processed_file_paths_csv)[
-                "file_names"
-            ].tolist()
+        self._processed_file_paths_per_split = {}
+        for split in self._splits:
+            # create the directory for the processed data if it doesn't exist
+            processed_file_paths_folder = self.processed_split_folder(split)
+            if not os.path.exists(processed_file_paths_folder):
+                os.mkdir(processed_file_paths_folder)
+            # try to read in the csv with the processed file paths
+            processed_file_paths_csv = os.path.join(
+                processed_file_paths_folder, "processed_file_paths.csv"
+            )
+            if os.path.exists(processed_file_paths_csv):
+                self._processed_file_paths_per_split[split] = pd.read_csv(
+                    processed_file_paths_csv
+                )["file_names"].tolist()
+        self._index_processed_file_paths()
 
+        # `process` refreshes `self._processed_file_paths` itself whenever it rewrites a csv
         super().__init__(root, transform, pre_transform)
-        self._processed_file_paths = pd.read_csv(processed_file_paths_csv)[
-            "file_names"
-        ].tolist()
+
+    def _index_processed_file_paths(self):
+        """One global index over the shards of all splits, in the order of `self.splits`."""
+        self._processed_file_paths = [
+            file_path
+            for split in self._splits
+            for file_path in self._processed_file_paths_per_split.get(split, [])
+        ]
+        self._split_boundaries = np.cumsum(
+            [0]
+            + [
+                len(self._processed_file_paths_per_split.get(split, []))
+                for split in self._splits
+            ]
+        )
+
+    def _process(self):
+        # `process` itself works out from the manifest which raw trace files still need to be
+        # converted, so it runs on every construction to pick up new files and interrupted runs.
+        # This also skips the per file existence checks of the torch_geometric `Dataset`.
+        self.process()
 
     @staticmethod
     def _generate_self_loops(num_nodes):
         """Generate a (num_nodes, 2) array of self loop edges."""
         return np.repeat(np.arange(num_nodes, dtype=np.int32), 2).reshape(-1, 2)
 
+    @property
+    def splits(self):
+        return self._splits
+
+    @property
+    def split_boundaries(self):
+        """The shards of `self.splits[i]` have the indices split_boundaries[i] to split_boundaries[i + 1] - 1."""
+        return self._split_boundaries
+
+    def split_of(self, idx):
+        return self._splits[
+            np.searchsorted(self._split_boundaries, idx, side="right") - 1
+        ]
+
+    def num_gen_steps_of(self, idx):
+        """Number of generation steps in a shard, which is part of its file name."""
+        return int(
+            re.search(r"_nsteps_(\d+)", os.path.basename(self.processed_file_names[idx]))[1]
+        )
+
+    def processed_split_folder(self, split):
+        return os.path.join(self._output_pyg_trace_dataset_parent_folder, split)
+
     @property
     def raw_file_names(self):
         """
         Raw generation trace files output from the preprocess function of the cli. These are zipped pickle
         files. This is the actual file name without the parent folder.
         """
+        return [
+            pkl_file_path
+            for split in self._splits
+            for pkl_file_path in self.raw_file_names_of_split(split)
+        ]
+
+    def raw_file_names_of_split(self, split):
         raw_pkl_file_folders = [
             folder
             for folder in os.listdir(self._raw_moler_trace_dataset_parent_folder)
-            if folder.startswith(self._split)
+            if folder.startswith(split)
         ]
 
         assert (
             len(raw_pkl_file_folders) > 0
-        ), f"{self._raw_moler_trace_dataset_parent_folder} does not contain {self._split} files."
+        ), f"{self._raw_moler_trace_dataset_parent_folder} does not contain {split} files."
 
         raw_generation_trace_files = []
         for folder in raw_pkl_file_folders:
@@ -185,16 +580,42 @@ class MolerDataset(Dataset):
         else:
             return []
 
+    @property
+    def shard_cache(self):
+        return self._shard_cache
+
     @property
     def processed_file_names_size(self):
         return len(self.processed_file_names)
 
     @property
     def metadata(self):
+        if self._metadata is None:
+            self.load_metadata()
         return self._metadata
 
+    @property
+    def atom_type_featuriser(self):
+        if self._metadata is None:
+            self.load_metadata()
+        return self._atom_type_featuriser
+
+    @property
+    def motif_vocabulary(self):
+        if self._metadata is None:
+            self.load_metadata()
+        return self._motif_vocabulary
+
+    @property
+    def motif_to_node_type_index(self):
+        if self._metadata is None:
+            self.load_metadata()
+        return self._motif_to_node_type_index
+
     @property
     def node_type_index_to_string(self):
+        if self._metadata is None:
+            self.load_metadata()
         return self._node_type_index_to_string
 
     @property
@@ -202,7 +623,7 @@ class MolerDataset(Dataset):
         return len(self.node_type_index_to_string)
 
     def node_type_to_index(self, node_type):
-        return self._atom_type_featuriser.type_name_to_index(node_type)
+        return self.atom_type_featuriser.type_name_to_index(node_type)
 
     def node_types_to_indices(self, node_types):
         """Convert list of string representations into list of integer indices."""
@@ -217,21 +638,19 @@ class MolerDataset(Dataset):
         return multihot
 
     def node_type_to_index(self, node_type):
-        motif_node_type_index = self._motif_to_node_type_index.get(node_type)
+        motif_node_type_index = self.motif_to_node_type_index.get(node_type)
 
         if motif_node_type_index is not None:
             return motif_node_type_index
         else:
-            return self._atom_type_featuriser.type_name_to_index(node_type)
+            return self.atom_type_featuriser.type_name_to_index(node_type)
 
     def load_metadata(self):
-        metadata_file_path = os.path.join(
-            self._raw_moler_trace_dataset_parent_folder, "metadata.pkl.gz"
+        self._metadata = load_metadata_file(
+            self._raw_moler_trace_dataset_parent_folder,
+            sidecar_folder=self._output_pyg_trace_dataset_parent_folder,
         )
 
-        with gzip.open(metadata_file_path, "rb") as f:
-            self._metadata = pickle.load(f)
-
         self._atom_type_featuriser = next(
             featuriser
             for featuriser in self._metadata["feature_extractors"]
@@ -241,7 +660,7 @@ class MolerDataset(Dataset):
         self._node_type_index_to_string = (
             self._atom_type_featuriser.index_to_atom_type_map.copy()
         )
-        self._motif_vocabulary = self.metadata.get("motif_vocabulary")
+        self._motif_vocabulary = self._metadata.get("motif_vocabulary")
 
         if self._motif_vocabulary is not None:
             self._motif_to_node_type_index = get_motif_type_to_node_type_index_map(
@@ -276,76 +695,210 @@ class MolerDataset(Dataset):
         )
         df.to_csv(processed_file_paths_csv, index=False)
 
+    def manifest_file_path(self, split):
+        return os.path.join(
+            self.processed_split_folder(split), "preprocessing_manifest.json"
+        )
+
+    def load_manifest(self, split):
+        """
+        The manifest maps every converted raw trace file (relative to the raw trace parent folder)
+        to its size, mtime, content hash and the output shards it was converted into.
+        """
+        if not os.path.exists(self.manifest_file_path(split)):
+            return None
+        with open(self.manifest_file_path(split), "r") as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest, split):
+        # write to a temporary file first so that an interruption never leaves a corrupt manifest
+        tmp_manifest_file_path = self.manifest_file_path(split) + ".tmp"
+        with open(tmp_manifest_file_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest_file_path, self.manifest_file_path(split))
+
+    def _has_raw_trace_files(self, split):
+        return any(
+            folder.startswith(split)
+            for folder in os.listdir(self._raw_moler_trace_dataset_parent_folder)
+        )
+
     def process(self):
-        """Convert raw generation traces into individual .pt files for each of the trace steps."""
-        # only call process if it was not called before
-        if self.processed_file_names_size > 0:
-            pass
-        else:
-            results = []
+        """
+        Convert raw generation traces into shards of batched trace steps. Only the raw trace files
+        that are new or have changed since the last call are converted, and the manifest is updated
+        after every converted file, so that an interrupted run resumes where it stopped.
+        """
+        for split in self._splits:
+            self._process_split(split)
+        self._index_processed_file_paths()
+
+    def _process_split(self, split):
+        manifest = self.load_manifest(split)
+        if (
+            manifest is None
+            and len(self._processed_file_paths_per_split.get(split, [])) > 0
+        ):
+            # processed before the manifest was introduced, use the shards as they are
+            return
+        if manifest is None:
+            manifest = {"raw_trace_files": {}}
+        elif not self._has_raw_trace_files(split):
+            # only the processed shards are available on this machine
+            self._update_processed_file_paths(split, manifest["raw_trace_files"])
+            return
+        raw_trace_files = manifest["raw_trace_files"]
+
+        raw_file_names = self.raw_file_names_of_split(split)
+        raw_file_stats = {}
+        for pkl_file_path in raw_file_names:
+            stat = os.stat(pkl_file_path)
+            raw_file_stats[
+                os.path.relpath(pkl_file_path, self._raw_moler_trace_dataset_parent_folder)
+            ] = (pkl_file_path, stat.st_size, stat.st_mtime_ns)
+
+        # raw trace files that were removed since the last call
+        removed_raw_file_names = set(raw_trace_files) - set(raw_file_stats)
+        for raw_file_name in removed_raw_file_names:
+            self._remove_shards(raw_trace_files.pop(raw_file_name)["shards"])
+
+        # a matching size and mtime is trusted, otherwise the content hash decides
+        raw_file_names_to_check = [
+            raw_file_name
+            for raw_file_name, (_, size, mtime_ns) in sorted(raw_file_stats.items())
+            if raw_file_name not in raw_trace_files
+            or raw_trace_files[raw_file_name]["size"] != size
+            or raw_trace_files[raw_file_name]["mtime_ns"] != mtime_ns
+        ]
+
+        if len(raw_file_names_to_check) > 0:
+            # loaded before the dataset is sent to the workers, so that they do not all load it
             self.load_metadata()
-            generation_steps = []
-            future_saved_file_paths = []
-            chunk_size = 1000
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                future_gen_steps_to_pkl_file_path = [
+            num_workers = (
+                self._num_workers if self._num_workers is not None else os.cpu_count()
+            )
+            # extracting the generation steps is pure python, so we need processes rather than
+            # threads to make use of more than one core
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_init_preprocessing_worker,
+                initargs=(self,),
+            ) as executor:
+                future_to_raw_file_name = {
                     executor.submit(
-                        self._convert_data_shard_to_list_of_trace_steps, pkl_file_path
-                    )
-                    for pkl_file_path in self.raw_file_names
-                ]
-                with tqdm(total=len(self.raw_file_names)) as pbar:
-                    for future_gen_steps in concurrent.futures.as_completed(
-                        future_gen_steps_to_pkl_file_path
+                        _convert_raw_trace_file,
+                        raw_file_stats[raw_file_name][0],
+                        raw_trace_files.get(raw_file_name, {}).get("sha1"),
+                        split,
+                    ): raw_file_name
+                    for raw_file_name in raw_file_names_to_check
+                }
+                with tqdm(total=len(future_to_raw_file_name)) as pbar:
+                    for future in concurrent.futures.as_completed(
+                        future_to_raw_file_name
                     ):
-                        current_generation_steps = future_gen_steps.result()
-
-                        # put all the generatoin steps into the queue
-                        generation_steps += current_generation_steps
+                        raw_file_name = future_to_raw_file_name[future]
+                        result = future.result()
+                        _, size, mtime_ns = raw_file_stats[raw_file_name]
+                        if result["shards"] is None:  # unchanged content
+                            raw_trace_files[raw_file_name]["size"] = size
+                            raw_trace_files[raw_file_name]["mtime_ns"] = mtime_ns
+                        else:
+                            if raw_file_name in raw_trace_files:
+                                new_file_paths = {
+                                    shard["file_path"] for shard in result["shards"]
+                                }
+                                self._remove_shards(
+                                    shard
+                                    for shard in raw_trace_files[raw_file_name]["shards"]
+                                    if shard["file_path"] not in new_file_paths
+                                )
+                            raw_trace_files[raw_file_name] = {
+                                "size": size,
+                                "mtime_ns": mtime_ns,
+                                "sha1": result["sha1"],
+                                "shards": result["shards"],
+                            }
+                        self._save_manifest(manifest, split)
                         pbar.update(1)
+        elif len(removed_raw_file_names) == 0 and os.path.exists(
+            self.manifest_file_path(split)
+        ):
+            self._update_processed_file_paths(split, raw_trace_files)
+            return
 
-                future_saved_file_paths += [
-                    executor.submit(self._save_processed_gen_step, chunk, i)
-                    for i, chunk in enumerate(
-                        chunk_list(generation_steps, chunk_size=chunk_size)
-                    )
-                ]
+        self._save_manifest(manifest, split)
+        self._update_processed_file_paths(split, raw_trace_files)
 
-                with tqdm(total=len(self.raw_file_names)) as pbar:
-                    for future in concurrent.futures.as_completed(
-                        future_saved_file_paths
-                    ):
-                        results += [future.result()]
-                        pbar.update(1)
+    def _update_processed_file_paths(self, split, raw_trace_files):
+        """
+        Rewrites the csv with the processed file paths of `split` unless it already lists the
+        shards of the manifest, e.g. when the csv was deleted or a run was interrupted between
+        saving the manifest and writing the csv.
+        """
+        results = [
+            shard
+            for raw_file_name in sorted(raw_trace_files)
+            for shard in raw_trace_files[raw_file_name]["shards"]
+        ]
+        file_paths = [result["file_path"] for result in results]
+        processed_file_paths_csv = os.path.join(
+            self.processed_split_folder(split), "processed_file_paths.csv"
+        )
+        # read from the csv in `__init__`, if it existed
+        if (
+            os.path.exists(processed_file_paths_csv)
+            and self._processed_file_paths_per_split.get(split) == file_paths
+        ):
+            return
+        self.generate_preprocessed_file_paths_csv(
+            preprocessed_file_paths_folder=self.processed_split_folder(split),
+            results=results,
+        )
+        self._processed_file_paths_per_split[split] = file_paths
 
-                # accumulated_generation_steps = []
-                # with tqdm(total = len(self.raw_file_names)) as pbar:
-                #     for future_gen_steps in concurrent.futures.as_completed(future_gen_steps_to_pkl_file_path):
-                #         pkl_file_path = future_gen_steps_to_pkl_file_path[future_gen_steps]
-                #         current_generation_steps = future_gen_steps.result()
-
-                #         accumulated_generation_steps += current_generation_steps
-                #         accumulated_num_steps += len(current_generation_steps)
-
-                #         if accumulated_num_steps > 200:
-                #             generation_steps.append((accumulated_generation_steps, pkl_file_path))
-                #             accumulated_generation_steps = []
-                #         pbar.update(1)
-
-                # future_saved_file_paths = [executor.submit(self._save_processed_gen_step, molecule_gen_steps, pkl_file_path) for molecule_gen_steps, pkl_file_path in generation_steps]
-                # with tqdm(total = len(generation_steps)) as pbar:
-                #     for future in concurrent.futures.as_completed(future_saved_file_paths):
-                #         results += [future.result()]
-                #         pbar.update(1)
-
-            self.generate_preprocessed_file_paths_csv(
-                preprocessed_file_paths_folder=os.path.join(
-                    self._output_pyg_trace_dataset_parent_folder, self._split
-                ),
-                results=results,
-            )
+    @staticmethod
+    def _remove_shards(shards):
+        for shard in shards:
+            if os.path.exists(shard["file_path"]):
+                os.remove(shard["file_path"])
 
-    def _save_processed_gen_step(self, molecule_gen_steps, id):
+    def _convert_raw_trace_file_to_shards(self, pkl_file_path, split, chunk_size=1000):
+        """
+        Saves the generation steps of one raw trace file as shards of up to `chunk_size` steps,
+        while it is being read, so that at most one chunk of steps is held in memory.
+        """
+        folder, file_name = os.path.split(
+            os.path.relpath(pkl_file_path, self._raw_moler_trace_dataset_parent_folder)
+        )
+        shard_id_prefix = f"{folder}_{file_name.split('.')[0]}"
+
+        results = []
+        generation_steps = []
+        with gzip.open(pkl_file_path, "rb") as f:
+            molecules = pickle.load(f)
+        for molecule in molecules:
+            generation_steps += self._extract_generation_step_features(molecule)
+            while len(generation_steps) >= chunk_size:
+                results += [
+                    self._save_processed_gen_step(
+                        self._to_moler_data(generation_steps[:chunk_size]),
+                        f"{shard_id_prefix}_{len(results)}",
+                        split,
+                    )
+                ]
+                generation_steps = generation_steps[chunk_size:]
+        if len(generation_steps) > 0:
+            results += [
+                self._save_processed_gen_step(
+                    self._to_moler_data(generation_steps),
+                    f"{shard_id_prefix}_{len(results)}",
+                    split,
+                )
+            ]
+        return results
+
+    def _save_processed_gen_step(self, molecule_gen_steps, id, split):
         """Saves a list of trace steps corresponding to different molecules."""
 
         # for step_idx, step in enumerate(molecule_gen_steps):
@@ -362,13 +915,13 @@ class MolerDataset(Dataset):
         # file_name = (
         #     f'{pkl_file_path.split("/")[-1].split(".")[0]}_nsteps_{len(molecule_gen_steps)}.pkl.gz'  #
         # )
-        file_name = f"{id}_nsteps_{len(molecule_gen_steps)}.pkl.gz"
-
-        file_path = os.path.join(
-            self._output_pyg_trace_dataset_parent_folder,
-            self._split,
-            file_name,
+        file_name = f"{id}_nsteps_{len(molecule_gen_steps)}" + (
+            COLUMNAR_SHARD_SUFFIX
+            if self._shard_format == "columnar"
+            else PICKLED_SHARD_SUFFIX
         )
+
+        file_path = os.path.join(self.processed_split_folder(split), file_name)
         # batch them together
         molecule_gen_steps = Batch.from_data_list(
             molecule_gen_steps,
@@ -387,26 +940,21 @@ class MolerDataset(Dataset):
                 "candidate_edge_targets",
             ],
         )
-        with gzip.open(file_path, "wb") as shard_file_path:
-            pickle.dump(molecule_gen_steps, shard_file_path)
+        if self._shard_format == "columnar":
+            save_columnar_shard(molecule_gen_steps, file_path)
+        else:
+            with gzip.open(file_path, "wb") as shard_file_path:
+                pickle.dump(molecule_gen_steps, shard_file_path)
 
         return {
             "file_path": file_path,
             "molecule_gen_steps_length": len(molecule_gen_steps),
         }
 
-    def _convert_data_shard_to_list_of_trace_steps(self, pkl_file_path):
-        # TODO: multiprocessing to speed this up
-        generation_steps = []
-
-        with gzip.open(pkl_file_path, "rb") as f:
-            molecules = pickle.load(f)
-            for molecule in molecules:
-                generation_steps += self._extract_generation_steps(molecule)
-
-        return generation_steps
-
     def _extract_generation_steps(self, molecule):
+        return self._to_moler_data(self._extract_generation_step_features(molecule))
+
+    def _extract_generation_step_features(self, molecule):
         molecule_gen_steps = []
         molecule_property_values = {
             k: [v] for k, v in molecule.graph_property_values.items()
@@ -553,8 +1101,10 @@ class MolerDataset(Dataset):
             gen_step_features = {**gen_step_features, **molecule_property_values}
             molecule_gen_steps += [gen_step_features]
 
-        molecule_gen_steps = self._to_tensor_moler(molecule_gen_steps)
+        return molecule_gen_steps
 
+    def _to_moler_data(self, molecule_gen_steps):
+        molecule_gen_steps = self._to_tensor_moler(molecule_gen_steps)
         return [MolerData(**step) for step in molecule_gen_steps]
 
     def _to_tensor_moler(self, molecule_gen_steps):
@@ -566,26 +1116,14 @@ class MolerDataset(Dataset):
     def len(self):
         return self.processed_file_names_size
 
-    def _size_of_current_data_shard(self):
-        return len(self._current_in_memory_data_shard)
-
-    def _reached_end_of_current_data_shard(self):
-        return self._current_in_memory_data_shard_counter == len(
-            self._current_in_memory_data_shard
-        )
-
-    def _read_in_data_shard(self, file_path):
-        with gzip.open(file_path, "rb") as f:
-            self._current_in_memory_data_shard = pickle.load(f)
-        self._current_in_memory_data_shard_counter = 0
-
-    def _read_in_and_extract_first_item_of_data_shard(self, file_path):
-        self._read_in_data_shard(file_path)
-        self._current_in_memory_data_shard_counter += 1  # reset counter
-        return self._current_in_memory_data_shard[0]
-
-    def _drop_current_gen_step(self):
-        return True if random.random() < self._gen_step_drop_probability else False
+    def __getitem__(self, idx):
+        # (shard index, step indices) tuples from `ShardAwareRandomSampler` select part of a shard.
+        # Like int indices, the shard index is a position in this (possibly sliced) dataset.
+        if isinstance(idx, tuple):
+            shard_idx, step_indices = idx
+            data = self.get((self.indices()[shard_idx], step_indices))
+            return data if self.transform is None else self.transform(data)
+        return super().__getitem__(idx)
 
     def get(self, idx):
         """
@@ -596,55 +1134,33 @@ class MolerDataset(Dataset):
         We use the idx to reference the molecule idx and read in each data shard and store it
         as an attribute in the class. Then, we maintain a counter for iterating through the
         shard. Once we read the end of the data shard, we use the idx to read in another molecule.
+
+        idx can also be a (shard index, step indices) tuple, to return only those generation steps.
         """
+        step_indices = None
+        if isinstance(idx, tuple):
+            idx, step_indices = idx
 
         file_path = self.processed_file_names[idx]
-        with gzip.open(file_path, "rb") as f:
-            data = pickle.load(f)
+        if self._shard_cache is not None:
+            # shallow copy, so that attributes set on the returned batch never end up in the cache
+            data = copy.copy(
+                self._shard_cache.get(file_path, lambda: load_shard(file_path, MolerData))
+            )
+        else:
+            data = load_shard(file_path, MolerData)
+        if step_indices is not None:
+            data = select_gen_steps(data, step_indices)
         if self._num_samples_debug_mode is not None:
             # NOTE: only for debugging; deterministically pick first n samples
             # and return them instead of random subsampling
-            unrolled = data.to_data_list()
-            return Batch.from_data_list(
-                unrolled[: self._num_samples_debug_mode],
-                follow_batch=[
-                    "correct_edge_choices",
-                    "correct_edge_types",
-                    "valid_edge_choices",
-                    "valid_attachment_point_choices",
-                    "correct_attachment_point_choice",
-                    "correct_node_type_choices",
-                    "original_graph_x",
-                    "correct_first_node_type_choices",
-                    # pick attachment points
-                    "candidate_attachment_points",
-                    # pick edge
-                    "candidate_edge_targets",
-                ],
+            return select_gen_steps(
+                data, np.arange(min(self._num_samples_debug_mode, data.num_graphs))
             )
-        if "train" in self._split and self._gen_step_drop_probability > 0:
-            unrolled = data.to_data_list()
-            selected_idx = np.arange(len(unrolled))[
-                np.random.rand(len(unrolled)) > self._gen_step_drop_probability
-            ]
-            data = Batch.from_data_list(
-                [unrolled[i] for i in selected_idx],
-                follow_batch=[
-                    "correct_edge_choices",
-                    "correct_edge_types",
-                    "valid_edge_choices",
-                    "valid_attachment_point_choices",
-                    "correct_attachment_point_choice",
-                    "correct_node_type_choices",
-                    "original_graph_x",
-                    "correct_first_node_type_choices",
-                    # pick attachment points
-                    "candidate_attachment_points",
-                    # pick edge
-                    "candidate_edge_targets",
-                ],
+        if "train" in self.split_of(idx) and self._gen_step_drop_probability > 0:
+            return select_gen_steps(
+                data, drop_gen_steps(data.num_graphs, self._gen_step_drop_probability)
             )
-            return data
         else:
             return data
 
@@ -675,13 +1191,6 @@ class MolerDataset(Dataset):
         # alternative for reading in individual .pt files (NOTE currently infeasible)
 
 
-def str_to_int(row):
-    """Specifically for the L1000 csv"""
-    row["ControlIndices"] = np.asarray(row["ControlIndices"].split(" "), dtype=np.int32)
-    row["TumourIndices"] = np.asarray(row["TumourIndices"].split(" "), dtype=np.int32)
-    return row
-
-
 class LincsDataset(MolerDataset):
     def __init__(
         self,
@@ -698,6 +1207,9 @@ class LincsDataset(MolerDataset):
         gen_step_drop_probability=0.5,
         edge_repr=EdgeRepresentation.edge_attr,
         num_samples_debug_mode=None,  # only for debugging, will pick first n number of samples deterministically
+        num_workers=None,
+        shard_format="pickle",
+        shard_cache_size_bytes=0,
     ):
         super().__init__(
             root=root,
@@ -710,176 +1222,63 @@ class LincsDataset(MolerDataset):
             gen_step_drop_probability=gen_step_drop_probability,
             edge_repr=edge_repr,
             num_samples_debug_mode=num_samples_debug_mode,  # only for debugging, will pick first n number of samples deterministically
+            num_workers=num_workers,
+            shard_format=shard_format,
+            shard_cache_size_bytes=shard_cache_size_bytes,
         )
-        print("Loading controls gene expression...")
-        self._gene_exp_controls = load(gene_exp_controls_file_path, allow_pickle=True)["genes"].astype('float32')
-        print("Loading tumour gene expression...")
-        self._gene_exp_tumour = load(gene_exp_tumour_file_path, allow_pickle=True)["genes"].astype('float32')
+        # the gene expressions are opened lazily in every process, see `gene_expression_store.py`
+        self._gene_exp_controls_file_path = gene_exp_controls_file_path
+        self._gene_exp_tumour_file_path = gene_exp_tumour_file_path
+        self._gene_exp_controls = None
+        self._gene_exp_tumour = None
+        self._gene_exp_conditioning = None
         print("Loading csv...")
-        self._lincs_df = pd.read_csv(
-            lincs_csv_file_path
-        )  # expects the whole dataframe with train, validation and test splits
-        self._lincs_df = self._lincs_df.apply(lambda x: str_to_int(x), axis=1)
-        self._experiment_idx_to_control_gene_exp_idx = self._lincs_df[
-            "ControlIndices"
-        ].values  # numpy array
-        self._experiment_idx_to_tumour_gene_exp_idx = self._lincs_df[
-            "TumourIndices"
-        ].values  # numpy array
-        self._experiment_idx_to_dose = np.log1p(self._lincs_df['Dose'].values)/ np.log(11.) # logarithmic scale, s.t. 10 micromoles -> 1 unit
-        del self._lincs_df
-
-    def _extract_generation_steps(self, molecule):
-        molecule_gen_steps = []
-        molecule_property_values = {
-            k: [v] for k, v in molecule.graph_property_values.items()
-        }
-        for gen_step in molecule:
-            gen_step_features = {}
+        # expects the whole dataframe with train, validation and test splits
+        lincs_experiments = load_lincs_experiments(lincs_csv_file_path)
+        self._experiment_idx_to_control_gene_exp_idx = lincs_experiments[
+            "control_indices"
+        ]  # CSRIndexLists
+        self._experiment_idx_to_tumour_gene_exp_idx = lincs_experiments[
+            "tumour_indices"
+        ]  # CSRIndexLists
+        self._experiment_idx_to_dose = np.log1p(lincs_experiments['dose'])/ np.log(11.) # logarithmic scale, s.t. 10 micromoles -> 1 unit
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # reopen the memory mapped gene expressions in the data loader workers instead of pickling them
+        state["_gene_exp_controls"] = None
+        state["_gene_exp_tumour"] = None
+        state["_gene_exp_conditioning"] = None
+        return state
 
-            gen_step_features["original_graph_x"] = molecule.node_features
-            # have an edge type attribute to tell apart each of the 3 bond types
-            edge_indexes = []
-            edge_types = []
-            for i, adj_list in enumerate(molecule.adjacency_lists):
-                if len(adj_list) != 0:
-                    edge_index = adj_list.T
-                    edge_indexes += [edge_index]
-                    """ 
-                    edge types: 
-                    single bond => 0
-                    double bond => 1
-                    triple bond => 2
-                    self loop => 3
-                    """
-                    edge_types += [i] * len(adj_list)
-
-            # add self loops
-            if (
-                self._using_self_loops
-            ):  # by default this is not used since pyg layers cover this
-                num_nodes_in_original_graph = molecule.node_features.shape[0]
-                edge_indexes += [
-                    self._generate_self_loops(num_nodes=num_nodes_in_original_graph).T
-                ]
-                edge_types += [3] * num_nodes_in_original_graph
+    @property
+    def gene_exp_conditioning(self):
+        """Cached (tumour - control, dose) conditioning vectors of the experiments, for evaluation."""
+        if self._gene_exp_conditioning is None:
+            self._gene_exp_conditioning = GeneExpConditioning(self)
+        return self._gene_exp_conditioning
 
-            gen_step_features["original_graph_edge_index"] = (
-                np.concatenate(edge_indexes, 1)
-                if len(edge_indexes) > 0
-                else np.array(edge_indexes)
+    @property
+    def gene_exp_controls(self):
+        if self._gene_exp_controls is None:
+            self._gene_exp_controls = load_gene_expressions(
+                self._gene_exp_controls_file_path
             )
+        return self._gene_exp_controls
 
-            if self._edge_repr == EdgeRepresentation.edge_type:
-                gen_step_features["original_graph_edge_features"] = np.array(edge_types)
-            elif self._edge_repr == EdgeRepresentation.edge_attr:
-                edge_attr = edge_types
-                # TODO: add other edge features produced from preprocessing
-                gen_step_features["original_graph_edge_features"] = np.array(edge_attr)
-            else:
-                raise NotImplementedError
-
-            gen_step_features[
-                "original_graph_node_categorical_features"
-            ] = molecule.node_categorical_features
-
-            gen_step_features["x"] = gen_step.partial_node_features
-            gen_step_features["focus_node"] = [gen_step.focus_node]
-
-            # have an edge type attribute to tell apart each of the 3 bond types
-            edge_indexes = []
-            edge_types = []
-            for i, adj_list in enumerate(gen_step.partial_adjacency_lists):
-                if len(adj_list) != 0:
-                    edge_index = adj_list.T
-                    edge_indexes += [edge_index]
-                    """ 
-                    edge types: 
-                    single bond => 0
-                    double bond => 1
-                    triple bond => 2
-                    self loop => 3
-                    """
-                    edge_types += [i] * len(adj_list)
-
-            # add self loops
-            if self._using_self_loops:
-                num_nodes_in_partial_graph = gen_step.partial_node_features.shape[0]
-                edge_indexes += [
-                    self._generate_self_loops(num_nodes=num_nodes_in_partial_graph).T
-                ]
-                edge_types += [3] * num_nodes_in_partial_graph
-
-            gen_step_features["edge_index"] = (
-                np.concatenate(edge_indexes, 1)
-                if len(edge_indexes) > 0
-                else np.array(edge_indexes)
+    @property
+    def gene_exp_tumour(self):
+        if self._gene_exp_tumour is None:
+            self._gene_exp_tumour = load_gene_expressions(
+                self._gene_exp_tumour_file_path
             )
+        return self._gene_exp_tumour
 
-            if self._edge_repr == EdgeRepresentation.edge_type:
-                gen_step_features["partial_graph_edge_features"] = np.array(edge_types)
-            elif self._edge_repr == EdgeRepresentation.edge_attr:
-                edge_attr = edge_types
-                # TODO: add other edge features produced from preprocessing
-                gen_step_features["partial_graph_edge_features"] = np.array(edge_attr)
-            else:
-                raise NotImplementedError
-
-            gen_step_features["edge_features"] = np.array(gen_step.edge_features)
-            gen_step_features["correct_edge_choices"] = gen_step.correct_edge_choices
-
-            num_correct_edge_choices = np.sum(gen_step.correct_edge_choices)
-            gen_step_features["num_correct_edge_choices"] = [num_correct_edge_choices]
-            gen_step_features["stop_node_label"] = [int(num_correct_edge_choices == 0)]
-            gen_step_features["valid_edge_choices"] = gen_step.valid_edge_choices
-            gen_step_features["valid_edge_types"] = gen_step.valid_edge_types
-
-            gen_step_features["correct_edge_types"] = gen_step.correct_edge_types
-            gen_step_features[
-                "partial_node_categorical_features"
-            ] = gen_step.partial_node_categorical_features
-            if gen_step.correct_attachment_point_choice is not None:
-                gen_step_features["correct_attachment_point_choice"] = [
-                    list(gen_step.valid_attachment_point_choices).index(
-                        gen_step.correct_attachment_point_choice
-                    )
-                ]
-            else:
-                gen_step_features["correct_attachment_point_choice"] = []
-            gen_step_features[
-                "valid_attachment_point_choices"
-            ] = gen_step.valid_attachment_point_choices
-
-            # And finally, the correct node type choices. Here, we have an empty list of
-            # correct choices for all steps where we didn't choose a node, so we skip that:
-            if gen_step.correct_node_type_choices is not None:
-                gen_step_features["correct_node_type_choices"] = np.array(
-                    [self.node_types_to_multi_hot(gen_step.correct_node_type_choices)]
-                )
-            else:
-                gen_step_features["correct_node_type_choices"] = np.zeros(
-                    shape=(0,) + (self.num_node_types,)
-                )
-            if molecule.correct_first_node_type_choices is not None:
-                gen_step_features["correct_first_node_type_choices"] = np.array(
-                    [
-                        self.node_types_to_multi_hot(
-                            molecule.correct_first_node_type_choices
-                        )
-                    ]
-                )
-            else:
-                gen_step_features["correct_first_node_type_choices"] = np.zeros(
-                    shape=(0,) + (self.num_node_types,)
-                )
-            # Add graph_property_values
-            gen_step_features = {**gen_step_features, **molecule_property_values}
+    def _extract_generation_step_features(self, molecule):
+        molecule_gen_steps = super()._extract_generation_step_features(molecule)
+        for gen_step_features, gen_step in zip(molecule_gen_steps, molecule):
             gen_step_features["l1000_idx"] = gen_step.idx
-            molecule_gen_steps += [gen_step_features]
-
-        molecule_gen_steps = self._to_tensor_moler(molecule_gen_steps)
-
-        return [MolerData(**step) for step in molecule_gen_steps]
+        return molecule_gen_steps
 
     def get(self, idx):
         """
@@ -891,53 +1290,7 @@ class LincsDataset(MolerDataset):
         shard. Once we read the end of the data shard, we use the idx to read in another molecule.
         """
 
-        file_path = self.processed_file_names[idx]
-        with gzip.open(file_path, "rb") as f:
-            data = pickle.load(f)
-        if self._num_samples_debug_mode is not None:
-            # NOTE: only for debugging; deterministically pick first n samples
-            # and return them instead of random subsampling
-            unrolled = data.to_data_list()
-            return Batch.from_data_list(
-                unrolled[: self._num_samples_debug_mode],
-                follow_batch=[
-                    "correct_edge_choices",
-                    "correct_edge_types",
-                    "valid_edge_choices",
-                    "valid_attachment_point_choices",
-                    "correct_attachment_point_choice",
-                    "correct_node_type_choices",
-                    "original_graph_x",
-                    "correct_first_node_type_choices",
-                    # pick attachment points
-                    "candidate_attachment_points",
-                    # pick edge
-                    "candidate_edge_targets",
-                ],
-            )
-
-        if  "train" in self._split and self._gen_step_drop_probability > 0:
-            unrolled = data.to_data_list()
-            selected_idx = np.arange(len(unrolled))[
-                np.random.rand(len(unrolled)) > self._gen_step_drop_probability
-            ]
-            data = Batch.from_data_list(
-                [unrolled[i] for i in selected_idx],
-                follow_batch=[
-                    "correct_edge_choices",
-                    "correct_edge_types",
-                    "valid_edge_choices",
-                    "valid_attachment_point_choices",
-                    "correct_attachment_point_choice",
-                    "correct_node_type_choices",
-                    "original_graph_x",
-                    "correct_first_node_type_choices",
-                    # pick attachment points
-                    "candidate_attachment_points",
-                    # pick edge
-                    "candidate_edge_targets",
-                ],
-            )
+        data = super().get(idx)
         # given the df row idx, we want to index into the df, then get the control
         # and tumour indices => then we randomly pick one from each and index into the
         # torch tensor.
@@ -951,19 +1304,26 @@ class LincsDataset(MolerDataset):
         # similar to in  https://github.com/insilicomedicine/BiAAE/blob/master/dataloader/lincs_dl.py
 
         # uses method 2
+        return self.sample_gene_expressions(data)
+
+    def sample_gene_expressions(self, data):
+        """
+        Sets the gene expressions (a random tumour - control difference) and the dose of the
+        experiment of every graph in `data`, which only needs its `l1000_idx`.
+        """
         experiment_idx = data.l1000_idx  # get row idx
-        control_idx = self._experiment_idx_to_control_gene_exp_idx[
+        num_control_idx = self._experiment_idx_to_control_gene_exp_idx.lengths[
             experiment_idx
-        ]  # get list of control idx
+        ]  # get number of control idx
         gene_exp_control_idx = [
-            random.randint(0, len(arr)) for arr in control_idx
+            random.randint(0, num_idx) for num_idx in num_control_idx
         ]  # choose one of the control expt idx for each sample in the batch
-        tumour_idx = self._experiment_idx_to_tumour_gene_exp_idx[experiment_idx]
-        gene_exp_tumour_idx = [random.randint(0, len(arr)) for arr in tumour_idx]
-        control_gene_exp = self._gene_exp_controls[
-            gene_exp_control_idx
-        ]  # torch tensors of size batch_size x gene exp dim
-        tumour_gene_exp = self._gene_exp_tumour[gene_exp_tumour_idx]
+        num_tumour_idx = self._experiment_idx_to_tumour_gene_exp_idx.lengths[experiment_idx]
+        gene_exp_tumour_idx = [random.randint(0, num_idx) for num_idx in num_tumour_idx]
+        control_gene_exp = self.gene_exp_controls[gene_exp_control_idx].astype(
+            np.float32
+        )  # batch_size x gene exp dim, float16 stores are subtracted in float32
+        tumour_gene_exp = self.gene_exp_tumour[gene_exp_tumour_idx].astype(np.float32)
         diff_gene_exp = tumour_gene_exp - control_gene_exp
         data.gene_expressions = torch.from_numpy(diff_gene_exp).float()
         data.dose = torch.from_numpy(self._experiment_idx_to_dose[experiment_idx]).float()
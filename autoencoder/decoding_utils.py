@@ -4,6 +4,7 @@ from rdkit import Chem
 import sys
 sys.path.append("../moler_reference")
 
+from molecule_generation.chem.atom_feature_utils import AtomTypeFeatureExtractor
 from molecule_generation.chem.molecule_dataset_utils import BOND_DICT
 from molecule_generation.chem.motif_utils import (
     find_motifs_from_vocabulary,
@@ -17,6 +18,7 @@ from torch_geometric.data import Batch
 from dataset import MolerData
 import torch
 from dataset import EdgeRepresentation
+from utils import SMALL_NUMBER, unsorted_segment_topk
 
 def construct_decoder_states(
     motif_vocabulary, 
@@ -194,8 +196,68 @@ def sample_indices_from_logprobs(
 
 
 
-def _to_tensor_moler(decoder_state_features, ignore = []):
-    device = decoder_state_features['latent_representation'].device
+def batched_sample_indices_from_logprobs(num_samples, sampling_mode, logprobs):
+    """Picks indices for every row of the log-likelihoods at once, on their device.
+
+    Args:
+        num_samples: intended number of samples per row
+        sampling_mode: 'greedy' (the most likely indices) or 'sampling' (sampled without
+            replacement, by perturbing the logprobs with Gumbel noise)
+        logprobs: log-probabilities of selecting appropriate entries, shape (G, C)
+
+    Returns:
+        indices of picked values and their logprobs, shape (G, k) each, where
+        k = min(num_samples, C), ordered from the most to the least likely pick
+    """
+    num_samples = min(num_samples, logprobs.shape[1])
+    if sampling_mode == 'greedy':
+        picked_logprobs, picked_indices = torch.topk(logprobs, num_samples, dim=1)
+    elif sampling_mode == 'sampling':
+        _, picked_indices = torch.topk(_add_gumbel_noise(logprobs), num_samples, dim=1)
+        picked_logprobs = torch.gather(logprobs, 1, picked_indices)
+    else:
+        raise ValueError(f"Sampling method {sampling_mode} not known.")
+    return picked_indices, picked_logprobs
+
+
+def batched_sample_segment_indices_from_logprobs(
+    num_samples, sampling_mode, logprobs, segment_ids, num_segments
+):
+    """Same as batched_sample_indices_from_logprobs, for a flat array of log-likelihoods that
+    contains the choices of num_segments decisions.
+
+    Args:
+        num_samples: intended number of samples per segment
+        sampling_mode: 'greedy' or 'sampling', see batched_sample_indices_from_logprobs
+        logprobs: log-probabilities of selecting appropriate entries, shape (C,)
+        segment_ids: the segment of every entry, shape (C,)
+        num_segments: number of segments S
+
+    Returns:
+        indices of picked values into logprobs and their logprobs, shape (S, num_samples) each,
+        ordered from the most to the least likely pick. Segments with fewer than num_samples
+        entries are padded with index -1.
+    """
+    if sampling_mode == 'greedy':
+        scores = logprobs
+    elif sampling_mode == 'sampling':
+        scores = _add_gumbel_noise(logprobs)
+    else:
+        raise ValueError(f"Sampling method {sampling_mode} not known.")
+    picked_indices = unsorted_segment_topk(
+        scores, segment_ids, num_samples, num_segments=num_segments
+    )
+    return picked_indices, logprobs[picked_indices.clamp(min=0)]
+
+
+def _add_gumbel_noise(logprobs):
+    # the top k of the perturbed logprobs are a sample of k entries without replacement
+    return logprobs - torch.log(-torch.log(torch.rand_like(logprobs).clamp(min=SMALL_NUMBER)))
+
+
+def _to_tensor_moler(decoder_state_features, ignore = [], device = None):
+    if device is None:
+        device = decoder_state_features['latent_representation'].device
     for k, v in decoder_state_features.items():
         if k in ignore:
             continue
@@ -208,6 +270,315 @@ def _to_tensor_moler(decoder_state_features, ignore = []):
         
 
     
+class DeviceSyncCounter:
+    """
+    Counts the device to host transfers in every round of `AbstractModel.decode`. On a GPU, each
+    one makes the host wait for the device, so the pickers copy everything they need from a batch
+    to the host with a single `to_host` call. Implicit synchronizations (e.g. `.item()` on a device
+    tensor) are not counted, `torch.cuda.set_sync_debug_mode("warn")` reports those.
+    """
+
+    def __init__(self):
+        self.syncs_per_round = []
+
+    def new_round(self):
+        self.syncs_per_round.append(0)
+
+    @property
+    def num_syncs(self):
+        return sum(self.syncs_per_round)
+
+    def to_host(self, *tensors):
+        """Copies the tensors to the host, waiting for the device only once."""
+        if len(self.syncs_per_round) == 0:
+            self.new_round()
+        self.syncs_per_round[-1] += 1
+        cuda_devices = {tensor.device for tensor in tensors if tensor.device.type == "cuda"}
+        if len(cuda_devices) == 0:
+            return tuple(tensor.cpu() for tensor in tensors)
+        host_tensors = tuple(tensor.to("cpu", non_blocking=True) for tensor in tensors)
+        for device in cuda_devices:
+            torch.cuda.current_stream(device).synchronize()
+        return host_tensors
+
+
+class _GrowingArray:
+    """Rows in a preallocated array, whose capacity is doubled when it is full."""
+
+    def __init__(self, row_shape, dtype, capacity=32):
+        self._array = np.empty((capacity,) + tuple(row_shape), dtype=dtype)
+        self._num_rows = 0
+
+    def resize(self, num_rows):
+        if num_rows > len(self._array):
+            array = np.empty(
+                (max(num_rows, 2 * len(self._array)),) + self._array.shape[1:],
+                dtype=self._array.dtype,
+            )
+            array[: self._num_rows] = self._array[: self._num_rows]
+            self._array = array
+        self._num_rows = num_rows
+
+    def extend(self, rows):
+        start = self._num_rows
+        self.resize(start + len(rows))
+        self._array[start : self._num_rows] = rows
+
+    @property
+    def values(self):
+        return self._array[: self._num_rows]
+
+
+class _AtomComponents:
+    """Connected components of the atoms of a partial molecule, as a union-find."""
+
+    def __init__(self, num_atoms=0):
+        self._parent = list(range(num_atoms))
+
+    def add_atoms(self, num_atoms):
+        self._parent.extend(range(len(self._parent), num_atoms))
+
+    def find(self, atom):
+        while self._parent[atom] != atom:
+            self._parent[atom] = self._parent[self._parent[atom]]
+            atom = self._parent[atom]
+        return atom
+
+    def union(self, u, v):
+        """Joins the components of u and v. Returns False if they already were one component."""
+        u, v = self.find(u), self.find(v)
+        if u == v:
+            return False
+        self._parent[u] = v
+        return True
+
+
+def _is_prefix(prefix, values):
+    return prefix is values or (
+        len(prefix) <= len(values) and values[: len(prefix)] == prefix
+    )
+
+
+class _PartialGraphFeatures:
+    """
+    Node features and edges of the partial molecule of one decoder state. The atom types,
+    adjacency lists and motifs of the state are kept to recognise the later states of the same
+    molecule, whose lists extend them (decoder states copy their lists on modification).
+    """
+
+    def __init__(self, decoder_state, node_features, node_categorical_features):
+        self.node_features = _GrowingArray(node_features.shape[1:], node_features.dtype)
+        self.node_features.extend(node_features)
+        self.node_categorical_features = (
+            None if node_categorical_features is None else list(node_categorical_features)
+        )
+        self.edges = []
+        self.components = _AtomComponents(len(decoder_state._atom_types))
+        for adj_list in decoder_state.adjacency_lists:
+            edges = _GrowingArray((2,), np.int32)
+            if len(adj_list) > 0:
+                edges.extend(np.array(adj_list, dtype=np.int32))
+            self.edges.append(edges)
+            for u, v in adj_list:
+                self.components.union(u, v)
+        self._set_state(decoder_state)
+
+    def _set_state(self, decoder_state):
+        self.atom_types = decoder_state._atom_types
+        self.adjacency_lists = decoder_state.adjacency_lists
+        self.motifs = decoder_state._motifs
+
+    def extends_to(self, decoder_state):
+        return (
+            _is_prefix(self.atom_types, decoder_state._atom_types)
+            and _is_prefix(self.motifs, decoder_state._motifs)
+            and all(
+                _is_prefix(adj_list, new_adj_list)
+                for adj_list, new_adj_list in zip(
+                    self.adjacency_lists, decoder_state.adjacency_lists
+                )
+            )
+        )
+
+    def new_bonds(self, decoder_state):
+        return [
+            new_adj_list[len(adj_list) :]
+            for adj_list, new_adj_list in zip(self.adjacency_lists, decoder_state.adjacency_lists)
+        ]
+
+    def update(self, decoder_state, new_bonds, atom_ids, atom_features, atom_categorical_features):
+        """Appends the new bonds and atoms and (re)sets the features of the atoms `atom_ids`."""
+        num_atoms = len(decoder_state._atom_types)
+        self.node_features.resize(num_atoms)
+        self.node_features.values[atom_ids] = atom_features
+        if self.node_categorical_features is not None:
+            self.node_categorical_features += [None] * (
+                num_atoms - len(self.node_categorical_features)
+            )
+            for atom_id, categorical_feature in zip(atom_ids, atom_categorical_features):
+                self.node_categorical_features[atom_id] = categorical_feature
+        for edges, bonds in zip(self.edges, new_bonds):
+            if len(bonds) > 0:
+                edges.extend(np.array(bonds, dtype=np.int32))
+        self._set_state(decoder_state)
+
+    def edge_index_and_types(self):
+        edge_indexes = [edges.values for edges in self.edges if len(edges.values) > 0]
+        if len(edge_indexes) == 0:
+            # as the np.array of an empty list of edge types in the full rebuild
+            return np.array([[], []], dtype=np.int32), np.array([])
+        edge_types = np.repeat(
+            np.arange(len(self.edges)), [len(edges.values) for edges in self.edges]
+        )
+        return np.concatenate(edge_indexes, 0).T, edge_types
+
+
+class DecoderStateFeaturizer:
+    """
+    Node features and edges of the partial molecules of decoder states, updated incrementally
+    from the features of the previous decoder state of the same molecule.
+
+    Adding atoms and bonds only changes the features of the new atoms and of the existing atoms
+    that get new bonds (degree, valence, number of hydrogens), unless a bond closes a ring through
+    existing atoms, which can change the ring features of any atom. Those are recomputed,
+    everything else is kept in preallocated buffers, so a decoding step costs time in the number
+    of changed atoms rather than in the size of the molecule. A ring closure through existing
+    atoms (a bond between two atoms that were already connected), or a state that does not extend
+    the last one seen for its molecule (e.g. another beam), gets all of its features recomputed.
+    `num_rebuilds` counts those.
+
+    The arrays returned by `featurize` are only valid until the next state of the same molecule is
+    featurized.
+    """
+
+    def __init__(self, atom_featurisers, motif_vocabulary=None):
+        self._atom_featurisers = atom_featurisers
+        self._motif_vocabulary = motif_vocabulary
+        if motif_vocabulary is not None:
+            self._atom_type_featuriser = next(
+                featuriser
+                for featuriser in atom_featurisers
+                if isinstance(featuriser, AtomTypeFeatureExtractor)
+            )
+        self._features_per_molecule = {}
+        self.num_rebuilds = 0
+
+    def _featurize_atoms(self, decoder_state, atom_ids, num_features):
+        """The rows of `featurise_atoms` for the atoms `atom_ids` of the partial molecule."""
+        atom_features = np.empty((len(atom_ids), num_features), dtype=np.float32)
+        if len(atom_ids) == 0:
+            return atom_features, []
+        molecule = decoder_state.molecule
+        molecule.UpdatePropertyCache(strict=False)
+        for i, atom_id in enumerate(atom_ids):
+            atom = molecule.GetAtomWithIdx(int(atom_id))
+            atom_features[i] = np.concatenate(
+                [featuriser.featurise(atom) for featuriser in self._atom_featurisers]
+            )
+
+        if self._motif_vocabulary is None:
+            return atom_features, None
+        num_motifs = len(self._motif_vocabulary.vocabulary)
+        enclosing_motif_id = {
+            atom.atom_id: self._motif_vocabulary.vocabulary[motif.motif_type]
+            for motif in decoder_state._motifs
+            for atom in motif.atoms
+        }
+        atom_categorical_features = [
+            enclosing_motif_id.get(
+                atom_id,
+                self._atom_type_featuriser.type_name_to_index(decoder_state._atom_types[atom_id])
+                + num_motifs,
+            )
+            for atom_id in atom_ids
+        ]
+        return atom_features, atom_categorical_features
+
+    def featurize(self, decoder_state):
+        """
+        Returns the node features, node categorical features (None without motifs), edge index
+        and edge types of the partial molecule of `decoder_state`, as `get_node_features` and the
+        adjacency lists of the state.
+        """
+        features = self._features_per_molecule.get(decoder_state.molecule_id)
+        if features is None or not features.extends_to(decoder_state):
+            features = self._rebuild(decoder_state)
+        else:
+            new_bonds = features.new_bonds(decoder_state)
+            num_old_atoms = len(features.atom_types)
+            num_atoms = len(decoder_state._atom_types)
+            changed_atoms = set(range(num_old_atoms, num_atoms))
+            # the adjacency lists are symmetric, take every bond once
+            bonds = [(u, v) for bonds in new_bonds for u, v in bonds if u < v]
+            for u, v in bonds:
+                changed_atoms.update((u, v))
+            # Bonds between new atoms only close rings of new atoms, which are featurized anyway.
+            # After them, every other bond has to join two components, so that no ring goes
+            # through the existing atoms.
+            features.components.add_atoms(num_atoms)
+            for u, v in bonds:
+                if u >= num_old_atoms:
+                    features.components.union(u, v)
+            closes_ring = not all(
+                features.components.union(u, v) for u, v in bonds if u < num_old_atoms
+            )
+            if closes_ring:
+                features = self._rebuild(decoder_state)
+            else:
+                atom_ids = sorted(changed_atoms)
+                atom_features, atom_categorical_features = self._featurize_atoms(
+                    decoder_state, atom_ids, features.node_features.values.shape[1]
+                )
+                features.update(
+                    decoder_state, new_bonds, atom_ids, atom_features, atom_categorical_features
+                )
+
+        edge_index, edge_types = features.edge_index_and_types()
+        return (
+            features.node_features.values,
+            features.node_categorical_features,
+            edge_index,
+            edge_types,
+        )
+
+    def _rebuild(self, decoder_state):
+        self.num_rebuilds += 1
+        node_features, node_categorical_features = decoder_state.get_node_features(
+            self._atom_featurisers, self._motif_vocabulary
+        )
+        features = _PartialGraphFeatures(
+            decoder_state, node_features, node_categorical_features
+        )
+        self._features_per_molecule[decoder_state.molecule_id] = features
+        return features
+
+
+DECODER_BATCH_FOLLOW_BATCH = [
+    'correct_edge_choices',
+    'correct_edge_types',
+    'valid_edge_choices',
+    'valid_attachment_point_choices',
+    'correct_attachment_point_choice',
+    'correct_node_type_choices',
+    'original_graph_x',
+    'correct_first_node_type_choices',
+    # pick attachment points
+    'candidate_attachment_points',
+    # pick edge
+    'candidate_edge_targets',
+    'prior_focus_atoms',
+    'focus_atoms',
+]
+
+
+def _collate_decoder_states(current_batch, device):
+    # collated on the host and moved to the device at once, instead of one copy per state and key
+    return (
+        Batch.from_data_list([i[0] for i in current_batch], follow_batch = DECODER_BATCH_FOLLOW_BATCH).to(device),
+        [i[1] for i in current_batch],
+    )
+
+
 def batch_decoder_states(
     batch_size,
     atom_featurisers, #=dataset._metadata['feature_extractors'] ,
@@ -215,85 +586,66 @@ def batch_decoder_states(
     decoder_states,#=decoder_states,
 #     init_batch_callback=init_atom_choice_batch,
     add_state_to_batch_callback,
-    type_of_edge_feature = EdgeRepresentation.edge_attr
+    type_of_edge_feature = EdgeRepresentation.edge_attr,
+    max_num_nodes = None,
+    featurizer = None,
 ):
+    """
+    Yields batches of at most `batch_size` decoder states (any number if None) and, if
+    `max_num_nodes` is given, of at most that many partial graph nodes in total, so that the
+    number of states per batch adapts to the size of the molecules. A single state with more
+    nodes still gets a batch of its own.
+
+    Pass the same `DecoderStateFeaturizer` in every decoding step to featurize the partial
+    molecules incrementally.
+    """
+    assert batch_size is not None or max_num_nodes is not None, 'the decoder batches need a limit'
+    if featurizer is None:
+        featurizer = DecoderStateFeaturizer(atom_featurisers, motif_vocabulary)
     current_batch = []
+    current_num_nodes = 0
     for decoder_state in decoder_states:
-        node_features, node_categorical_features = decoder_state.get_node_features(
-            atom_featurisers, motif_vocabulary
-        )
-        # mol_num_nodes = node_features.shape[0]
+        (
+            node_features,
+            node_categorical_features,
+            edge_index,
+            edge_types,
+        ) = featurizer.featurize(decoder_state)
         
         decoder_state_features = {
             'latent_representation':decoder_state.molecule_representation, 
             'x': node_features,
             'node_categorical_features': node_categorical_features,
+            'edge_index': edge_index,
         }
-        
-        edge_indexes = []
-        edge_types = []
-        for edge_type_idx, adj_list in enumerate(decoder_state.adjacency_lists):
-            if len(adj_list) > 0:
-                edge_index = np.array(adj_list, dtype=np.int32).T
-                edge_indexes += [edge_index]
-                """ 
-                edge types: 
-                single bond => 0
-                double bond => 1
-                triple bond => 2
-                """
-                edge_types += [edge_type_idx] * len(adj_list)
-            
-        
-        decoder_state_features["edge_index"] = (
-            np.concatenate(edge_indexes, 1)
-            if len(edge_indexes) > 0
-            else np.array([[], []], dtype=np.int32)
-        )
+        """ 
+        edge types: 
+        single bond => 0
+        double bond => 1
+        triple bond => 2
+        """
         if type_of_edge_feature == EdgeRepresentation.edge_type:
-            decoder_state_features["partial_graph_edge_features"] = np.array(edge_types)
+            decoder_state_features["partial_graph_edge_features"] = edge_types
         elif type_of_edge_feature == EdgeRepresentation.edge_attr:
             edge_attr = edge_types
-            decoder_state_features["partial_graph_edge_features"] = np.array(edge_attr)
+            decoder_state_features["partial_graph_edge_features"] = edge_attr
         
         decoder_state_features = add_state_to_batch_callback(decoder_state_features, decoder_state)
         
-        decoder_state_features = _to_tensor_moler(decoder_state_features, ignore = ['latent_representation'])
+        device = decoder_state.molecule_representation.device
+        decoder_state_features = _to_tensor_moler(
+            decoder_state_features, ignore = ['latent_representation'], device = 'cpu'
+        )
 
-        current_batch += [(MolerData(**decoder_state_features), decoder_state)]
-        if len(current_batch) == batch_size:
-            tmp = current_batch
+        num_nodes = decoder_state_features['x'].shape[0]
+        if len(current_batch) > 0 and (
+            (batch_size is not None and len(current_batch) == batch_size)
+            or (max_num_nodes is not None and current_num_nodes + num_nodes > max_num_nodes)
+        ):
+            yield _collate_decoder_states(current_batch, device)
             current_batch = []
-            yield (Batch.from_data_list([i[0] for i in tmp], follow_batch = [
-                'correct_edge_choices',
-                'correct_edge_types',
-                'valid_edge_choices',
-                'valid_attachment_point_choices',
-                'correct_attachment_point_choice',
-                'correct_node_type_choices',
-                'original_graph_x',
-                'correct_first_node_type_choices',
-                # pick attachment points
-                'candidate_attachment_points',
-                # pick edge
-                'candidate_edge_targets',
-                'prior_focus_atoms',
-                'focus_atoms',
-            ]), [i[1] for i in tmp])
+            current_num_nodes = 0
+        current_batch += [(MolerData(**decoder_state_features), decoder_state)]
+        current_num_nodes += num_nodes
     if len(current_batch) > 0:
-        yield (Batch.from_data_list([i[0] for i in current_batch], follow_batch = [
-            'correct_edge_choices',
-            'correct_edge_types',
-            'valid_edge_choices',
-            'valid_attachment_point_choices',
-            'correct_attachment_point_choice',
-            'correct_node_type_choices',
-            'original_graph_x',
-            'correct_first_node_type_choices',
-            # pick attachment points
-            'candidate_attachment_points',
-            # pick edge
-            'candidate_edge_targets',
-            'prior_focus_atoms',
-            'focus_atoms',
-        ]), [i[1] for i in current_batch])
\ No newline at end of file
+        yield _collate_decoder_states(current_batch, device)
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+Dynamic batching of generation steps. Instead of one fixed size shard per training step, the
+generation steps of every shard are packed into batches that stay within a budget of nodes, edges
+and candidate edges, so that the memory use of a training step no longer depends on how large the
+molecules in a shard happen to be.
+
+    train_dataloader = torch.utils.data.DataLoader(
+        DynamicGenStepBatches(
+            train_dataset,
+            ShardAwareRandomSampler(train_dataset, shards_per_group=16),
+            max_num_nodes=20000,
+            max_num_candidate_edges=40000,
+        ),
+        batch_size=None,  # the dataset yields ready made batches
+        num_workers=4,
+    )
+"""
+from dataset import select_gen_steps
+from torch.utils.data import IterableDataset, get_worker_info
+import numpy as np
+
+
+def gen_step_sizes(batch):
+    """Number of nodes, edges and candidate edges of every generation step of a batched shard."""
+
+    def counts(key):
+        slices = batch._slice_dict[key]
+        return (slices[1:] - slices[:-1]).numpy()
+
+    return {
+        "num_nodes": counts("x") + counts("original_graph_x"),
+        "num_edges": counts("edge_index") + counts("original_graph_edge_index"),
+        "num_candidate_edges": counts("valid_edge_choices"),
+    }
+
+
+def pack_gen_steps(sizes, budget):
+    """
+    Greedily packs consecutive generation steps into batches whose summed sizes stay within the
+    budget, e.g. {"num_nodes": 20000}. A single step larger than the budget gets a batch of its own.
+    Returns the generation step indices of every batch.
+    """
+    num_gen_steps = len(next(iter(sizes.values())))
+    batches = []
+    start = 0
+    totals = dict.fromkeys(budget, 0)
+    for i in range(num_gen_steps):
+        if i > start and any(
+            totals[key] + sizes[key][i] > max_size for key, max_size in budget.items()
+        ):
+            batches.append(np.arange(start, i))
+            start = i
+            totals = dict.fromkeys(budget, 0)
+        for key in budget:
+            totals[key] += sizes[key][i]
+    if num_gen_steps > start:
+        batches.append(np.arange(start, num_gen_steps))
+    return batches
+
+
+class DynamicGenStepBatches(IterableDataset):
+    """
+    Loads the shards of `dataset` in the order given by `sampler` (generation step dropout is still
+    applied by `dataset`) and yields batches of their generation steps packed up to the budget.
+    Steps are never packed across shards, so the last batch of a shard can be smaller.
+
+    With several data loader workers, all workers draw the same shard order for an epoch and every
+    worker loads (and prefetches) every num_workers-th shard of it.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        sampler,
+        max_num_nodes=None,
+        max_num_edges=None,
+        max_num_candidate_edges=None,
+    ):
+        self._dataset = dataset
+        self._sampler = sampler
+        self._budget = {
+            key: max_size
+            for key, max_size in [
+                ("num_nodes", max_num_nodes),
+                ("num_edges", max_num_edges),
+                ("num_candidate_edges", max_num_candidate_edges),
+            ]
+            if max_size is not None
+        }
+        assert len(self._budget) > 0, "at least one batch budget has to be set."
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            shard_indices = iter(self._sampler)
+        else:
+            # the workers' seeds only differ by the worker id, so this is the same in every worker
+            # of an epoch but different across epochs
+            self._sampler.reseed(worker_info.seed - worker_info.id)
+            self._sampler.set_worker(worker_info.id, worker_info.num_workers)
+            shard_indices = iter(self._sampler)
+        for idx in shard_indices:
+            data = self._dataset[idx]
+            for selected_idx in pack_gen_steps(gen_step_sizes(data), self._budget):
+                yield select_gen_steps(data, selected_idx)
@@ -1,6 +1,7 @@
 from model_utils import GenericGraphEncoder
 import torch
 from model_utils import LayerType, AggrLayerType
+from dataset import first_step_mask, original_graph_to_unique_graph_map
 
 
 class GraphEncoder(torch.nn.Module):
@@ -70,6 +71,67 @@ class GraphEncoder(torch.nn.Module):
         return input_molecule_representations
 
 
+def encode_unique_original_graphs(full_graph_encoder, batch, deduplicate=False):
+    """
+    Representations of the distinct original graphs in the batch, in the order of their first
+    step, and the map from the generation steps to them.
+
+    With `deduplicate`, the full graph encoder only runs once for every distinct original graph
+    instead of once for every generation step. This is not exact: the LayerNorm layers of the
+    encoder normalise over all nodes in the batch, so their statistics are then computed over the
+    distinct molecules rather than over every step. Only use it for encoders trained with it (see
+    `AbstractModel.deduplicate_original_graphs`).
+    """
+    graph_to_unique_graph = original_graph_to_unique_graph_map(batch)
+    is_first_step = first_step_mask(batch, graph_to_unique_graph)
+    if not deduplicate:
+        graph_representations = full_graph_encoder(
+            original_graph_node_categorical_features=batch.original_graph_node_categorical_features,
+            node_features=batch.original_graph_x.float(),
+            edge_index=batch.original_graph_edge_index,
+            edge_features=batch.original_graph_edge_features,  # can be edge_type or edge_attr
+            batch_index=batch.original_graph_x_batch,
+        )
+        return graph_representations[is_first_step], graph_to_unique_graph
+
+    node_to_graph = batch.original_graph_x_batch
+    edge_index = batch.original_graph_edge_index.long()
+    edge_to_graph = node_to_graph[edge_index[0]]
+    node_mask = is_first_step[node_to_graph]
+    edge_mask = is_first_step[edge_to_graph]
+    node_idx_in_unique_graphs = torch.cumsum(node_mask, dim=0) - 1
+
+    unique_graph_representations = full_graph_encoder(
+        original_graph_node_categorical_features=batch.original_graph_node_categorical_features[
+            node_mask
+        ],
+        node_features=batch.original_graph_x[node_mask].float(),
+        edge_index=node_idx_in_unique_graphs[edge_index[:, edge_mask]],
+        edge_features=batch.original_graph_edge_features[edge_mask],
+        batch_index=graph_to_unique_graph[node_to_graph[node_mask]],
+    )
+    return unique_graph_representations, graph_to_unique_graph
+
+
+def encode_original_graphs(full_graph_encoder, batch, deduplicate=False):
+    """
+    Representation of the original graph of every generation step in the batch, see
+    `encode_unique_original_graphs` for `deduplicate`.
+    """
+    if not deduplicate:
+        return full_graph_encoder(
+            original_graph_node_categorical_features=batch.original_graph_node_categorical_features,
+            node_features=batch.original_graph_x.float(),
+            edge_index=batch.original_graph_edge_index,
+            edge_features=batch.original_graph_edge_features,  # can be edge_type or edge_attr
+            batch_index=batch.original_graph_x_batch,
+        )
+    unique_graph_representations, graph_to_unique_graph = encode_unique_original_graphs(
+        full_graph_encoder, batch, deduplicate=True
+    )
+    return unique_graph_representations[graph_to_unique_graph]
+
+
 class PartialGraphEncoder(torch.nn.Module):
     """Returns graph level representation of the molecules."""
 
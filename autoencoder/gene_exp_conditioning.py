@@ -0,0 +1,103 @@
+import collections
+import math
+import numpy as np
+import torch
+
+
+class GeneExpConditioning:
+    """
+    Conditioning vectors of the L1000 experiments of a `LincsDataset`: the differences between
+    every (control, tumour) pair of gene expressions of an experiment, in the order of
+    itertools.product(control_idx, tumour_idx), and the experiment's dose.
+
+    The difference vectors are computed by gathering every control and tumour row once and
+    broadcasting the subtraction, and are kept in an LRU cache of at most `max_cache_size_bytes`,
+    so that repeated evaluations of an experiment only copy them to the device.
+    """
+
+    def __init__(self, dataset, max_cache_size_bytes=1 << 30):
+        self._dataset = dataset
+        self._max_cache_size_bytes = max_cache_size_bytes
+        self._cache = collections.OrderedDict()
+        self._cache_size_bytes = 0
+
+    def difference_vectors(self, control_idx, tumour_idx):
+        """
+        float32 tensor of shape [len(control_idx) * len(tumour_idx), gene exp dim] on the cpu, which
+        is shared with the cache and must not be modified in place.
+        """
+        control_idx = np.asarray(control_idx, dtype=np.int64)
+        tumour_idx = np.asarray(tumour_idx, dtype=np.int64)
+        key = (control_idx.tobytes(), tumour_idx.tobytes())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        control_gene_exp = self._dataset.gene_exp_controls[control_idx].astype(np.float32)
+        tumour_gene_exp = self._dataset.gene_exp_tumour[tumour_idx].astype(np.float32)
+        difference_vectors = torch.from_numpy(
+            (tumour_gene_exp[None, :, :] - control_gene_exp[:, None, :]).reshape(
+                -1, control_gene_exp.shape[-1]
+            )
+        )
+
+        size_bytes = difference_vectors.numel() * difference_vectors.element_size()
+        if size_bytes <= self._max_cache_size_bytes:
+            while self._cache_size_bytes + size_bytes > self._max_cache_size_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size_bytes -= evicted.numel() * evicted.element_size()
+            self._cache[key] = difference_vectors
+            self._cache_size_bytes += size_bytes
+        return difference_vectors
+
+    def sample_difference_vectors(
+        self, control_idx, tumour_idx, num_samples, device="cpu", round_up=True
+    ):
+        """
+        Difference vectors for num_samples samples on `device`. If there are fewer pairs than
+        samples, every vector is repeated in place num_repeats times, rounded up (and cut to
+        num_samples) or down, otherwise the first num_samples vectors are used.
+        Returns the vectors and num_repeats, which is None if they are not repeated.
+        """
+        difference_vectors = self.difference_vectors(control_idx, tumour_idx)
+        num_pairs = difference_vectors.shape[0]
+        if num_samples > num_pairs:
+            num_repeats = (
+                math.ceil(num_samples / num_pairs)
+                if round_up
+                else num_samples // num_pairs
+            )
+            difference_vectors = torch.repeat_interleave(
+                difference_vectors.to(device), num_repeats, dim=0
+            )
+            if round_up:
+                difference_vectors = difference_vectors[:num_samples]
+            return difference_vectors, num_repeats
+        return difference_vectors[:num_samples].to(device), None
+
+    def dose(self, experiment_idx, num_samples, device="cpu"):
+        """The experiment's dose repeated num_samples times."""
+        return torch.full(
+            (num_samples,),
+            float(self._dataset._experiment_idx_to_dose[experiment_idx]),
+            device=device,
+        )
+
+    def conditioning_vectors(
+        self, control_idx, tumour_idx, experiment_idx, num_samples, device="cpu"
+    ):
+        """[num_samples, gene exp dim + 1] conditioning of the latent diffusion model."""
+        difference_vectors, _ = self.sample_difference_vectors(
+            control_idx, tumour_idx, num_samples, device=device
+        )
+        return torch.cat(
+            (
+                difference_vectors,
+                self.dose(experiment_idx, num_samples, device=device).unsqueeze(-1),
+            ),
+            dim=1,
+        )
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_size_bytes = 0
@@ -0,0 +1,61 @@
+"""
+Uncompressed on-disk store for the L1000 gene expression matrices.
+
+`robust_normalized_controls.npz` and `robust_normalized_tumors.npz` have to be decompressed and
+converted to float32 by every process that uses them. The converted matrix is stored once as a
+plain .npy file next to the npz file, e.g. `robust_normalized_controls.float32.npy`, which is
+opened with `np.load(mmap_mode="r")`, so that all data loader workers and evaluation scripts
+share the same pages of the OS page cache instead of holding their own copy.
+
+    python gene_expression_store.py \
+        --npz_file_paths data/l1000/robust_normalized_controls.npz data/l1000/robust_normalized_tumors.npz \
+        --dtype=float16
+"""
+import argparse
+import os
+import numpy as np
+
+GENE_EXPRESSION_STORE_DTYPES = ["float32", "float16"]
+
+
+def gene_expression_store_file_path(npz_file_path, dtype="float32"):
+    return npz_file_path[: -len(".npz")] + f".{dtype}.npy"
+
+
+def convert_npz_to_gene_expression_store(npz_file_path, dtype="float32"):
+    assert dtype in GENE_EXPRESSION_STORE_DTYPES, f"unsupported dtype {dtype}"
+    genes = np.load(npz_file_path, allow_pickle=True)["genes"].astype(dtype)
+    file_path = gene_expression_store_file_path(npz_file_path, dtype)
+    # write to a temporary file first so that an interrupted conversion is never picked up
+    tmp_file_path = file_path + ".tmp"
+    with open(tmp_file_path, "wb") as f:
+        np.save(f, genes)
+    os.replace(tmp_file_path, file_path)
+    return file_path
+
+
+def load_gene_expressions(file_path):
+    """
+    Opens a converted gene expression store read-only and memory mapped. Given the original npz
+    file, its converted store is used if there is one, otherwise the npz file is loaded into memory.
+    """
+    if file_path.endswith(".npz"):
+        for dtype in GENE_EXPRESSION_STORE_DTYPES:
+            store_file_path = gene_expression_store_file_path(file_path, dtype)
+            if os.path.exists(store_file_path):
+                return np.load(store_file_path, mmap_mode="r")
+        return np.load(file_path, allow_pickle=True)["genes"].astype("float32")
+    return np.load(file_path, mmap_mode="r")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--npz_file_paths", required=True, nargs="+")
+    parser.add_argument(
+        "--dtype", type=str, default="float32", choices=GENE_EXPRESSION_STORE_DTYPES
+    )
+    args = parser.parse_args()
+    for npz_file_path in args.npz_file_paths:
+        print(
+            f"{npz_file_path} -> {convert_npz_to_gene_expression_store(npz_file_path, args.dtype)}"
+        )
@@ -0,0 +1,88 @@
+"""
+The `ControlIndices` and `TumourIndices` columns of the L1000 experiment csv files hold one space
+separated list of gene expression indices per experiment (sometimes wrapped in brackets and
+spread over several lines). They are parsed once into a CSR layout, a flat int32 array of all
+indices plus the offsets of every experiment's list, which is cached next to the csv file.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+INDEX_LIST_COLUMNS = {
+    "ControlIndices": "control_indices",
+    "TumourIndices": "tumour_indices",
+}
+
+
+class CSRIndexLists:
+    """Ragged lists of indices, lists[i] is an O(1) slice of the flat index array."""
+
+    def __init__(self, indices, offsets):
+        self.indices = indices
+        self.offsets = offsets
+        self.lengths = offsets[1:] - offsets[:-1]
+
+    @classmethod
+    def from_strings(cls, strings):
+        cleaned = pd.Series(strings, dtype=object).str.replace(
+            r"[\[\]\n]", " ", regex=True
+        )
+        lengths = cleaned.str.count(r"\S+").to_numpy()
+        indices = np.array(" ".join(cleaned).split(), dtype=np.int32)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(indices, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.indices[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_lincs_experiments(lincs_csv_file_path):
+    """
+    Returns the control and tumour index lists and the doses of all experiments in the csv. The
+    parsed arrays are cached in `<csv>.index_lists.npz` and reused until the csv changes.
+    """
+    cache_file_path = lincs_csv_file_path + ".index_lists.npz"
+    csv_stat = os.stat(lincs_csv_file_path)
+    version = np.array([csv_stat.st_size, csv_stat.st_mtime_ns], dtype=np.int64)
+    if os.path.exists(cache_file_path):
+        with np.load(cache_file_path) as cache:
+            if np.array_equal(cache["version"], version):
+                experiments = {
+                    name: CSRIndexLists(
+                        cache[f"{name}_indices"], cache[f"{name}_offsets"]
+                    )
+                    for name in INDEX_LIST_COLUMNS.values()
+                }
+                experiments["dose"] = cache["dose"]
+                return experiments
+
+    df = pd.read_csv(
+        lincs_csv_file_path, usecols=list(INDEX_LIST_COLUMNS) + ["Dose"]
+    )
+    experiments = {
+        name: CSRIndexLists.from_strings(df[column])
+        for column, name in INDEX_LIST_COLUMNS.items()
+    }
+    experiments["dose"] = df["Dose"].to_numpy()
+
+    arrays = {"version": version, "dose": experiments["dose"]}
+    for name in INDEX_LIST_COLUMNS.values():
+        arrays[f"{name}_indices"] = experiments[name].indices
+        arrays[f"{name}_offsets"] = experiments[name].offsets
+    try:
+        # np.savez appends .npz to file names that do not end with it
+        tmp_cache_file_path = cache_file_path[: -len(".npz")] + ".tmp.npz"
+        np.savez(tmp_cache_file_path, **arrays)
+        os.replace(tmp_cache_file_path, cache_file_path)
+    except OSError:
+        # e.g. a read-only data folder, the index lists are simply parsed again next time
+        pass
+    return experiments
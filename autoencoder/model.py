@@ -2,17 +2,20 @@ import sys
 import itertools
 from pytorch_lightning import LightningModule
 from model_utils import GenericMLP, MoLeROutput, PropertyRegressionMLP
-from encoder import GraphEncoder, PartialGraphEncoder
+from encoder import GraphEncoder, PartialGraphEncoder, encode_original_graphs
 from rdkit.Chem import Draw
 from rdkit import Chem
 from decoder import MLPDecoder
 import torch
 import numpy as np
-from utils import BIG_NUMBER, pprint_pyg_obj
+from utils import BIG_NUMBER, pprint_pyg_obj, traced_unsorted_segment_log_softmax
 from decoding_utils import (
     construct_decoder_states,
-    sample_indices_from_logprobs,
+    batched_sample_indices_from_logprobs,
+    batched_sample_segment_indices_from_logprobs,
     batch_decoder_states,
+    DecoderStateFeaturizer,
+    DeviceSyncCounter,
 )
 from torchvision import transforms
 
@@ -83,6 +86,15 @@ class AbstractModel(LightningModule):
     def full_graph_encoder(self):
         return self._full_graph_encoder
 
+    @property
+    def deduplicate_original_graphs(self):
+        """
+        Whether the full graph encoder runs once per distinct molecule of a batch, see
+        `encode_unique_original_graphs`. Off for models trained without it, as it changes the
+        LayerNorm statistics and therefore the latents.
+        """
+        return self._params.get("deduplicate_original_graphs", False)
+
     @property
     def partial_graph_encoder(self):
         return self._partial_graph_encoder
@@ -104,7 +116,10 @@ class AbstractModel(LightningModule):
         decoder_states,
         sampling_mode="greedy",
         num_samples=1,
+        sync_counter=None,
     ):
+        if sync_counter is None:
+            sync_counter = DeviceSyncCounter()
         with torch.no_grad():
             # We only need the molecule representations.
             latent_representations = torch.stack(
@@ -119,30 +134,39 @@ class AbstractModel(LightningModule):
                 first_node_type_logits[:, 1:],  # because index 0 corresponds to UNK
                 dim=1,
             )  # Shape [G, NT]
+            (
+                picked_atom_type_indices,
+                picked_atom_type_logprobs,
+            ) = batched_sample_indices_from_logprobs(
+                num_samples, sampling_mode, first_atom_type_logprobs
+            )  # Shape [G, K]
+            (
+                first_atom_type_logprobs,
+                picked_atom_type_indices,
+                picked_atom_type_logprobs,
+            ) = sync_counter.to_host(
+                first_atom_type_logprobs,
+                # Revert the stripping out of the UNK (index 0) type
+                picked_atom_type_indices + 1,
+                picked_atom_type_logprobs,
+            )
 
             first_atom_type_pick_results = []
-
-            # Iterate over each of the rows independently, sampling for each input state:
-            for state_first_atom_type_logprobs in first_atom_type_logprobs:
-                picked_atom_type_indices = sample_indices_from_logprobs(
-                    num_samples, sampling_mode, state_first_atom_type_logprobs
-                )
-
-                this_state_results = []
-
-                for picked_atom_type_idx in picked_atom_type_indices:
-                    pick_logprob = state_first_atom_type_logprobs[picked_atom_type_idx]
-                    picked_atom_type_idx += (
-                        1  # Revert the stripping out of the UNK (index 0) type
-                    )
-
-                    this_state_results.append(
-                        (
-                            self._index_to_node_type_map[picked_atom_type_idx.item()],
-                            pick_logprob,
-                        )
+            for (
+                state_first_atom_type_logprobs,
+                state_picked_atom_type_indices,
+                state_picked_atom_type_logprobs,
+            ) in zip(
+                first_atom_type_logprobs,
+                picked_atom_type_indices.tolist(),
+                picked_atom_type_logprobs.tolist(),
+            ):
+                this_state_results = [
+                    (self._index_to_node_type_map[picked_atom_type_idx], pick_logprob)
+                    for picked_atom_type_idx, pick_logprob in zip(
+                        state_picked_atom_type_indices, state_picked_atom_type_logprobs
                     )
-
+                ]
                 first_atom_type_pick_results.append(
                     (this_state_results, state_first_atom_type_logprobs)
                 )
@@ -154,7 +178,10 @@ class AbstractModel(LightningModule):
         decoder_states,
         num_samples=1,
         sampling_mode="greedy",
+        sync_counter=None,
     ):
+        if sync_counter is None:
+            sync_counter = DeviceSyncCounter()
 
         initial_focus_atom_idx = batch.candidate_attachment_points_ptr[:-1]
 
@@ -182,46 +209,87 @@ class AbstractModel(LightningModule):
             candidate_attachment_points=candidate_attachment_points,
         )  # Shape: [CA]
 
+        num_graphs = len(decoder_states)
         attachment_point_to_graph_map = batch.batch[candidate_attachment_points]
+        attachment_point_logprobs = traced_unsorted_segment_log_softmax(
+            attachment_point_selection_logits,
+            attachment_point_to_graph_map,
+            num_segments=num_graphs,
+        )
+        (
+            picked_att_point_indices,
+            picked_att_point_logprobs,
+        ) = batched_sample_segment_indices_from_logprobs(
+            num_samples,
+            sampling_mode,
+            attachment_point_logprobs,
+            attachment_point_to_graph_map,
+            num_graphs,
+        )  # Shape [G, K]
+        # The candidate attachment points of a graph are contiguous, so the position of a pick
+        # among the candidates of its graph is its offset from the first one:
+        attachment_point_offsets = batch.candidate_attachment_points_ptr
+        picked_att_point_indices = torch.where(
+            picked_att_point_indices >= 0,
+            picked_att_point_indices - attachment_point_offsets[:-1].unsqueeze(1),
+            picked_att_point_indices,
+        )
+        (
+            attachment_point_selection_logits,
+            picked_att_point_indices,
+            picked_att_point_logprobs,
+            attachment_point_offsets,
+        ) = sync_counter.to_host(
+            attachment_point_selection_logits,
+            picked_att_point_indices,
+            picked_att_point_logprobs,
+            attachment_point_offsets,
+        )
 
-        # TODO(krmaziar): Consider tensorizing the code below. For that, we need some equivalent of
-        # `unsorted_segment_argmax`.
-        logits_by_graph = [[] for _ in range(len(decoder_states))]
-
-        for logit, graph_id in zip(
-            attachment_point_selection_logits, attachment_point_to_graph_map
-        ):
-            logits_by_graph[graph_id].append(logit)
+        attachment_point_offsets = attachment_point_offsets.tolist()
+        logits_by_graph = [
+            attachment_point_selection_logits[start:end]
+            for start, end in zip(
+                attachment_point_offsets[:-1], attachment_point_offsets[1:]
+            )
+        ]
         attachment_point_pick_results = []
-        for old_decoder_state, attachment_point_logits in zip(
-            decoder_states, logits_by_graph
+        for (
+            old_decoder_state,
+            state_picked_att_point_indices,
+            state_picked_att_point_logprobs,
+        ) in zip(
+            decoder_states,
+            picked_att_point_indices.tolist(),
+            picked_att_point_logprobs.tolist(),
         ):
-
-            attachment_point_logprobs = torch.nn.functional.log_softmax(
-                torch.tensor(attachment_point_logits), dim=0
-            )  # .numpy()
-            picked_att_point_indices = sample_indices_from_logprobs(
-                num_samples, sampling_mode, attachment_point_logprobs
-            )
-
-            this_state_results = []
-            for attachment_point_pick_idx in picked_att_point_indices:
-                attachment_point_pick = old_decoder_state.candidate_attachment_points[
-                    attachment_point_pick_idx
-                ]
-                attachment_point_logprob = attachment_point_logprobs[
-                    attachment_point_pick_idx
+            attachment_point_pick_results.append(
+                [
+                    (
+                        old_decoder_state.candidate_attachment_points[
+                            attachment_point_pick_idx
+                        ],
+                        attachment_point_logprob,
+                    )
+                    for attachment_point_pick_idx, attachment_point_logprob in zip(
+                        state_picked_att_point_indices, state_picked_att_point_logprobs
+                    )
+                    # Graphs with fewer than num_samples candidates are padded with -1:
+                    if attachment_point_pick_idx >= 0
                 ]
-
-                this_state_results.append(
-                    (attachment_point_pick, attachment_point_logprob)
-                )
-            attachment_point_pick_results.append(this_state_results)
+            )
 
         return attachment_point_pick_results, logits_by_graph
 
     def _decoder_pick_attachment_points(
-        self, decoder_states, sampling_mode="greedy", num_samples=1
+        self,
+        decoder_states,
+        sampling_mode="greedy",
+        num_samples=1,
+        batch_size=16,
+        max_num_nodes=None,
+        featurizer=None,
+        sync_counter=None,
     ):
         if len(decoder_states) == 0:
             return [], np.zeros(shape=(0,))
@@ -239,7 +307,9 @@ class AbstractModel(LightningModule):
 
         for batch, decoder_states_batch in batch_decoder_states(
             decoder_states=decoder_states,
-            batch_size=16,
+            batch_size=batch_size,
+            max_num_nodes=max_num_nodes,
+            featurizer=featurizer,
             atom_featurisers=self._atom_featurisers,
             motif_vocabulary=self._motif_vocabulary,
             add_state_to_batch_callback=add_state_to_attachment_point_choice_batch,
@@ -255,6 +325,7 @@ class AbstractModel(LightningModule):
                     decoder_states=decoder_states_batch,
                     num_samples=num_samples,
                     sampling_mode=sampling_mode,
+                    sync_counter=sync_counter,
                 )
                 attachment_point_pick_results.extend(pick_results_for_batch)
                 logits_by_graph.extend(logits_for_batch)
@@ -268,7 +339,10 @@ class AbstractModel(LightningModule):
         num_samples=1,
         sampling_mode="greedy",
         store_generation_traces=False,
+        sync_counter=None,
     ):
+        if sync_counter is None:
+            sync_counter = DeviceSyncCounter()
         with torch.no_grad():
             # print('batch.focus_atoms,', batch.focus_atoms)
             graph_representations, node_representations = self._partial_graph_encoder(
@@ -285,91 +359,110 @@ class AbstractModel(LightningModule):
                 batch_index=batch.batch,
             )
 
-            batch_candidate_edge_targets = batch.candidate_edge_targets
-            batch_candidate_edge_type_masks = batch.candidate_edge_type_masks
-
+            num_graphs = len(decoder_states)
             edge_candidate_logits, edge_type_logits = self.decoder.pick_edge(
                 input_molecule_representations=batch.latent_representation,
                 partial_graph_representations=graph_representations,
                 node_representations=node_representations,
-                num_graphs_in_batch=len(batch.ptr) - 1,
+                num_graphs_in_batch=num_graphs,
                 focus_node_idx_in_batch=batch.focus_atoms,
                 node_to_graph_map=batch.batch,
-                candidate_edge_targets=batch_candidate_edge_targets.long(),
+                candidate_edge_targets=batch.candidate_edge_targets.long(),
                 candidate_edge_features=batch.candidate_edge_features.float(),
             )
 
-            # We now need to unpack the results, which is a bit fiddly because the "no more edges"
-            # logits are bunched together at the end for all input graphs...
-            num_total_edge_candidates = torch.sum(
-                batch.decoder_state_to_num_candidate_edges
+            # The "no more edges" logits are bunched together at the end for all input graphs, so
+            # the edge candidates of a graph and its "no more edges" choice form one segment:
+            edge_candidate_to_graph_map = torch.cat(
+                [
+                    batch.candidate_edge_targets_batch,
+                    torch.arange(num_graphs, device=edge_candidate_logits.device),
+                ]
+            )
+            edge_candidate_logprobs = traced_unsorted_segment_log_softmax(
+                edge_candidate_logits, edge_candidate_to_graph_map, num_segments=num_graphs
             )
-            edge_candidate_offset = 0
+            edge_type_logprobs = torch.nn.functional.log_softmax(
+                edge_type_logits - BIG_NUMBER * (1 - batch.candidate_edge_type_masks),
+                dim=1,
+            )
+            # Pick the edges of every graph (or "no more edges"), and the types of every edge
+            # candidate, of which only those of the picked edges are used:
+            (
+                picked_edge_cand_indices,
+                picked_edge_cand_logprobs,
+            ) = batched_sample_segment_indices_from_logprobs(
+                num_samples,
+                sampling_mode,
+                edge_candidate_logprobs,
+                edge_candidate_to_graph_map,
+                num_graphs,
+            )  # Shape [G, K]
+            picked_edge_types, picked_edge_type_logprobs = batched_sample_indices_from_logprobs(
+                num_samples, sampling_mode, edge_type_logprobs
+            )  # Shape [CE, K]
+            # Everything below runs on the host:
+            (
+                edge_candidate_logits,
+                edge_candidate_logprobs,
+                edge_type_logprobs,
+                batch_candidate_edge_targets,
+                num_candidate_edges,
+                ptr,
+                picked_edge_cand_indices,
+                picked_edge_cand_logprobs,
+                picked_edge_types,
+                picked_edge_type_logprobs,
+            ) = sync_counter.to_host(
+                edge_candidate_logits,
+                edge_candidate_logprobs,
+                edge_type_logprobs,
+                batch.candidate_edge_targets,
+                batch.decoder_state_to_num_candidate_edges,
+                batch.ptr,
+                picked_edge_cand_indices,
+                picked_edge_cand_logprobs,
+                picked_edge_types,
+                picked_edge_type_logprobs,
+            )
+            picked_edge_cand_indices = picked_edge_cand_indices.tolist()
+            picked_edge_cand_logprobs = picked_edge_cand_logprobs.tolist()
+            picked_edge_types = picked_edge_types.tolist()
+            picked_edge_type_logprobs = picked_edge_type_logprobs.tolist()
+
+            num_total_edge_candidates = len(batch_candidate_edge_targets)
+            edge_candidate_offsets = np.cumsum([0] + num_candidate_edges.tolist())
             picked_edges = []
 
-            for state_idx, (
-                decoder_state,
-                decoder_state_num_edge_candidates,
-            ) in enumerate(
-                zip(decoder_states, batch.decoder_state_to_num_candidate_edges)
-            ):
+            for state_idx, decoder_state in enumerate(decoder_states):
+                start, end = edge_candidate_offsets[state_idx : state_idx + 2]
                 # We had no valid candidates -> Easy out:
-                if decoder_state_num_edge_candidates == 0:
+                if start == end:
                     picked_edges.append(([], None))
                     continue
 
                 # Find the edge targets for this decoder state, in the original node index:
-                edge_targets = batch_candidate_edge_targets[
-                    edge_candidate_offset : edge_candidate_offset
-                    + decoder_state_num_edge_candidates
-                ]
-                edge_targets_orig_idx = edge_targets - batch.ptr[state_idx]
-
-                # Get logits for edge candidates for this decoder state:
-                decoder_state_edge_candidate_logits = edge_candidate_logits[
-                    edge_candidate_offset : edge_candidate_offset
-                    + decoder_state_num_edge_candidates
-                ]
-                decoder_state_no_edge_logit = edge_candidate_logits[
-                    num_total_edge_candidates + state_idx
-                ]
+                edge_targets_orig_idx = batch_candidate_edge_targets[start:end] - ptr[state_idx]
 
-                decoder_state_edge_cand_logprobs = torch.nn.functional.log_softmax(
-                    torch.cat(
-                        [
-                            decoder_state_edge_candidate_logits,
-                            torch.tensor(
-                                [decoder_state_no_edge_logit],
-                                device=self.full_graph_encoder._dummy_param.device,
-                            ),
-                        ]
-                    ),
-                    dim=0,
+                decoder_state_no_edge_idx = num_total_edge_candidates + state_idx
+                decoder_state_edge_cand_logprobs = torch.cat(
+                    [
+                        edge_candidate_logprobs[start:end],
+                        edge_candidate_logprobs[
+                            decoder_state_no_edge_idx : decoder_state_no_edge_idx + 1
+                        ],
+                    ]
                 )
 
                 # Before we continue, generate the information for the trace visualisation:
                 molecule_generation_edge_choice_info = None
                 if store_generation_traces:
-                    # Set up the edge candidate info
-                    candidate_edge_type_logits = edge_type_logits[
-                        edge_candidate_offset : edge_candidate_offset
-                        + decoder_state_num_edge_candidates
-                    ]
-                    candidate_edge_type_mask = batch_candidate_edge_type_masks[
-                        edge_candidate_offset : edge_candidate_offset
-                        + decoder_state_num_edge_candidates
-                    ]
-                    masked_candidate_edge_type_logits = (
-                        candidate_edge_type_logits
-                        - BIG_NUMBER * (1 - candidate_edge_type_mask)
-                    )
-
                     # Loop over the edge candidates themselves.
                     molecule_generation_edge_candidate_info = []
                     for edge_idx, (target, score, logprob) in enumerate(
                         zip(
                             edge_targets_orig_idx,
-                            decoder_state_edge_candidate_logits,
+                            edge_candidate_logits[start:end],
                             decoder_state_edge_cand_logprobs,
                         )
                     ):
@@ -379,60 +472,44 @@ class AbstractModel(LightningModule):
                                 score=score,
                                 logprob=logprob,
                                 correct=None,
-                                type_idx_to_logprobs=torch.nn.functional.log_softmax(
-                                    masked_candidate_edge_type_logits[edge_idx, :]
-                                ),
+                                type_idx_to_logprobs=edge_type_logprobs[start + edge_idx],
                             )
                         )
                     molecule_generation_edge_choice_info = MoleculeGenerationEdgeChoiceInfo(
                         focus_node_idx=decoder_state.focus_atom,
                         partial_molecule_adjacency_lists=decoder_state.adjacency_lists,
                         candidate_edge_infos=molecule_generation_edge_candidate_info,
-                        no_edge_score=decoder_state_no_edge_logit,
+                        no_edge_score=edge_candidate_logits[decoder_state_no_edge_idx],
                         no_edge_logprob=decoder_state_edge_cand_logprobs[-1],
                         no_edge_correct=None,
                     )
 
-                # Collect (sampling) results for this state:
+                # Collect (sampling) results for this state, the picks index into the edge
+                # candidates of the whole batch followed by the "no more edges" choices:
                 this_state_results = []
-                picked_edge_cand_indices = sample_indices_from_logprobs(
-                    num_samples, sampling_mode, decoder_state_edge_cand_logprobs
-                )
-                for picked_edge_cand_idx in picked_edge_cand_indices:
-                    picked_cand_logprob = decoder_state_edge_cand_logprobs[
-                        picked_edge_cand_idx
-                    ]
+                for picked_edge_cand_idx, picked_cand_logprob in zip(
+                    picked_edge_cand_indices[state_idx], picked_edge_cand_logprobs[state_idx]
+                ):
+                    # Padding of graphs with fewer than num_samples choices:
+                    if picked_edge_cand_idx < 0:
+                        continue
                     # Handle case of having no edge is better:
-                    if (
-                        picked_edge_cand_idx
-                        == len(decoder_state_edge_cand_logprobs) - 1
-                    ):
+                    if picked_edge_cand_idx >= num_total_edge_candidates:
                         this_state_results.append((None, picked_cand_logprob))
                     else:
                         # Otherwise, we need to find the target of that edge, in the original
                         # (unbatched) node index:
                         picked_edge_partner = edge_targets_orig_idx[
-                            picked_edge_cand_idx
+                            picked_edge_cand_idx - start
                         ]
 
-                        # Next, identify the edge type for this choice:
-                        edge_type_mask = batch_candidate_edge_type_masks[
-                            edge_candidate_offset + picked_edge_cand_idx
-                        ]
-                        cand_edge_type_logprobs = torch.nn.functional.log_softmax(
-                            edge_type_logits[
-                                edge_candidate_offset + picked_edge_cand_idx
-                            ]
-                            - BIG_NUMBER * (1 - edge_type_mask),
-                            dim=0,
-                        )
-                        picked_edge_types = sample_indices_from_logprobs(
-                            num_samples, sampling_mode, cand_edge_type_logprobs
-                        )
-                        for picked_edge_type in picked_edge_types:
+                        # Next, add the picked edge types for this choice:
+                        for picked_edge_type, picked_edge_type_logprob in zip(
+                            picked_edge_types[picked_edge_cand_idx],
+                            picked_edge_type_logprobs[picked_edge_cand_idx],
+                        ):
                             picked_edge_logprob = (
-                                picked_cand_logprob
-                                + cand_edge_type_logprobs[picked_edge_type]
+                                picked_cand_logprob + picked_edge_type_logprob
                             )
                             this_state_results.append(
                                 (
@@ -443,7 +520,6 @@ class AbstractModel(LightningModule):
                 picked_edges.append(
                     (this_state_results, molecule_generation_edge_choice_info)
                 )
-                edge_candidate_offset += decoder_state_num_edge_candidates
             return picked_edges
 
     def _decoder_pick_new_bond_types(
@@ -452,6 +528,10 @@ class AbstractModel(LightningModule):
         sampling_mode="greedy",
         store_generation_traces=False,
         num_samples=1,
+        batch_size=16,
+        max_num_nodes=None,
+        featurizer=None,
+        sync_counter=None,
     ):
         def add_state_to_edge_batch(decoder_state_features, decoder_state):
             #     TODO add all these into MolerData to get the right offset.
@@ -478,7 +558,9 @@ class AbstractModel(LightningModule):
 
         batch_generator = batch_decoder_states(
             decoder_states=decoder_states,
-            batch_size=16,
+            batch_size=batch_size,
+            max_num_nodes=max_num_nodes,
+            featurizer=featurizer,
             atom_featurisers=self._atom_featurisers,
             motif_vocabulary=self._motif_vocabulary,
             add_state_to_batch_callback=add_state_to_edge_batch,
@@ -490,7 +572,7 @@ class AbstractModel(LightningModule):
 
         picked_edges_generator = (
             self._pick_edges_for_batch(
-                b, d, num_samples, sampling_mode, store_generation_traces
+                b, d, num_samples, sampling_mode, store_generation_traces, sync_counter
             )
             for b, d in batch_generator
         )
@@ -501,6 +583,10 @@ class AbstractModel(LightningModule):
         decoder_states,
         sampling_mode="greedy",
         num_samples=1,
+        batch_size=16,
+        max_num_nodes=None,
+        featurizer=None,
+        sync_counter=None,
     ):
         def add_state_to_atom_choice_batch(decoder_state_features, decoder_state):
             #     TODO add all these into MolerData to get the right offset.
@@ -509,20 +595,26 @@ class AbstractModel(LightningModule):
 
         batch_generator = batch_decoder_states(
             decoder_states=decoder_states,
-            batch_size=16,
+            batch_size=batch_size,
+            max_num_nodes=max_num_nodes,
+            featurizer=featurizer,
             atom_featurisers=self._atom_featurisers,
             motif_vocabulary=self._motif_vocabulary,
             add_state_to_batch_callback=add_state_to_atom_choice_batch,
         )
         atom_type_pick_generator = (
-            self._pick_new_atom_types_for_batch(batch, num_samples, sampling_mode)
+            self._pick_new_atom_types_for_batch(
+                batch, num_samples, sampling_mode, sync_counter
+            )
             for batch, _ in batch_generator
         )
         return itertools.chain.from_iterable(atom_type_pick_generator)
 
     def _pick_new_atom_types_for_batch(
-        self, batch, num_samples=1, sampling_mode="greedy"
+        self, batch, num_samples=1, sampling_mode="greedy", sync_counter=None
     ):
+        if sync_counter is None:
+            sync_counter = DeviceSyncCounter()
         # print('batch.prior_focus_atoms')
         # pprint_pyg_obj(batch, True)
         with torch.no_grad():
@@ -553,26 +645,43 @@ class AbstractModel(LightningModule):
             atom_type_logprobs = torch.nn.functional.log_softmax(
                 node_type_logits[:, 1:], dim=1
             )  # .numpy()  # Shape [G, NT]
+            (
+                picked_atom_type_indices,
+                picked_atom_type_logprobs,
+            ) = batched_sample_indices_from_logprobs(
+                num_samples, sampling_mode, atom_type_logprobs
+            )  # Shape [G, K]
+            (
+                atom_type_logprobs,
+                picked_atom_type_indices,
+                picked_atom_type_logprobs,
+            ) = sync_counter.to_host(
+                atom_type_logprobs,
+                # Revert the stripping out of the UNK (index 0) type
+                picked_atom_type_indices + 1,
+                picked_atom_type_logprobs,
+            )
 
             atom_type_pick_results = []
-            # Iterate over each of the rows independently, sampling for each input state:
-            for state_atom_type_logprobs in atom_type_logprobs:
-                picked_atom_type_indices = sample_indices_from_logprobs(
-                    num_samples, sampling_mode, state_atom_type_logprobs
-                )
-
+            for (
+                state_atom_type_logprobs,
+                state_picked_atom_type_indices,
+                state_picked_atom_type_logprobs,
+            ) in zip(
+                atom_type_logprobs,
+                picked_atom_type_indices.tolist(),
+                picked_atom_type_logprobs.tolist(),
+            ):
                 this_state_results = []
-                for picked_atom_type_idx in picked_atom_type_indices:
-                    pick_logprob = state_atom_type_logprobs[picked_atom_type_idx]
-                    picked_atom_type_idx += (
-                        1  # Revert the stripping out of the UNK (index 0) type
-                    )
+                for picked_atom_type_idx, pick_logprob in zip(
+                    state_picked_atom_type_indices, state_picked_atom_type_logprobs
+                ):
                     # This is the case in which we picked the "no further nodes" virtual node type:
                     if picked_atom_type_idx >= self._num_node_types:
                         this_state_results.append((None, pick_logprob))
                     else:
                         picked_atom_type = self._index_to_node_type_map[
-                            picked_atom_type_idx.item()
+                            picked_atom_type_idx
                         ]
                         this_state_results.append((picked_atom_type, pick_logprob))
                 atom_type_pick_results.append(
@@ -589,7 +698,25 @@ class AbstractModel(LightningModule):
         max_num_steps=120,
         beam_size=1,
         sampling_mode="greedy",
+        decode_batch_size=16,
+        max_nodes_per_decode_batch=None,
+        sync_counter=None,
     ):
+        """
+        `decode_batch_size` is the maximal number of decoder states whose partial graphs are
+        encoded together in every decoding step. With `max_nodes_per_decode_batch`, the batches are
+        also limited to that many partial graph nodes, so that more of the small partial graphs of
+        the early steps and fewer of the large ones of the late steps are batched together; set
+        `decode_batch_size=None` to only limit the number of nodes.
+
+        The partial molecules are featurized incrementally from one decoding step to the next, see
+        `DecoderStateFeaturizer`. Pass a `DeviceSyncCounter` to count the device to host transfers
+        of every decoding round (round 0 picks the first atoms), one per batch of decoder states.
+        """
+        featurizer = DecoderStateFeaturizer(self._atom_featurisers, self._motif_vocabulary)
+        if sync_counter is None:
+            sync_counter = DeviceSyncCounter()
+        sync_counter.new_round()
         # use this for initialising decoder states when using initial scaffolds
         decoder_states_empty, decoder_states_non_empty = construct_decoder_states(
             motif_vocabulary=self._motif_vocabulary,
@@ -605,6 +732,7 @@ class AbstractModel(LightningModule):
             decoder_states=decoder_states_empty,
             num_samples=beam_size,
             sampling_mode=sampling_mode,
+            sync_counter=sync_counter,
         )
 
         decoder_states = decoder_states_non_empty
@@ -650,6 +778,7 @@ class AbstractModel(LightningModule):
             # This will hold the results after this decoding step, grouped by input mol id:
             new_decoder_states = []
             num_steps += 1
+            sync_counter.new_round()
             # Step 1: Split decoder states into subsets, dependent on what they need next:
             (
                 require_atom_states,
@@ -676,6 +805,10 @@ class AbstractModel(LightningModule):
                 decoder_states=require_atom_states,
                 num_samples=beam_size,
                 sampling_mode=sampling_mode,
+                batch_size=decode_batch_size,
+                max_num_nodes=max_nodes_per_decode_batch,
+                featurizer=featurizer,
+                sync_counter=sync_counter,
             )
 
             for decoder_state, (node_type_picks, node_type_logprobs) in zip(
@@ -727,6 +860,10 @@ class AbstractModel(LightningModule):
                 ) = self._decoder_pick_attachment_points(
                     decoder_states=require_attachment_point_states,
                     sampling_mode=sampling_mode,
+                    batch_size=decode_batch_size,
+                    max_num_nodes=max_nodes_per_decode_batch,
+                    featurizer=featurizer,
+                    sync_counter=sync_counter,
                 )
                 # print('attachment_pick_results, attachment_pick_logits', attachment_pick_results, attachment_pick_logits)
                 for (
@@ -775,6 +912,10 @@ class AbstractModel(LightningModule):
                 decoder_states=require_bond_states,
                 store_generation_traces=store_generation_traces,
                 sampling_mode=sampling_mode,
+                batch_size=decode_batch_size,
+                max_num_nodes=max_nodes_per_decode_batch,
+                featurizer=featurizer,
+                sync_counter=sync_counter,
             )
             for (decoder_state, (bond_picks, edge_choice_info)) in zip(
                 require_bond_states, bond_pick_results
@@ -814,7 +955,7 @@ class AbstractModel(LightningModule):
                                 target_atom_idx=int(
                                     picked_bond_target
                                 ),  # Go from np.int32 to pyInt
-                                bond_type_idx=picked_bond_type.item(),
+                                bond_type_idx=int(picked_bond_type),
                                 bond_logprob=bond_pick_logprob,
                                 edge_choice_info=edge_choice_info,
                             )
@@ -949,11 +1090,11 @@ class BaseModel(AbstractModel):
         if self.uses_motifs:
             # Record the set of atom types, which will be a subset of all node types.
             self._atom_types = set(
-                dataset._atom_type_featuriser.index_to_atom_type_map.values()
+                dataset.atom_type_featuriser.index_to_atom_type_map.values()
             )
 
         self._index_to_node_type_map = dataset.node_type_index_to_string
-        self._atom_featurisers = dataset._metadata["feature_extractors"]
+        self._atom_featurisers = dataset.metadata["feature_extractors"]
         self._num_node_types = dataset.num_node_types
 
     def sample_from_latent_repr(self, latent_repr):
@@ -1003,12 +1144,8 @@ class BaseModel(AbstractModel):
 
     def _run_step(self, batch):
         # Obtain graph level representation of original molecular graph
-        input_molecule_representations = self.full_graph_encoder(
-            original_graph_node_categorical_features=batch.original_graph_node_categorical_features,
-            node_features=batch.original_graph_x.float(),
-            edge_index=batch.original_graph_edge_index,
-            edge_features=batch.original_graph_edge_features,  # can be edge_type or edge_attr
-            batch_index=batch.original_graph_x_batch,
+        input_molecule_representations = encode_original_graphs(
+            self.full_graph_encoder, batch, deduplicate=self.deduplicate_original_graphs
         )
 
         # Obtain graph level representation of the partial graph
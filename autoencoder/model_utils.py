@@ -100,6 +100,33 @@ class GenericGraphEncoder(torch.nn.Module):
                 transformation_mlp_result_upper_bound=torch.tensor(5),
             )
         self._use_intermediate_gnn_results = use_intermediate_gnn_results
+        # see `set_backend`, the compiled forward pass is built lazily in every copy of the module
+        self._backend = "eager"
+        self._compiled_forward = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # compiled functions can not be pickled, and a deep copy has to compile its own forward pass
+        state["_compiled_forward"] = None
+        return state
+
+    def set_backend(self, backend):
+        """
+        Runs the forward pass eagerly ("eager") or compiled with torch.compile ("compile", needs
+        torch >= 2.0), which removes most of the Python overhead of the 12 layers for the small
+        batches of partial graphs encoded at every decoding step. Shapes are compiled as dynamic,
+        so graphs of different sizes do not trigger recompilation.
+        """
+        if backend not in ["eager", "compile"]:
+            raise ValueError(f"unknown graph encoder backend {backend}")
+        if backend == "compile" and not hasattr(torch, "compile"):
+            raise ValueError("torch.compile needs torch >= 2.0.")
+        self._compiled_forward = None
+        self._backend = backend
+
+    @property
+    def backend(self):
+        return self._backend
 
     def _apply_aggr(self, x, batch_index):
         if self._aggr_layer_type == AggrLayerType.SoftmaxAggregation:
@@ -115,6 +142,15 @@ class GenericGraphEncoder(torch.nn.Module):
             raise NotImplementedError
 
     def forward(self, node_features, edge_index, edge_type_or_attr, batch_index):
+        if self._backend == "compile":
+            if self._compiled_forward is None:
+                self._compiled_forward = torch.compile(self._forward, dynamic=True)
+            return self._compiled_forward(
+                node_features, edge_index, edge_type_or_attr, batch_index
+            )
+        return self._forward(node_features, edge_index, edge_type_or_attr, batch_index)
+
+    def _forward(self, node_features, edge_index, edge_type_or_attr, batch_index):
         gnn_results = []
         if self._layer_type in [
             LayerType.FiLMConv,
@@ -152,6 +188,13 @@ class GenericGraphEncoder(torch.nn.Module):
         return graph_representations, node_representations
 
 
+def set_graph_encoder_backend(module, backend):
+    """Sets the backend of every `GenericGraphEncoder` in `module`, see `GenericGraphEncoder.set_backend`."""
+    for submodule in module.modules():
+        if isinstance(submodule, GenericGraphEncoder):
+            submodule.set_backend(backend)
+
+
 class GenericMLP(torch.nn.Module):
     """
     Generic MLP with dropout layers.
@@ -327,14 +370,10 @@ class WeightedSumGraphRepresentation(torch.nn.Module):
         if self._weighting_fun == "sigmoid":
             weights = torch.sigmoid(scores)
         elif self._weighting_fun == "softmax":
-            weights_per_head = []
-            for head_idx in range(self._num_heads):
-                head_scores = scores[:, head_idx]  # Shape [V]
-                head_weights = unsorted_segment_softmax(
-                    logits=head_scores, segment_ids=batch
-                )  # Shape [V]
-                weights_per_head.append(head_weights)
-            weights = torch.stack(weights_per_head, dim=-1)  # Shape [V, H]
+            # softmax over the nodes of each graph, for all heads at once
+            weights = unsorted_segment_softmax(
+                logits=scores, segment_ids=batch
+            )  # Shape [V, H]
         else:
             raise NotImplementedError()
 
@@ -0,0 +1,178 @@
+"""
+Molecule level view of a `MolerDataset` or `LincsDataset`, for training the latent diffusion
+model, which only needs the original graph of every molecule and not its generation steps.
+
+The original graphs of the distinct molecules of a split (for a `LincsDataset`, of the distinct
+pairs of molecule and experiment, as a compound appears once for every experiment with it) are
+extracted from its trace shards once
+and stored as a single columnar shard, `<processed split folder>/molecules.colshard`, which is
+rebuilt whenever processed_file_paths.csv changes. Batches of molecules are sliced from the memory
+mapped shard with `select_gen_steps`, and have the same original graph keys (including
+`original_graph_x_batch` and `original_graph_x_ptr`) as batches of generation steps, so they can be
+passed to `encode_original_graphs` directly. For a `LincsDataset`, the gene expressions and dose
+are drawn anew for every batch, just like for the generation steps.
+
+    dataset = MoleculeDataset(train_dataset)
+    dataloader = molecule_dataloader(dataset, batch_size=256)
+"""
+import os
+import numpy as np
+import torch
+from torch_geometric.data import Batch
+from tqdm import tqdm
+from columnar_shards import COLUMNAR_SHARD_SUFFIX, load_shard, save_columnar_shard
+from dataset import MolerData, first_step_mask, select_gen_steps
+
+ORIGINAL_GRAPH_KEYS = [
+    "original_graph_x",
+    "original_graph_edge_index",
+    "original_graph_edge_features",
+    "original_graph_node_categorical_features",
+]
+
+
+def molecules_file_path(trace_dataset, split):
+    return os.path.join(
+        trace_dataset.processed_split_folder(split), "molecules" + COLUMNAR_SHARD_SUFFIX
+    )
+
+
+def _same_molecule(data, other, extra_keys):
+    return all(
+        torch.equal(data[key], other[key])
+        for key in ORIGINAL_GRAPH_KEYS + [key for key in extra_keys if key in data]
+    )
+
+
+def extract_molecules(trace_file_paths, extra_keys=("l1000_idx",)):
+    """
+    Batch of the original graphs of the distinct molecules of the trace shards, in order. Consecutive
+    steps with the same original graph are only one molecule if they also have the same
+    `extra_keys`, so that every experiment (`l1000_idx`) of a compound keeps its own row. The steps
+    of a molecule that are split over two consecutive shards are recognised as one molecule.
+    """
+    extra_keys = list(extra_keys)
+    molecules = []
+    for file_path in tqdm(trace_file_paths):
+        shard = load_shard(file_path, MolerData)
+        is_first_step = first_step_mask(shard, extra_keys=extra_keys)
+        first_steps = select_gen_steps(shard, torch.nonzero(is_first_step).view(-1))
+        for step in first_steps.to_data_list():
+            if len(molecules) > 0 and _same_molecule(step, molecules[-1], extra_keys):
+                continue
+            molecule = MolerData(**{key: step[key] for key in ORIGINAL_GRAPH_KEYS})
+            for key in extra_keys:
+                if key in step:
+                    molecule[key] = step[key]
+            molecules.append(molecule)
+    return Batch.from_data_list(molecules, follow_batch=["original_graph_x"])
+
+
+class MoleculeDataset(torch.utils.data.Dataset):
+    """
+    The distinct molecules of the splits of `trace_dataset`. Indexing with an int returns a batch
+    of one molecule, indexing with a list of indices of the same split returns a batch of those
+    molecules, see `MoleculeBatchSampler`.
+    """
+
+    def __init__(self, trace_dataset, rebuild=False):
+        self._trace_dataset = trace_dataset
+        self._file_paths = []
+        num_molecules = []
+        for split in trace_dataset.splits:
+            file_path = molecules_file_path(trace_dataset, split)
+            processed_file_paths_csv = os.path.join(
+                trace_dataset.processed_split_folder(split), "processed_file_paths.csv"
+            )
+            if (
+                rebuild
+                or not os.path.exists(file_path)
+                or os.path.getmtime(file_path) < os.path.getmtime(processed_file_paths_csv)
+            ):
+                print(f"Extracting the molecules of {split}...")
+                save_columnar_shard(
+                    extract_molecules(
+                        trace_dataset._processed_file_paths_per_split.get(split, [])
+                    ),
+                    file_path,
+                )
+            self._file_paths.append(file_path)
+            num_molecules.append(load_shard(file_path, MolerData).num_graphs)
+        self._split_boundaries = np.cumsum([0] + num_molecules)
+        # memory mapped lazily in every process
+        self._molecules = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_molecules"] = None
+        return state
+
+    @property
+    def split_boundaries(self):
+        """The molecules of `splits[i]` have the indices split_boundaries[i] to split_boundaries[i + 1] - 1."""
+        return self._split_boundaries
+
+    def __len__(self):
+        return int(self._split_boundaries[-1])
+
+    def __getitem__(self, idx):
+        if self._molecules is None:
+            self._molecules = [
+                load_shard(file_path, MolerData) for file_path in self._file_paths
+            ]
+        idx = np.sort(np.atleast_1d(np.asarray(idx)))
+        split_idx = np.searchsorted(self._split_boundaries, idx[0], side="right") - 1
+        assert (
+            idx[-1] < self._split_boundaries[split_idx + 1]
+        ), "a batch of molecules has to be from a single split"
+        data = select_gen_steps(
+            self._molecules[split_idx], idx - self._split_boundaries[split_idx]
+        )
+        if hasattr(self._trace_dataset, "sample_gene_expressions"):
+            data = self._trace_dataset.sample_gene_expressions(data)
+        return data
+
+
+class MoleculeBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of up to `batch_size` molecule indices, every batch from a single split. With `shuffle`,
+    the molecules are shuffled within their split and the batches of all splits are shuffled.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, seed=None):
+        self._split_boundaries = dataset.split_boundaries
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        # like the samplers of torch, follow `torch.manual_seed` unless a seed is given
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        sizes = np.diff(self._split_boundaries)
+        return int(np.sum(-(-sizes // self._batch_size)))
+
+    def __iter__(self):
+        batches = []
+        for start, end in zip(self._split_boundaries[:-1], self._split_boundaries[1:]):
+            idx = np.arange(start, end)
+            if self._shuffle:
+                self._rng.shuffle(idx)
+            batches += [
+                idx[i : i + self._batch_size].tolist()
+                for i in range(0, len(idx), self._batch_size)
+            ]
+        order = (
+            self._rng.permutation(len(batches)) if self._shuffle else range(len(batches))
+        )
+        for i in order:
+            yield batches[i]
+
+
+def molecule_dataloader(dataset, batch_size, shuffle=True, num_workers=0, seed=None):
+    return torch.utils.data.DataLoader(
+        dataset,
+        sampler=MoleculeBatchSampler(dataset, batch_size, shuffle=shuffle, seed=seed),
+        batch_size=None,
+        num_workers=num_workers,
+    )
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Sampler
+import numpy as np
+import torch
+
+
+def _read_into_page_cache(file_paths, block_size=1 << 22):
+    """Reads the files once, so that the data loader workers find them in the OS page cache."""
+    for file_path in file_paths:
+        try:
+            with open(file_path, "rb", buffering=0) as f:
+                while f.read(block_size):
+                    pass
+        except OSError:
+            pass
+
+
+class ShardAwareRandomSampler(Sampler):
+    """
+    Random sampler over the shards of a `MolerDataset` that keeps the disk reads mostly sequential.
+
+    The shards of every split are cut into groups of `shards_per_group` consecutive shards (a whole
+    split when it is None). Every epoch visits the groups in a random order, and the shards of a
+    group in their on-disk order, while a background thread reads the next `num_prefetch_groups`
+    groups into the OS page cache.
+
+    With `num_parts_per_shard > 1` the generation steps of every shard are randomly split into that
+    many parts, and the parts of the shards of a group are visited in a random order, so that the
+    generation steps are also shuffled within shards. The sampler then yields (shard index, step
+    indices) tuples, which `MolerDataset` resolves with `select_gen_steps`. This is meant for the
+    memory mapped columnar shards, since every part maps the shard again instead of decompressing it.
+
+    The sampler yields positions in `dataset`, which are only the shard indices if the dataset is
+    not sliced. Without a `seed`, it is drawn from the torch random number generator, so that
+    `pl.seed_everything` makes the order reproducible.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        shards_per_group=None,
+        num_prefetch_groups=0,
+        num_parts_per_shard=1,
+        seed=None,
+    ):
+        self._dataset = dataset
+        self._num_prefetch_groups = num_prefetch_groups
+        self._num_parts_per_shard = num_parts_per_shard
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self._rng = np.random.default_rng(seed)
+        self._worker_id, self._num_workers = 0, 1
+
+        # the shard index of every position of a sliced dataset
+        self._shard_indices = np.asarray(dataset.indices())
+        shard_splits = (
+            np.searchsorted(dataset.split_boundaries, self._shard_indices, side="right") - 1
+        )
+        self._groups = []
+        for split_idx in range(len(dataset.split_boundaries) - 1):
+            positions = np.flatnonzero(shard_splits == split_idx)
+            # in their on-disk order
+            positions = positions[np.argsort(self._shard_indices[positions], kind="stable")]
+            group_size = shards_per_group or max(len(positions), 1)
+            self._groups.extend(
+                positions[group_start : group_start + group_size]
+                for group_start in range(0, len(positions), group_size)
+            )
+
+    def reseed(self, seed):
+        self._rng = np.random.default_rng(seed)
+
+    def set_worker(self, worker_id, num_workers):
+        """
+        Yields only every `num_workers`-th item of an epoch, starting at `worker_id`, and prefetches
+        only the shards of those items. This is for data loader workers that each read their share
+        of the shards, see `DynamicGenStepBatches`.
+        """
+        self._worker_id, self._num_workers = worker_id, num_workers
+
+    def __len__(self):
+        num_shards = sum(len(group) for group in self._groups)
+        if self._num_parts_per_shard == 1:
+            return num_shards
+        # a shard with fewer generation steps than parts is split into fewer parts
+        return sum(
+            min(self._num_gen_steps_of(idx), self._num_parts_per_shard)
+            for group in self._groups
+            for idx in group
+        )
+
+    def _num_gen_steps_of(self, idx):
+        return self._dataset.num_gen_steps_of(self._shard_indices[idx])
+
+    def _group_items(self, group):
+        if self._num_parts_per_shard == 1:
+            return group.tolist()
+        items = []
+        for idx in group:
+            step_indices = self._rng.permutation(self._num_gen_steps_of(idx))
+            items.extend(
+                (int(idx), np.sort(part))
+                for part in np.array_split(step_indices, self._num_parts_per_shard)
+                if len(part) > 0
+            )
+        return [items[i] for i in self._rng.permutation(len(items))]
+
+    def _worker_items(self, items_per_group):
+        worker_items_per_group = []
+        offset = 0
+        for items in items_per_group:
+            worker_items_per_group.append(
+                [
+                    item
+                    for i, item in enumerate(items, offset)
+                    if i % self._num_workers == self._worker_id
+                ]
+            )
+            offset += len(items)
+        return worker_items_per_group
+
+    def _file_paths_of(self, items):
+        processed_file_names = self._dataset.processed_file_names
+        positions = {item[0] if isinstance(item, tuple) else item for item in items}
+        return [
+            processed_file_names[self._shard_indices[idx]] for idx in sorted(positions)
+        ]
+
+    def __iter__(self):
+        group_order = [self._groups[i] for i in self._rng.permutation(len(self._groups))]
+        items_per_group = [self._group_items(group) for group in group_order]
+        if self._num_workers > 1:
+            items_per_group = self._worker_items(items_per_group)
+        if self._num_prefetch_groups == 0:
+            for items in items_per_group:
+                yield from items
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            for i, items in enumerate(items_per_group):
+                prefetched_group_idx = i + self._num_prefetch_groups
+                if i == 0:
+                    prefetched_groups = items_per_group[1 : prefetched_group_idx + 1]
+                elif prefetched_group_idx < len(items_per_group):
+                    prefetched_groups = [items_per_group[prefetched_group_idx]]
+                else:
+                    prefetched_groups = []
+                for prefetched_items in prefetched_groups:
+                    executor.submit(
+                        _read_into_page_cache, self._file_paths_of(prefetched_items)
+                    )
+                yield from items
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,38 @@
+from dataset import MolerData, drop_gen_steps, select_gen_steps
+from torch_geometric.data import Batch
+import numpy as np
+import pytest
+import torch
+
+
+def make_gen_steps(num_steps):
+    return Batch.from_data_list(
+        [
+            MolerData(
+                x=torch.randn(3, 4),
+                edge_index=torch.tensor([[0, 1], [1, 2]]),
+                original_graph_x=torch.randn(4, 4),
+                original_graph_edge_index=torch.tensor([[0, 1, 2], [1, 2, 3]]),
+                valid_attachment_point_choices=torch.tensor([0, 2]),
+                focus_node=torch.tensor([1]),
+            )
+            for _ in range(num_steps)
+        ]
+    )
+
+
+@pytest.mark.parametrize("num_steps", [1, 2, 5])
+def test_keeps_at_least_one_step(num_steps):
+    # the last shard of a raw trace file can hold a single step
+    np.random.seed(0)
+    batch = make_gen_steps(num_steps)
+    for _ in range(100):
+        selected_idx = drop_gen_steps(batch.num_graphs, 0.999)
+        assert len(selected_idx) == 1
+        data = select_gen_steps(batch, selected_idx)
+        assert data.num_graphs == 1
+        assert data.x.size(0) == 3
+
+
+def test_keeps_every_step_without_dropout():
+    np.testing.assert_array_equal(drop_gen_steps(5, 0.0), np.arange(5))
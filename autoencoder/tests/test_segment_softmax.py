@@ -0,0 +1,102 @@
+"""
+The fused segment (log) softmax of `utils.py` against the previous scatter/gather implementation,
+for every backend, including empty segments and logits with several heads.
+
+    cd autoencoder && python -m pytest tests
+"""
+from utils import (
+    SMALL_NUMBER,
+    set_segment_softmax_backend,
+    traced_unsorted_segment_log_softmax,
+    unsorted_segment_softmax,
+)
+from torch_geometric.utils import scatter
+import pytest
+import torch
+
+
+def reference_segment_log_softmax(logits, segment_ids):
+    """The previous implementation of `traced_unsorted_segment_log_softmax`."""
+    max_per_segment = scatter(logits, segment_ids, reduce="max")
+    recentered_scores = logits - max_per_segment[segment_ids]
+    per_segment_sums = scatter(torch.exp(recentered_scores), segment_ids, reduce="sum")
+    return recentered_scores - torch.log(per_segment_sums + SMALL_NUMBER)[segment_ids]
+
+
+def reference_segment_softmax(logits, segment_ids):
+    """The previous implementation of `unsorted_segment_softmax`."""
+    max_per_segment = scatter(logits, segment_ids, reduce="max")
+    exped_recentered_scores = torch.exp(logits - max_per_segment[segment_ids])
+    per_segment_sums = scatter(exped_recentered_scores, segment_ids, reduce="sum")
+    return exped_recentered_scores / (per_segment_sums[segment_ids] + SMALL_NUMBER)
+
+
+BACKENDS = [
+    "eager",
+    "torchscript",
+    pytest.param(
+        "compile",
+        marks=pytest.mark.skipif(
+            not hasattr(torch, "compile"), reason="torch.compile needs torch >= 2.0"
+        ),
+    ),
+]
+FUNCTIONS = [
+    ("log_softmax", reference_segment_log_softmax, traced_unsorted_segment_log_softmax),
+    ("softmax", reference_segment_softmax, unsorted_segment_softmax),
+]
+
+
+@pytest.fixture
+def backend(request):
+    set_segment_softmax_backend(request.param)
+    yield request.param
+    set_segment_softmax_backend("eager")
+
+
+def make_inputs(num_heads, with_empty_segments, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    segment_sizes = torch.randint(1, 8, (20,), generator=generator)
+    if with_empty_segments:
+        segment_sizes[[0, 7, 8, 19]] = 0
+    segment_ids = torch.repeat_interleave(torch.arange(20), segment_sizes)
+    segment_ids = segment_ids[torch.randperm(len(segment_ids), generator=generator)]
+    shape = (len(segment_ids),) if num_heads is None else (len(segment_ids), num_heads)
+    logits = 3 * torch.randn(shape, generator=generator, dtype=torch.float64)
+    return logits, segment_ids
+
+
+def forward_backward(fn, logits, segment_ids, **kwargs):
+    logits = logits.clone().requires_grad_()
+    out = fn(logits, segment_ids, **kwargs)
+    # a loss with a different weight for every output, so that the gradients do not cancel out
+    weights = torch.linspace(-1.0, 2.0, out.numel(), dtype=out.dtype).view(out.shape)
+    (out * weights).sum().backward()
+    return out.detach(), logits.grad
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+@pytest.mark.parametrize("name, reference_fn, fused_fn", FUNCTIONS)
+@pytest.mark.parametrize("num_heads", [None, 4])
+@pytest.mark.parametrize("with_empty_segments", [False, True])
+def test_matches_scatter_reference(
+    backend, name, reference_fn, fused_fn, num_heads, with_empty_segments
+):
+    logits, segment_ids = make_inputs(num_heads, with_empty_segments)
+    expected, expected_grad = forward_backward(reference_fn, logits, segment_ids)
+    # the trailing empty segment is only known from num_segments
+    actual, actual_grad = forward_backward(fused_fn, logits, segment_ids, num_segments=20)
+
+    torch.testing.assert_close(actual, expected, rtol=0, atol=1e-12)
+    # the backward pass assumes that every segment sums to one, which is only true up to the
+    # SMALL_NUMBER added to the normalisers
+    torch.testing.assert_close(actual_grad, expected_grad, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+@pytest.mark.parametrize("name, reference_fn, fused_fn", FUNCTIONS)
+def test_no_logits(backend, name, reference_fn, fused_fn):
+    logits = torch.zeros(0, dtype=torch.float64)
+    segment_ids = torch.zeros(0, dtype=torch.long)
+    actual, actual_grad = forward_backward(fused_fn, logits, segment_ids)
+    assert actual.shape == (0,) and actual_grad.shape == (0,)
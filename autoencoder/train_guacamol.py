@@ -1,10 +1,10 @@
 from dataset import MolerDataset
+from samplers import ShardAwareRandomSampler
 from torch_geometric.loader import DataLoader
 from model import BaseModel
 from aae import AAE
 from model_utils import get_params
 from pytorch_lightning import Trainer
-from torch.utils.data import ConcatDataset
 from datetime import datetime
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping, Timer
 from pytorch_lightning.loggers import TensorBoardLogger
@@ -36,6 +36,8 @@ if __name__ == "__main__":
     )
     parser.add_argument("--use_oclr_scheduler", action="store_true")
     parser.add_argument("--using_cyclical_anneal", action="store_true")
+    # encode every distinct molecule of a batch once, see `encode_unique_original_graphs`
+    parser.add_argument("--deduplicate_original_graphs", action="store_true")
     parser.add_argument("--using_wasserstein_loss", action="store_true")
     parser.add_argument("--using_gp", action="store_true")
     parser.add_argument("--gradient_clip_val", required=True, type=float, default=1.0)
@@ -45,82 +47,20 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    train_split1 = "train_0"
-    train_split2 = "train_1000"
-    train_split3 = "train_2000"
-    train_split4 = "train_3000"
-    train_split5 = "train_4000"
-    train_split6 = "train_5000"
-    train_split7 = "train_6000"
+    train_splits = [f"train_{i}" for i in range(0, 7000, 1000)]
 
     valid_split = "valid_0"
 
     raw_moler_trace_dataset_parent_folder = "data/guacamol/trace_dir"
     output_pyg_trace_dataset_parent_folder = "data/guacamol/already_batched"
 
-    train_dataset1 = MolerDataset(
+    train_dataset = MolerDataset(
         root="/data/ongh0068",
         raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
         output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split1,
+        split=train_splits,
         gen_step_drop_probability=args.gen_step_drop_probability,
     )
-    train_dataset2 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split2,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset3 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split3,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-
-    train_dataset4 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split4,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-
-    train_dataset5 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split5,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset6 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split6,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset7 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split7,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-
-    train_dataset = ConcatDataset(
-        [
-            train_dataset1,
-            train_dataset2,
-            train_dataset3,
-            train_dataset4,
-            train_dataset5,
-            train_dataset6,
-            train_dataset7,
-        ]
-    )
 
     valid_dataset = MolerDataset(
         root="/data/ongh0068",
@@ -133,7 +73,9 @@ if __name__ == "__main__":
     train_dataloader = DataLoader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True,
+        sampler=ShardAwareRandomSampler(
+            train_dataset, shards_per_group=16, num_prefetch_groups=1
+        ),
         # sampler=train_sampler,
         follow_batch=[
             "correct_edge_choices",
@@ -166,13 +108,14 @@ if __name__ == "__main__":
         num_workers=NUM_WORKERS,
     )
 
-    params = get_params(dataset=train_dataset1)  # train_dataset)
+    params = get_params(dataset=train_dataset)
     ###################################################
 
     params["full_graph_encoder"]["layer_type"] = args.layer_type
     params["partial_graph_encoder"]["layer_type"] = args.layer_type
     params["use_oclr_scheduler"] = args.use_oclr_scheduler
     params["using_cyclical_anneal"] = args.using_cyclical_anneal
+    params["deduplicate_original_graphs"] = args.deduplicate_original_graphs
     model_architecture = args.model_architecture
     params["max_lr"] = args.max_lr
     ###################################################
@@ -1,4 +1,5 @@
 from dataset import LincsDataset
+from samplers import ShardAwareRandomSampler
 from torch_geometric.loader import DataLoader
 from model import BaseModel
 from aae import AAE
@@ -118,6 +119,8 @@ if __name__ == "__main__":
     )
     parser.add_argument("--use_oclr_scheduler", action="store_true")
     parser.add_argument("--using_cyclical_anneal", action="store_true")
+    # encode every distinct molecule of a batch once, see `encode_unique_original_graphs`
+    parser.add_argument("--deduplicate_original_graphs", action="store_true")
     parser.add_argument("--using_wasserstein_loss", action="store_true")
     parser.add_argument("--use_clamp_log_var", action="store_true")
     parser.add_argument("--using_gp", action="store_true")
@@ -164,7 +167,9 @@ if __name__ == "__main__":
     train_dataloader = DataLoader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True,
+        sampler=ShardAwareRandomSampler(
+            train_dataset, shards_per_group=16, num_prefetch_groups=1
+        ),
         # sampler=train_sampler,
         follow_batch=[
             "correct_edge_choices",
@@ -206,6 +211,7 @@ if __name__ == "__main__":
     params["partial_graph_encoder"]["layer_type"] = args.layer_type
     params["use_oclr_scheduler"] = args.use_oclr_scheduler
     params["using_cyclical_anneal"] = args.using_cyclical_anneal
+    params["deduplicate_original_graphs"] = args.deduplicate_original_graphs
     model_architecture = args.model_architecture
     params["max_lr"] = args.max_lr
     ###################################################
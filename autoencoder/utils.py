@@ -1,5 +1,4 @@
 import torch
-from torch_geometric.utils import scatter
 
 
 def pprint_pyg_obj(batch, verbose = False):
@@ -34,35 +33,151 @@ def compute_neglogprob_for_multihot_objective(
     )
 
 
-def traced_unsorted_segment_log_softmax(
-    logits,  # edge_candidate_logits
-    segment_ids,  # edge_candidate_to_graph_map
-):
-    """Basically compute the log softmax for an array that contains a mix of a few different
-    groups of logits. The final result is that log softmax is applied to each individual group
-    of logits."""
-    max_per_segment = scatter(logits, segment_ids, reduce="max")
+def _segment_max(values, segment_ids, num_segments: int):
+    index = segment_ids.view([-1] + [1] * (values.dim() - 1)).expand_as(values)
+    # like torch_geometric's scatter, segments without any values get a maximum of 0
+    return torch.zeros(
+        [num_segments] + list(values.shape[1:]), dtype=values.dtype, device=values.device
+    ).scatter_reduce_(0, index, values, reduce="amax", include_self=False)
 
-    scattered_maxes = max_per_segment[segment_ids]
-    recentered_scores = logits - scattered_maxes
-    exped_recentered_scores = torch.exp(recentered_scores)
 
-    per_segment_sums = scatter(exped_recentered_scores, segment_ids, reduce="sum")
-    per_segment_normalization_consts = torch.log(per_segment_sums + SMALL_NUMBER)
+def _segment_sum(values, segment_ids, num_segments: int):
+    return torch.zeros(
+        [num_segments] + list(values.shape[1:]), dtype=values.dtype, device=values.device
+    ).index_add_(0, segment_ids, values)
 
-    log_probs = recentered_scores - per_segment_normalization_consts[segment_ids]
-    return log_probs
 
-def unsorted_segment_softmax(logits, segment_ids):
-    """Same as traced_unsorted_segment_log_softmax except without log."""
-    max_per_segment = scatter(logits, segment_ids, reduce="max")
+def _segment_softmax_forward(
+    logits, segment_ids, num_segments: int, log: bool, small_number: float
+):
+    # recentre by the maximum of each segment, then normalise in place
+    out = logits - _segment_max(logits, segment_ids, num_segments)[segment_ids]
+    if log:
+        per_segment_sums = _segment_sum(torch.exp(out), segment_ids, num_segments)
+        out -= torch.log(per_segment_sums + small_number)[segment_ids]
+    else:
+        out.exp_()
+        per_segment_sums = _segment_sum(out, segment_ids, num_segments)
+        out /= (per_segment_sums + small_number)[segment_ids]
+    return out
+
+
+def _segment_softmax_backward(grad_out, out, segment_ids, num_segments: int, log: bool):
+    if log:
+        # d log_softmax_i / d logit_j = delta_ij - softmax_j
+        return grad_out - torch.exp(out) * _segment_sum(
+            grad_out, segment_ids, num_segments
+        )[segment_ids]
+    # d softmax_i / d logit_j = softmax_i * (delta_ij - softmax_j)
+    return out * (
+        grad_out
+        - _segment_sum(grad_out * out, segment_ids, num_segments)[segment_ids]
+    )
 
-    scattered_maxes = max_per_segment[segment_ids]
-    recentered_scores = logits - scattered_maxes
-    exped_recentered_scores = torch.exp(recentered_scores)
 
-    per_segment_sums = scatter(exped_recentered_scores, segment_ids, reduce="sum")
+_segment_softmax_backend = "eager"
+_segment_softmax_fns = {
+    "eager": (_segment_softmax_forward, _segment_softmax_backward),
+}
+
+
+def set_segment_softmax_backend(backend):
+    """
+    Selects how the fused segment softmax kernels are run: "eager", "torchscript" (torch.jit.script)
+    or "compile" (torch.compile, if the installed torch has it).
+    """
+    global _segment_softmax_backend
+    if backend not in _segment_softmax_fns:
+        if backend == "torchscript":
+            compile_fn = torch.jit.script
+        elif backend == "compile":
+            if not hasattr(torch, "compile"):
+                raise ValueError("torch.compile needs torch >= 2.0.")
+            compile_fn = lambda fn: torch.compile(fn, dynamic=True)
+        else:
+            raise ValueError(f"unknown segment softmax backend {backend}")
+        _segment_softmax_fns[backend] = (
+            compile_fn(_segment_softmax_forward),
+            compile_fn(_segment_softmax_backward),
+        )
+    _segment_softmax_backend = backend
+
+
+class SegmentSoftmax(torch.autograd.Function):
+    """
+    (Log) softmax over the segments of an unsorted array of logits in a single pass, which saves
+    only its output for the backward pass instead of every intermediate result.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, segment_ids, num_segments, log):
+        forward_fn, _ = _segment_softmax_fns[_segment_softmax_backend]
+        out = forward_fn(logits, segment_ids, num_segments, log, SMALL_NUMBER)
+        ctx.save_for_backward(out, segment_ids)
+        ctx.num_segments = num_segments
+        ctx.log = log
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        out, segment_ids = ctx.saved_tensors
+        _, backward_fn = _segment_softmax_fns[_segment_softmax_backend]
+        grad_logits = backward_fn(
+            grad_out.contiguous(), out, segment_ids, ctx.num_segments, ctx.log
+        )
+        return grad_logits, None, None, None
+
+
+def _num_segments(segment_ids):
+    return int(segment_ids.max()) + 1 if segment_ids.numel() > 0 else 0
 
-    probs = exped_recentered_scores / (per_segment_sums[segment_ids] + SMALL_NUMBER)
-    return probs
 
+def traced_unsorted_segment_log_softmax(
+    logits,  # edge_candidate_logits
+    segment_ids,  # edge_candidate_to_graph_map
+    num_segments=None,
+):
+    """Basically compute the log softmax for an array that contains a mix of a few different
+    groups of logits. The final result is that log softmax is applied to each individual group
+    of logits."""
+    if num_segments is None:
+        num_segments = _num_segments(segment_ids)
+    return SegmentSoftmax.apply(logits, segment_ids, num_segments, True)
+
+
+def unsorted_segment_softmax(logits, segment_ids, num_segments=None):
+    """
+    Same as traced_unsorted_segment_log_softmax except without log. logits can also be of shape
+    [V, H], to compute the softmax of every column separately.
+    """
+    if num_segments is None:
+        num_segments = _num_segments(segment_ids)
+    return SegmentSoftmax.apply(logits, segment_ids, num_segments, False)
+
+
+def unsorted_segment_topk(values, segment_ids, k, num_segments=None):
+    """
+    Indices of the k largest values of every segment of an unsorted array of values, shape
+    [num_segments, k], ordered from the largest value down. The rows of segments with fewer than k
+    values are padded with -1. Ties are broken by the position in the array.
+    """
+    if num_segments is None:
+        num_segments = _num_segments(segment_ids)
+    # sort by value, then stably by segment, so that every segment is sorted by value
+    order = torch.sort(values, descending=True, stable=True)[1]
+    order = order[torch.sort(segment_ids[order], stable=True)[1]]
+    sorted_segment_ids = segment_ids[order]
+    segment_sizes = _segment_sum(
+        torch.ones_like(segment_ids), segment_ids, num_segments
+    )
+    segment_starts = torch.cumsum(segment_sizes, dim=0) - segment_sizes
+    rank = (
+        torch.arange(order.shape[0], device=order.device)
+        - segment_starts[sorted_segment_ids]
+    )
+    # everything ranked below the top k goes to an extra column, which is dropped
+    topk_indices = torch.full(
+        (num_segments, k + 1), -1, dtype=torch.long, device=order.device
+    )
+    topk_indices.view(-1)[sorted_segment_ids * (k + 1) + rank.clamp(max=k)] = order
+    return topk_indices[:, :k]
@@ -287,6 +287,9 @@ if __name__ == "__main__":
     parser.add_argument("--ldm_config", type=str, default="/data/conghao001/FYP/DrugDiscovery/ldm/config/ldm_uncon+vae_uncon.yml")
     parser.add_argument("--smiles_file", type=str, default="distribution_learning_smiles.pkl")
     parser.add_argument("--number_samples", type=int, default=1000)
+    parser.add_argument("--decode_batch_size", type=int, default=16)
+    # e.g. 2000, to batch the decoder states by their number of nodes instead of a fixed number
+    parser.add_argument("--max_nodes_per_decode_batch", type=int, default=None)
     args = parser.parse_args()
 
     number_samples = args.number_samples   # let's use 2000 samples rather than 10000
@@ -308,6 +311,8 @@ if __name__ == "__main__":
             internal_bs=internal_bs,
             device=args.device,
             smiles_file=args.smiles_file,
+            decode_batch_size=args.decode_batch_size,
+            max_nodes_per_decode_batch=args.max_nodes_per_decode_batch,
         )
     else: 
         generator = MoLeRGenerator(
@@ -318,6 +323,8 @@ if __name__ == "__main__":
             using_gp=True if args.using_gp else False,
             using_wasserstein_loss=True if args.using_wasserstein_loss else False,
             device=args.device,
+            decode_batch_size=args.decode_batch_size,
+            max_nodes_per_decode_batch=args.max_nodes_per_decode_batch,
         )
 
     json_file_path = os.path.join(args.output_dir, args.output_fp)
@@ -2,11 +2,11 @@ import os
 import sys
 sys.path.append('../autoencoder/')
 from dataset import LincsDataset
+from lincs_index_lists import CSRIndexLists
 # from model import BaseModel
 # from aae import AAE
-from model_utils import get_params
+from model_utils import get_params, set_graph_encoder_backend
 from rdkit.Chem import RDConfig
-import itertools
 from rdkit import Chem
 
 import pandas as pd
@@ -40,69 +40,19 @@ def generate_similar_molecules_with_gene_exp_diff(
     num_samples=20,
     ddim_steps=500,
     ddim_eta=1.0,
+    decode_batch_size=16,
+    max_nodes_per_decode_batch=None,
 ):
     # print('device: ', device)
     # model.to(device=device)
     sampler = MolSampler(model)
     # sampler = sampler.to(device=device)
-    possible_pairs = np.array(list(itertools.product(control_idx, tumour_idx)))
 
-    control_idx_batched = possible_pairs[:, 0]
-    tumour_idx_batched = possible_pairs[:, 1]
-
-    control_gene_exp_batched = dataset._gene_exp_controls[control_idx_batched]
-    tumour_gene_exp_batched = dataset._gene_exp_tumour[tumour_idx_batched]
-    difference_gene_exp_batched = tumour_gene_exp_batched - control_gene_exp_batched
-
-    # Create num_samples//num_diff_vectors random vectors
-    if num_samples > difference_gene_exp_batched.shape[0]:
-        # num_rand_vectors_required = num_samples // difference_gene_exp_batched.shape[0]
-        num_rand_vectors_required = - (- num_samples // difference_gene_exp_batched.shape[0])
-        random_vectors = torch.randn(
-            num_rand_vectors_required, rand_vect_dim, device=device
-        )
-        # repeat each gene expression difference vector in its place a number of times
-        # equal to the number of random vectors using repeat_interleave
-        # then repeat the random vectors batchwise so that we can align the random vectors
-        # with the gene expression differences
-        # Eg given 114 gene expression diff vectors, we will have 8 random vectors
-        # then for each gene expresison vector, we want to match it with each of the
-        # 8 random vectors individually
-        difference_gene_exp_batched = torch.tensor(
-            difference_gene_exp_batched, device=device
-        )
-        difference_gene_exp_batched = torch.repeat_interleave(
-            difference_gene_exp_batched, num_rand_vectors_required, dim=0
-        )
-        difference_gene_exp_batched = difference_gene_exp_batched[:num_samples, :]
-        # random_vectors = random_vectors.repeat(possible_pairs.shape[0], 1)
-        # print(difference_gene_exp_batched.size())
-
-    else:
-        num_rand_vectors_required = num_samples
-        # since number of samples is less than the number of gene expressions
-        # we need to truncate the gene expressions too
-        difference_gene_exp_batched = torch.tensor(
-            difference_gene_exp_batched[:num_samples, :], device=device
-        )
-        # random_vectors = torch.randn(
-        #     num_rand_vectors_required, rand_vect_dim, device=device
-        # )
-
-    dose_batched = (
-        torch.from_numpy(
-            np.repeat(
-                dataset._experiment_idx_to_dose[original_idx], num_samples
-            )
-        )
-        .float()
-        .to(device=device)
+    # every (control, tumour) difference vector is repeated in place to give num_samples vectors,
+    # then the dose is appended
+    cond_vec = dataset.gene_exp_conditioning.conditioning_vectors(
+        control_idx, tumour_idx, original_idx, num_samples, device=device
     )
-
-    # print("dose batched shape: ", dose_batched.shape)
-    # print("difference gene exp batched shape: ", difference_gene_exp_batched.shape)
-
-    cond_vec = torch.cat((difference_gene_exp_batched, dose_batched.unsqueeze(-1)), dim=1)
     conditioning = cond_vec.view((num_samples, 1, cond_vec.size(-1)))
     # print(conditioning.device)
 
@@ -121,7 +71,10 @@ def generate_similar_molecules_with_gene_exp_diff(
     # compute similarity score between all 1000 generated molecules and the actual molecule
     # take the max similarity score
     decoder_states = model.first_stage_model.decode(
-        latent_representations=conditioned_random_vectors, max_num_steps=120
+        latent_representations=conditioned_random_vectors,
+        max_num_steps=120,
+        decode_batch_size=decode_batch_size,
+        max_nodes_per_decode_batch=max_nodes_per_decode_batch,
     )
     molecules = [decoder_state.molecule for decoder_state in decoder_states]
 
@@ -135,40 +88,22 @@ def create_tensors_gene_exp_diff(
     dataset,
     num_samples=20,
 ):
-    possible_pairs = np.array(list(itertools.product(control_idx, tumour_idx)))
-
-    control_idx_batched = possible_pairs[:, 0]
-    tumour_idx_batched = possible_pairs[:, 1]
-
-    control_gene_exp_batched = dataset._gene_exp_controls[control_idx_batched]
-    tumour_gene_exp_batched = dataset._gene_exp_tumour[tumour_idx_batched]
-    difference_gene_exp_batched = tumour_gene_exp_batched - control_gene_exp_batched
-
     # Create num_samples//num_diff_vectors random vectors
-    if num_samples > difference_gene_exp_batched.shape[0]:
-        num_rand_vectors_required = num_samples // difference_gene_exp_batched.shape[0]
-        random_vectors = torch.randn(num_rand_vectors_required, 512)
-        # repeat each gene expression difference vector in its place a number of times
-        # equal to the number of random vectors using repeat_interleave
-        # then repeat the random vectors batchwise so that we can align the random vectors
-        # with the gene expression differences
-        # Eg given 114 gene expression diff vectors, we will have 8 random vectors
-        # then for each gene expresison vector, we want to match it with each of the
-        # 8 random vectors individually
-        difference_gene_exp_batched = torch.tensor(difference_gene_exp_batched)
-        difference_gene_exp_batched = torch.repeat_interleave(
-            difference_gene_exp_batched, num_rand_vectors_required, dim=0
+    (
+        difference_gene_exp_batched,
+        num_repeats,
+    ) = dataset.gene_exp_conditioning.sample_difference_vectors(
+        control_idx, tumour_idx, num_samples, round_up=False
+    )
+    if num_repeats is not None:
+        # each gene expression difference vector is repeated in its place once for each of
+        # the random vectors, so the random vectors are repeated batchwise to align them
+        random_vectors = torch.randn(num_repeats, 512)
+        random_vectors = random_vectors.repeat(
+            difference_gene_exp_batched.shape[0] // num_repeats, 1
         )
-        random_vectors = random_vectors.repeat(possible_pairs.shape[0], 1)
-
     else:
-        num_rand_vectors_required = num_samples
-        # since number of samples is less than the number of gene expressions
-        # we need to truncate the gene expressions too
-        difference_gene_exp_batched = torch.tensor(
-            difference_gene_exp_batched[:num_samples, :]
-        )
-        random_vectors = torch.randn(num_rand_vectors_required, 512)
+        random_vectors = torch.randn(difference_gene_exp_batched.shape[0], 512)
 
     dose_batched = torch.from_numpy(
         np.repeat(
@@ -204,29 +139,6 @@ class GeneExpDataset(torch.utils.data.Dataset):
         )
 
 
-def sanitise(row):
-    """Specifically for the L1000 csv"""
-    control_indices = (
-        row["ControlIndices"]
-        .replace("[", "")
-        .replace("]", "")
-        .replace("\n", "")
-        .split(" ")
-    )
-    control_indices = [idx for idx in control_indices if idx != ""]
-    row["ControlIndices"] = np.asarray(control_indices, dtype=np.int32)
-    tumour_indices = (
-        row["TumourIndices"]
-        .replace("[", "")
-        .replace("]", "")
-        .replace("\n", "")
-        .split(" ")
-    )
-    tumour_indices = [idx for idx in tumour_indices if idx != ""]
-    row["TumourIndices"] = np.asarray(tumour_indices, dtype=np.int32)
-    return row
-
-
 dataset = LincsDataset(
     root="/data/ongh0068",
     raw_moler_trace_dataset_parent_folder="/data/ongh0068/guacamol/trace_dir",
@@ -241,6 +153,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument("-m", "--model_type", type=str, choices=["vae", "aae", "wae", "test"])
 parser.add_argument("-b", "--bind_exp", action="store_true", default=False, help="add this flag to run the binding experiment")
 parser.add_argument("-d", "--device", type=str, default="cuda:0")
+parser.add_argument("--graph_encoder_backend", type=str, default="eager", choices=["eager", "compile"], help="compile the graph encoders used at every decoding step")
+parser.add_argument("--decode_batch_size", type=int, default=16, help="maximal number of decoder states per batch at every decoding step")
+parser.add_argument("--max_nodes_per_decode_batch", type=int, default=None, help="also limit the decoder batches to this many partial graph nodes")
 args = parser.parse_args()
 
 # test_set = pd.read_csv("/data/ongh0068/l1000/l1000_biaae/INPUT_DIR/test.csv")
@@ -248,12 +163,11 @@ if args.bind_exp:
     test_set = pd.read_csv("../binding_affinity/binding_eval_experiments.csv")
 else:
     test_set = pd.read_csv("filtered_test_set.csv")
-test_set = test_set.apply(lambda x: sanitise(x), axis=1)
 
 
 reference_smiles = test_set.SMILES.to_list()
-control_idxes = test_set.ControlIndices.values
-tumour_idxes = test_set.TumourIndices.values
+control_idxes = CSRIndexLists.from_strings(test_set.ControlIndices)
+tumour_idxes = CSRIndexLists.from_strings(test_set.TumourIndices)
 original_idxes = test_set.original_idx.to_list()
 
 # Run this script with the following command:
@@ -358,6 +272,7 @@ ldm_model = LatentDiffusion(
 ldm_model.load_state_dict(ckpt['state_dict'])
 ldm_model.to(device=device)
 ldm_model.eval()
+set_graph_encoder_backend(ldm_model, args.graph_encoder_backend)
 
 results = {}
 
@@ -381,6 +296,8 @@ for control_idx, tumour_idx, reference_smile, original_idx in tqdm(
             device,
             rand_vect_dim=512,
             num_samples=100,
+            decode_batch_size=args.decode_batch_size,
+            max_nodes_per_decode_batch=args.max_nodes_per_decode_batch,
         )
         results["_".join([reference_smile, str(original_idx)])] = {}
         results["_".join([reference_smile, str(original_idx)])]["generated_mols"] = [mol for mol in candidate_molecules]
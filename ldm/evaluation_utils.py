@@ -26,6 +26,8 @@ class MoLeRGenerator(DistributionMatchingGenerator):
         using_wasserstein_loss,
         using_gp,
         device="cuda:0",
+        decode_batch_size=16,
+        max_nodes_per_decode_batch=None,
     ):
         dataset = MolerDataset(
             root="/data/ongh0068",
@@ -34,6 +36,8 @@ class MoLeRGenerator(DistributionMatchingGenerator):
             split="valid_0",
         )
         self._device = device
+        self._decode_batch_size = decode_batch_size
+        self._max_nodes_per_decode_batch = max_nodes_per_decode_batch
         params = get_params(dataset)
         ###################################################
         params['full_graph_encoder']['layer_type'] = layer_type
@@ -64,7 +68,10 @@ class MoLeRGenerator(DistributionMatchingGenerator):
     ) -> List[str]:
         z = torch.randn(number_samples, latent_space_dim).to(self._device) if self._device is not None else torch.randn(number_samples, latent_space_dim).cuda()
         decoder_states = self.model.decode(
-            latent_representations=z, max_num_steps=max_num_steps
+            latent_representations=z,
+            max_num_steps=max_num_steps,
+            decode_batch_size=self._decode_batch_size,
+            max_nodes_per_decode_batch=self._max_nodes_per_decode_batch,
         )
         samples = [
             Chem.MolToSmiles(decoder_state.molecule) for decoder_state in decoder_states
@@ -84,6 +91,8 @@ class LDMGenerator(DistributionMatchingGenerator):
         ddim_eta = 1.0,
         device="cuda:0",
         smiles_file = None,
+        decode_batch_size = 16,
+        max_nodes_per_decode_batch = None,
     ):
         # super().__init__(
         #     ckpt_file_path, 
@@ -153,7 +162,10 @@ class LDMGenerator(DistributionMatchingGenerator):
         self.smiles_file = smiles_file
 
         decoder_states = self.model.first_stage_model.decode(
-            latent_representations=self.z, max_num_steps=120
+            latent_representations=self.z,
+            max_num_steps=120,
+            decode_batch_size=decode_batch_size,
+            max_nodes_per_decode_batch=max_nodes_per_decode_batch,
         )
         # decoder_states = decoder_states.cpu()
         # self.release_gpu_memory(self.model, self.ckpt)
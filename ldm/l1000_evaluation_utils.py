@@ -6,7 +6,6 @@
 
 
 # Compute all possible gene expression difference vectors
-import itertools
 from rdkit import DataStructs, Chem
 from rdkit.Chem import MACCSkeys
 from rdkit.Chem import AllChem
@@ -19,42 +18,27 @@ from tqdm import tqdm
 def generate_similar_molecules_with_gene_exp_diff(
     control_idx, tumour_idx, dataset, model, num_samples=1000, device="cuda:0"
 ):
-    possible_pairs = np.array(list(itertools.product(control_idx, tumour_idx)))
-
-    control_idx_batched = possible_pairs[:, 0]
-    tumour_idx_batched = possible_pairs[:, 1]
-
-    control_gene_exp_batched = dataset._gene_exp_controls[control_idx_batched]
-    tumour_gene_exp_batched = dataset._gene_exp_tumour[tumour_idx_batched]
-    difference_gene_exp_batched = tumour_gene_exp_batched - control_gene_exp_batched
-
     # Create num_samples//num_diff_vectors random vectors
-    if num_samples > difference_gene_exp_batched.shape[0]:
-        num_rand_vectors_required = num_samples // difference_gene_exp_batched.shape[0]
-        random_vectors = torch.randn(num_rand_vectors_required, 512, device=device)
-        # repeat each gene expression difference vector in its place a number of times
-        # equal to the number of random vectors using repeat_interleave
-        # then repeat the random vectors batchwise so that we can align the random vectors
-        # with the gene expression differences
+    (
+        difference_gene_exp_batched,
+        num_repeats,
+    ) = dataset.gene_exp_conditioning.sample_difference_vectors(
+        control_idx, tumour_idx, num_samples, device=device, round_up=False
+    )
+    if num_repeats is not None:
+        random_vectors = torch.randn(num_repeats, 512, device=device)
+        # each gene expression difference vector is repeated in its place once for each of
+        # the random vectors, so the random vectors are repeated batchwise to align them
         # Eg given 114 gene expression diff vectors, we will have 8 random vectors
         # then for each gene expresison vector, we want to match it with each of the
         # 8 random vectors individually
-        difference_gene_exp_batched = torch.tensor(
-            difference_gene_exp_batched, device=device
+        random_vectors = random_vectors.repeat(
+            difference_gene_exp_batched.shape[0] // num_repeats, 1
         )
-        difference_gene_exp_batched = torch.repeat_interleave(
-            difference_gene_exp_batched, num_rand_vectors_required, dim=0
-        )
-        random_vectors = random_vectors.repeat(possible_pairs.shape[0], 1)
-
     else:
-        num_rand_vectors_required = num_samples
         # since number of samples is less than the number of gene expressions
-        # we need to truncate the gene expressions too
-        difference_gene_exp_batched = torch.tensor(
-            difference_gene_exp_batched[:num_samples, :], device=device
-        )
-        random_vectors = torch.randn(num_rand_vectors_required, 512, device=device)
+        # the gene expressions are truncated too
+        random_vectors = torch.randn(num_samples, 512, device=device)
 
     conditioned_random_vectors = model.condition_on_gene_expression(
         latent_representation=random_vectors,
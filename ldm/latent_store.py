@@ -0,0 +1,274 @@
+"""
+Precomputed first stage latents for training the latent diffusion model without running the
+frozen first stage encoder (and without reading the trace shards) in every training step.
+
+Every distinct molecule of the dataset (for l1000, every distinct pair of molecule and experiment)
+is encoded once, and the parameters of its latent distribution (see `first_stage_posterior` in
+`moler_ldm.py`) are stored in a folder of .npy files:
+
+    posterior.npy   [N, latent dim] z of the aae/wae, [N, 2 * latent dim] mean and log variance of the vae
+    l1000_idx.npy   [N] experiment of every row, for l1000
+    metadata.json   model type, latent dim, dtype and the data the latents were computed from
+
+which are memory mapped by `LatentStoreDataset`. Only the latents are precomputed: the vae latents
+are still sampled in every step, and the (gene expression difference, dose) conditioning vectors
+of the experiments are drawn anew for every batch by the `LincsDataset`, like for the shards.
+
+    python latent_store.py --config_file=config/ldm_con+aae_con.yml --dataset=l1000 \
+        --splits train_0 --output_folder=data/l1000/latents/aae_con_train_0 --dtype=float16
+"""
+import sys
+sys.path.append('../autoencoder/')
+from types import SimpleNamespace
+import argparse
+import json
+import os
+import numpy as np
+import torch
+
+LATENT_STORE_DTYPES = ["float32", "float16"]
+
+
+class _NpyChunkWriter:
+    """Appends row chunks of unknown total number to a .npy file."""
+
+    def __init__(self, file_path, dtype):
+        self._file_path = file_path
+        self._rows_file_path = file_path + ".rows.tmp"
+        self._dtype = np.dtype(dtype)
+        self._num_rows = 0
+        self._row_shape = None
+        self._f = open(self._rows_file_path, "wb")
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self._dtype)
+        if self._row_shape is None:
+            self._row_shape = rows.shape[1:]
+        assert rows.shape[1:] == self._row_shape, "rows of different shapes"
+        self._f.write(rows.tobytes())
+        self._num_rows += rows.shape[0]
+
+    def close(self):
+        self._f.close()
+        shape = (self._num_rows,) + tuple(self._row_shape or ())
+        raw = np.memmap(self._rows_file_path, dtype=self._dtype, mode="r", shape=shape)
+        out = np.lib.format.open_memmap(
+            self._file_path + ".tmp", mode="w+", dtype=self._dtype, shape=shape
+        )
+        for start in range(0, self._num_rows, 1 << 16):
+            out[start : start + (1 << 16)] = raw[start : start + (1 << 16)]
+        out.flush()
+        del raw, out
+        os.replace(self._file_path + ".tmp", self._file_path)
+        os.remove(self._rows_file_path)
+
+
+@torch.no_grad()
+def write_latent_store(
+    first_stage_model,
+    model_type,
+    dataloader,
+    output_folder,
+    dtype="float32",
+    device="cpu",
+    metadata=None,
+):
+    """
+    Encodes every distinct molecule of the batches of `dataloader`, e.g. of a `MoleculeDataset`
+    (or batches of generation steps, without dropped steps) and writes the store. Consecutive
+    steps of the same molecule with different experiments (`l1000_idx`) get a row each.
+    """
+    from dataset import first_step_mask
+    from encoder import encode_unique_original_graphs
+    from moler_ldm import first_stage_posterior
+
+    assert dtype in LATENT_STORE_DTYPES, f"unsupported dtype {dtype}"
+    os.makedirs(output_folder, exist_ok=True)
+    first_stage_model = first_stage_model.to(device).eval()
+    writers = {}
+    for batch in dataloader:
+        batch = batch.to(device)
+        encoder_posterior, graph_to_unique_graph = encode_unique_original_graphs(
+            first_stage_model.full_graph_encoder,
+            batch,
+            deduplicate=first_stage_model.deduplicate_original_graphs,
+        )
+        is_first_step = first_step_mask(
+            batch, graph_to_unique_graph, extra_keys=["l1000_idx"]
+        )
+        arrays = {
+            "posterior": first_stage_posterior(
+                first_stage_model, model_type, encoder_posterior
+            )[graph_to_unique_graph[is_first_step]].float()
+        }
+        if "l1000_idx" in batch:
+            arrays["l1000_idx"] = batch.l1000_idx.view(-1)[is_first_step]
+
+        for name, array in arrays.items():
+            if name not in writers:
+                writers[name] = _NpyChunkWriter(
+                    os.path.join(output_folder, f"{name}.npy"),
+                    np.int64 if name == "l1000_idx" else dtype,
+                )
+            writers[name].append(array.cpu().numpy())
+
+    for writer in writers.values():
+        writer.close()
+    metadata = dict(metadata or {})
+    metadata.update(
+        model_type=model_type,
+        latent_dim=first_stage_model.latent_dim,
+        dtype=dtype,
+        num_latents=writers["posterior"]._num_rows,
+        arrays=sorted(writers),
+    )
+    with open(os.path.join(output_folder, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=4)
+    return metadata
+
+
+class LatentStoreDataset(torch.utils.data.Dataset):
+    """
+    Rows of a latent store. Indexing with a list of indices returns a whole batch, so it is meant
+    to be used with a `BatchSampler` and `batch_size=None`, see `latent_store_dataloader`.
+
+    A store with experiments (`l1000_idx`) needs the `LincsDataset` it was computed from, which
+    draws the conditioning vectors ("cond") of every batch.
+    """
+
+    def __init__(self, store_folder, trace_dataset=None):
+        self._store_folder = store_folder
+        with open(os.path.join(store_folder, "metadata.json")) as f:
+            self.metadata = json.load(f)
+        if "l1000_idx" in self.metadata["arrays"]:
+            assert hasattr(
+                trace_dataset, "sample_gene_expressions"
+            ), "a latent store with experiments needs the LincsDataset to draw their conditioning"
+        self._trace_dataset = trace_dataset
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # reopen the memory mapped arrays in the data loader workers instead of pickling them
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(
+                    os.path.join(self._store_folder, f"{name}.npy"), mmap_mode="r"
+                )
+                for name in self.metadata["arrays"]
+            }
+        return self._arrays
+
+    @property
+    def model_type(self):
+        return self.metadata["model_type"]
+
+    def __len__(self):
+        return self.metadata["num_latents"]
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, int):
+            # sorted reads are sequential within the memory mapped files
+            idx = np.sort(np.asarray(idx))
+        rows = {
+            name: torch.from_numpy(np.array(array[idx], dtype=np.float32))
+            for name, array in self.arrays.items()
+            if name != "l1000_idx"
+        }
+        if "l1000_idx" in self.arrays:
+            experiments = self._trace_dataset.sample_gene_expressions(
+                SimpleNamespace(l1000_idx=np.atleast_1d(self.arrays["l1000_idx"][idx]))
+            )
+            rows["cond"] = torch.cat(
+                (experiments.gene_expressions, experiments.dose.view(-1, 1)), dim=-1
+            )
+            if isinstance(idx, int):
+                rows["cond"] = rows["cond"][0]
+        return rows
+
+
+def latent_store_dataloader(
+    store_folder, batch_size, shuffle=True, num_workers=0, trace_dataset=None
+):
+    dataset = LatentStoreDataset(store_folder, trace_dataset=trace_dataset)
+    sampler = (
+        torch.utils.data.RandomSampler(dataset)
+        if shuffle
+        else torch.utils.data.SequentialSampler(dataset)
+    )
+    return torch.utils.data.DataLoader(
+        dataset,
+        sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=num_workers,
+    )
+
+
+if __name__ == "__main__":
+    from dataset import MolerDataset, LincsDataset
+    from molecule_dataset import MoleculeDataset, molecule_dataloader
+    from omegaconf import OmegaConf
+    from ldm.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_file", type=str, required=True)
+    parser.add_argument("--dataset", type=str, required=True, choices=["guacamol", "l1000"])
+    parser.add_argument("--splits", type=str, nargs="+", required=True)
+    parser.add_argument("--output_folder", type=str, required=True)
+    parser.add_argument("--dtype", type=str, default="float32", choices=LATENT_STORE_DTYPES)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--molecules_per_batch", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.dataset == "guacamol":
+        dataset = MolerDataset(
+            root="/data/ongh0068",
+            raw_moler_trace_dataset_parent_folder="data/guacamol/trace_dir",
+            output_pyg_trace_dataset_parent_folder="data/guacamol/already_batched",
+            split=args.splits,
+            gen_step_drop_probability=0.0,
+        )
+    else:
+        dataset = LincsDataset(
+            root="/data/ongh0068",
+            raw_moler_trace_dataset_parent_folder="data/l1000/trace_dir",
+            output_pyg_trace_dataset_parent_folder="data/l1000/already_batched",
+            gene_exp_controls_file_path="data/l1000/robust_normalized_controls.npz",
+            gene_exp_tumour_file_path="data/l1000/robust_normalized_tumors.npz",
+            lincs_csv_file_path="data/l1000/experiments_filtered.csv",
+            split=args.splits,
+            gen_step_drop_probability=0.0,
+        )
+    dataloader = molecule_dataloader(
+        MoleculeDataset(dataset),
+        batch_size=args.molecules_per_batch,
+        shuffle=False,
+        num_workers=args.num_workers,
+    )
+
+    first_stage_config = OmegaConf.load(args.config_file)["model"]["first_stage_config"]
+    # the first stage hyperparameters are restored from the checkpoint
+    first_stage_model = get_obj_from_str(first_stage_config["target"]).load_from_checkpoint(
+        first_stage_config["ckpt_path"], dataset=dataset, map_location="cpu"
+    )
+    metadata = write_latent_store(
+        first_stage_model,
+        first_stage_config["model_type"],
+        dataloader,
+        args.output_folder,
+        dtype=args.dtype,
+        device=args.device,
+        metadata=dict(
+            config_file=args.config_file,
+            first_stage_ckpt=first_stage_config["ckpt_path"],
+            dataset=args.dataset,
+            splits=args.splits,
+        ),
+    )
+    print(f"wrote {metadata['num_latents']} latents to {args.output_folder}")
@@ -7,6 +7,19 @@ from ldm.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat,
 from torch.optim.lr_scheduler import LambdaLR
 from pytorch_lightning.utilities import rank_zero_only
 import numpy as np
+from encoder import encode_original_graphs
+
+def first_stage_posterior(first_stage_model, model_architecture, encoder_posterior):
+    """
+    Parameters of the latent distribution of the first stage model given the full graph
+    representations: the concatenated mean and log variance for the vae, z itself for the aae/wae.
+    """
+    if model_architecture == 'vae':
+        return first_stage_model.mean_log_var_mlp(encoder_posterior)
+    elif model_architecture == 'aae' or model_architecture == 'wae':
+        return first_stage_model.latent_repr_mlp(encoder_posterior)
+    else:
+        raise NotImplementedError('first stage model type is not supported')
 
 class LatentDiffusion(DDPM):
     def __init__(self,
@@ -25,6 +38,7 @@ class LatentDiffusion(DDPM):
                  conditioning_key=None,    # by default, concat mode is used
                  scale_factor=1.0,
                  scale_by_std=False,
+                 encode_partial_graphs=False,    # only needed to decode the first stage outputs, e.g. for diagnostics
                  *args, **kwargs):
         # self.log("drop_prob", dataset._gen_step_drop_probability)    # can't call here since trainer is not initiated yet
         
@@ -67,6 +81,9 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        self.encode_partial_graphs = encode_partial_graphs
+        self.partial_reprs = None
+        self.node_reprs = None
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -88,13 +105,7 @@ class LatentDiffusion(DDPM):
             # set rescale weight to 1./std of encodings
             print("### USING STD-RESCALING ###")
             # x = super().get_input(batch, self.first_stage_key)    # this is not necessary as the whole batch is always passed together
-            x = batch
-            x = x.to(self.device)
-            encoder_posterior, partial_reprs, node_reprs = self.encode_first_stage(x)
-            self.partial_reprs = partial_reprs
-            self.node_reprs = node_reprs
-            
-            z = self.get_first_stage_encoding(encoder_posterior).detach()
+            z = self.get_first_stage_input(batch)
             del self.scale_factor
             self.register_buffer('scale_factor', 1. / z.flatten().std())
             print(f"setting self.scale_factor to {self.scale_factor}")
@@ -198,18 +209,33 @@ class LatentDiffusion(DDPM):
         #     z = encoder_posterior.sample()
 
         if isinstance(encoder_posterior, torch.Tensor):
-            if self.model_architecture == 'vae':
-                mean_and_logvar = self.first_stage_model.mean_log_var_mlp(encoder_posterior)
-                mu = mean_and_logvar[:, : self.latent_dim]  # Shape: [V, MD]
-                log_var = mean_and_logvar[:, self.latent_dim :]  # Shape: [V, MD]
-                z = self.first_stage_model.reparametrize(mu, log_var)
-            elif self.model_architecture == 'aae' or self.model_architecture == 'wae':
-                z = self.first_stage_model.latent_repr_mlp(encoder_posterior)
-            else:
-                raise NotImplementedError('first stage model type is not supported')
+            posterior = first_stage_posterior(self.first_stage_model, self.model_architecture, encoder_posterior)
         else:
             raise NotImplementedError(f"encoder_posterior of type '{type(encoder_posterior)}' not yet implemented")
+        return self.sample_first_stage_encoding(posterior)
+
+    def sample_first_stage_encoding(self, posterior):
+        # posterior is the output of `first_stage_posterior`, e.g. read from a precomputed latent store
+        if self.model_architecture == 'vae':
+            mu = posterior[:, : self.latent_dim]  # Shape: [V, MD]
+            log_var = posterior[:, self.latent_dim :]  # Shape: [V, MD]
+            z = self.first_stage_model.reparametrize(mu, log_var)
+        else:
+            z = posterior
         return self.scale_factor * z
+
+    @torch.no_grad()
+    def get_first_stage_input(self, batch, with_partial=False):
+        # batches of a `LatentStoreDataset` hold the precomputed posteriors, the encoder is not needed
+        if isinstance(batch, dict) and 'posterior' in batch:
+            return self.sample_first_stage_encoding(batch['posterior'].to(self.device).float())
+        x = batch.to(self.device)
+        encoder_posterior, partial_reprs, node_reprs = self.encode_first_stage(
+            x, with_partial=with_partial or self.encode_partial_graphs
+        )
+        self.partial_reprs = partial_reprs
+        self.node_reprs = node_reprs
+        return self.get_first_stage_encoding(encoder_posterior).detach()
     
     '''
     def get_learned_conditioning(self, c):
@@ -246,17 +272,17 @@ class LatentDiffusion(DDPM):
         x = batch
         if bs is not None:
             x = x[:bs]
-        x = x.to(self.device)
-        encoder_posterior, partial_reprs, node_reprs = self.encode_first_stage(x)
-        z = self.get_first_stage_encoding(encoder_posterior).detach()
-        self.partial_reprs = partial_reprs
-        self.node_reprs = node_reprs
+        z = self.get_first_stage_input(x, with_partial=return_first_stage_outputs)
 
         if self.model.conditioning_key is not None:    # should be concat or crossattn
             if cond_key is None:
                 cond_key = self.cond_stage_key
 
-            if cond_key == 'gene_expressions':
+            if isinstance(batch, dict) and 'posterior' in batch:
+                # the (gene expression, dose) conditioning vectors are drawn for the stored experiments
+                assert 'cond' in batch, 'the latent store has no experiments'
+                xc = batch['cond'].to(self.device).float()
+            elif cond_key == 'gene_expressions':
                 xc = torch.cat((batch[cond_key], batch['dose'].unsqueeze(-1)), dim=-1)
             else:
                 xc = None
@@ -301,6 +327,7 @@ class LatentDiffusion(DDPM):
     
     @torch.no_grad()
     def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
+        assert self.partial_reprs is not None, 'the partial graphs were not encoded, see `encode_partial_graphs`'
         z = 1. / self.scale_factor * z
         (
             first_node_type_logits,
@@ -325,15 +352,16 @@ class LatentDiffusion(DDPM):
         return [first_node_type_logits, node_type_logits, edge_candidate_logits, edge_type_logits, attachment_point_selection_logits]
     
     @torch.no_grad()
-    def encode_first_stage(self, batch):
-        # other repr from partial encoder should also be done and passed to self, so that decoder can access to them
-        input_molecule_representations = self.first_stage_model.full_graph_encoder(
-            original_graph_node_categorical_features=batch.original_graph_node_categorical_features,
-            node_features=batch.original_graph_x.float(),
-            edge_index=batch.original_graph_edge_index,
-            edge_features=batch.original_graph_edge_features,  # can be edge_type or edge_attr
-            batch_index=batch.original_graph_x_batch,
+    def encode_first_stage(self, batch, with_partial=False):
+        # the diffusion loss only needs the full graph latents. the partial graph representations are
+        # only used by the decoder (`decode_first_stage`), so they are computed on request
+        input_molecule_representations = encode_original_graphs(
+            self.first_stage_model.full_graph_encoder,
+            batch,
+            deduplicate=self.first_stage_model.deduplicate_original_graphs,
         )
+        if not with_partial:
+            return input_molecule_representations, None, None
         partial_graph_representations, node_representations = self.first_stage_model.partial_graph_encoder(
             partial_graph_node_categorical_features=batch.partial_node_categorical_features,
             node_features=batch.x,
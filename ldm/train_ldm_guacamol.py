@@ -2,17 +2,20 @@ import sys
 sys.path.append('../autoencoder/')
 import numpy as np
 from dataset import MolerDataset
+from samplers import ShardAwareRandomSampler
+from dynamic_batching import DynamicGenStepBatches
 from torch_geometric.loader import DataLoader
 import torch
 from omegaconf import OmegaConf
 from model_utils import get_params
-from torch.utils.data import ConcatDataset
 from pytorch_lightning.trainer import Trainer
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping, Timer
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.callbacks import LearningRateMonitor
 from datetime import datetime
 from moler_ldm import LatentDiffusion
+from latent_store import latent_store_dataloader
+from molecule_dataset import MoleculeDataset, molecule_dataloader
 import argparse
 
 def filter_dataset(remove_idx, dataset):
@@ -51,6 +54,21 @@ if __name__ == "__main__":
     parser.add_argument("--pretrained_ckpt", type=str)
     parser.add_argument("--pretrained_ckpt_model_type", type=str)
     parser.add_argument("--config_file", type=str, default="config/ldm_uncon+vae_uncon.yml")
+    parser.add_argument(
+        "--valid_shard_cache_gb",
+        type=float,
+        default=2.0,
+        help="size of the per worker cache of validation shards, which are re-read every epoch",
+    )
+    # precomputed with latent_store.py, replaces the training shards and the first stage encoder
+    parser.add_argument("--train_latent_store", type=str)
+    parser.add_argument("--latent_batch_size", type=int, default=1000)
+    # train on batches of distinct molecules instead of shards of generation steps
+    parser.add_argument("--molecules_per_batch", type=int)
+    # if any of these is set, training batches are packed up to a budget instead of being whole shards
+    parser.add_argument("--max_nodes_per_batch", type=int)
+    parser.add_argument("--max_edges_per_batch", type=int)
+    parser.add_argument("--max_candidate_edges_per_batch", type=int)
 
     '''
     VAE (unconditional): 
@@ -74,13 +92,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    train_split1 = "train_0"
-    train_split2 = "train_1000"
-    train_split3 = "train_2000"
-    train_split4 = "train_3000"
-    train_split5 = "train_4000"
-    train_split6 = "train_5000"
-    train_split7 = "train_6000"
+    train_splits = [f"train_{i}" for i in range(0, 7000, 1000)]
 
     valid_split = "valid_0"
 
@@ -93,95 +105,78 @@ if __name__ == "__main__":
     config = OmegaConf.load(args.config_file)
     ldm_params = config['model']['params']
 
-    train_dataset1 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split1,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset2 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split2,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset3 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split3,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-
-    train_dataset4 = MolerDataset(
+    train_dataset = MolerDataset(
         root="/data/ongh0068",
         raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
         output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split4,
+        split=train_splits,
         gen_step_drop_probability=args.gen_step_drop_probability,
     )
 
-    train_dataset5 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split5,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset6 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split6,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-    train_dataset7 = MolerDataset(
-        root="/data/ongh0068",
-        raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
-        output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
-        split=train_split7,
-        gen_step_drop_probability=args.gen_step_drop_probability,
-    )
-
-    train_dataset = ConcatDataset(
-        [
-            train_dataset1,
-            train_dataset2,
-            train_dataset3,
-            train_dataset4,
-            train_dataset5,
-            train_dataset6,
-            train_dataset7,
-        ]
-    )
-
     valid_dataset = MolerDataset(
         root="/data/ongh0068",
         raw_moler_trace_dataset_parent_folder=raw_moler_trace_dataset_parent_folder,  # "/data/ongh0068/l1000/trace_playground",
         output_pyg_trace_dataset_parent_folder=output_pyg_trace_dataset_parent_folder,
         split=valid_split,
-        gen_step_drop_probability=0.0
+        gen_step_drop_probability=0.0,
+        shard_cache_size_bytes=int(args.valid_shard_cache_gb * 2**30),
     )
 
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        # sampler=train_sampler,
-        follow_batch=[
-            "correct_edge_choices",
-            "correct_edge_types",
-            "valid_edge_choices",
-            "valid_attachment_point_choices",
-            "correct_attachment_point_choice",
-            "correct_node_type_choices",
-            "original_graph_x",
-            "correct_first_node_type_choices",
-        ],
-        num_workers=NUM_WORKERS,
+    train_sampler = ShardAwareRandomSampler(
+        train_dataset, shards_per_group=16, num_prefetch_groups=1
     )
+    if args.train_latent_store is not None:
+        train_dataloader = latent_store_dataloader(
+            args.train_latent_store,
+            batch_size=args.latent_batch_size,
+            num_workers=NUM_WORKERS,
+        )
+        assert (
+            train_dataloader.dataset.model_type
+            == config['model']['first_stage_config']['model_type']
+        ), 'the latent store was computed with a different first stage model'
+    elif args.molecules_per_batch is not None:
+        train_dataloader = molecule_dataloader(
+            MoleculeDataset(train_dataset),
+            batch_size=args.molecules_per_batch,
+            num_workers=NUM_WORKERS,
+        )
+    elif any(
+        max_size is not None
+        for max_size in [
+            args.max_nodes_per_batch,
+            args.max_edges_per_batch,
+            args.max_candidate_edges_per_batch,
+        ]
+    ):
+        train_dataloader = torch.utils.data.DataLoader(
+            DynamicGenStepBatches(
+                train_dataset,
+                train_sampler,
+                max_num_nodes=args.max_nodes_per_batch,
+                max_num_edges=args.max_edges_per_batch,
+                max_num_candidate_edges=args.max_candidate_edges_per_batch,
+            ),
+            batch_size=None,
+            num_workers=NUM_WORKERS,
+        )
+    else:
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            sampler=train_sampler,
+            follow_batch=[
+                "correct_edge_choices",
+                "correct_edge_types",
+                "valid_edge_choices",
+                "valid_attachment_point_choices",
+                "correct_attachment_point_choice",
+                "correct_node_type_choices",
+                "original_graph_x",
+                "correct_first_node_type_choices",
+            ],
+            num_workers=NUM_WORKERS,
+        )
 
     valid_dataset = valid_dataset[:100]  # use only 100 batches for validation
     valid_dataloader = DataLoader(
@@ -200,11 +195,12 @@ if __name__ == "__main__":
             "correct_first_node_type_choices",
         ],
         num_workers=NUM_WORKERS,
+        persistent_workers=NUM_WORKERS > 0,  # keeps the shard caches of the workers across epochs
     )
 
     # print(len(train_dataloader), len(valid_dataloader))
     # print(next(iter(train_dataloader)))
-    first_stage_params = get_params(train_dataset1)
+    first_stage_params = get_params(train_dataset)
     ###################################################
     first_stage_params["full_graph_encoder"]["layer_type"] = args.layer_type
     first_stage_params["partial_graph_encoder"]["layer_type"] = args.layer_type
@@ -2,6 +2,7 @@ import sys
 sys.path.append('../autoencoder/')
 import numpy as np
 from dataset import LincsDataset
+from samplers import ShardAwareRandomSampler
 from torch_geometric.loader import DataLoader
 import torch
 from omegaconf import OmegaConf
@@ -12,6 +13,8 @@ from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.callbacks import LearningRateMonitor
 from datetime import datetime
 from moler_ldm import LatentDiffusion
+from latent_store import latent_store_dataloader
+from molecule_dataset import MoleculeDataset, molecule_dataloader
 import argparse
 
 def filter_dataset(remove_idx, dataset):
@@ -50,6 +53,17 @@ if __name__ == "__main__":
     parser.add_argument("--pretrained_ckpt", type=str)
     parser.add_argument("--pretrained_ckpt_model_type", type=str)
     parser.add_argument("--config_file", type=str, default="config/ldm_uncon+vae_uncon.yml")
+    parser.add_argument(
+        "--valid_shard_cache_gb",
+        type=float,
+        default=2.0,
+        help="size of the per worker cache of validation shards, which are re-read every epoch",
+    )
+    # precomputed with latent_store.py, replaces the training shards and the first stage encoder
+    parser.add_argument("--train_latent_store", type=str)
+    parser.add_argument("--latent_batch_size", type=int, default=1000)
+    # train on batches of distinct molecules instead of shards of generation steps
+    parser.add_argument("--molecules_per_batch", type=int)
 
     '''
     VAE (unconditional): 
@@ -99,29 +113,50 @@ if __name__ == "__main__":
         lincs_csv_file_path=lincs_csv_file_path,
         split=valid_split,
         gen_step_drop_probability=args.gen_step_drop_probability,
+        shard_cache_size_bytes=int(args.valid_shard_cache_gb * 2**30),
     )
 
     # train_dataset = filter_dataset(791, train_dataset)
     # valid_dataset = filter_dataset(791, valid_dataset)
 
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        # sampler=train_sampler,
-        follow_batch=[
-            "correct_edge_choices",
-            "correct_edge_types",
-            "valid_edge_choices",
-            "valid_attachment_point_choices",
-            "correct_attachment_point_choice",
-            "correct_node_type_choices",
-            "original_graph_x",
-            "correct_first_node_type_choices",
-        ],
-        num_workers=NUM_WORKERS,
-        # prefetch_factor=0,
-    )
+    if args.train_latent_store is not None:
+        train_dataloader = latent_store_dataloader(
+            args.train_latent_store,
+            batch_size=args.latent_batch_size,
+            num_workers=NUM_WORKERS,
+            trace_dataset=train_dataset,
+        )
+        assert (
+            train_dataloader.dataset.model_type
+            == config['model']['first_stage_config']['model_type']
+        ), 'the latent store was computed with a different first stage model'
+    elif args.molecules_per_batch is not None:
+        train_dataloader = molecule_dataloader(
+            MoleculeDataset(train_dataset),
+            batch_size=args.molecules_per_batch,
+            num_workers=NUM_WORKERS,
+        )
+    else:
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            sampler=ShardAwareRandomSampler(
+                train_dataset, shards_per_group=16, num_prefetch_groups=1
+            ),
+            # sampler=train_sampler,
+            follow_batch=[
+                "correct_edge_choices",
+                "correct_edge_types",
+                "valid_edge_choices",
+                "valid_attachment_point_choices",
+                "correct_attachment_point_choice",
+                "correct_node_type_choices",
+                "original_graph_x",
+                "correct_first_node_type_choices",
+            ],
+            num_workers=NUM_WORKERS,
+            # prefetch_factor=0,
+        )
 
     valid_dataset = valid_dataset[:100]  # use only 200 batches for validation
     valid_dataloader = DataLoader(
@@ -140,6 +175,7 @@ if __name__ == "__main__":
             "correct_first_node_type_choices",
         ],
         num_workers=NUM_WORKERS,
+        persistent_workers=NUM_WORKERS > 0,  # keeps the shard caches of the workers across epochs
         # prefetch_factor=0,
     )
 